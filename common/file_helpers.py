@@ -1,10 +1,15 @@
 import io
 import os
+import queue
 import tempfile
+import threading
 import contextlib
+from collections.abc import Iterator
 import zstandard as zstd
 
 LOG_COMPRESSION_LEVEL = 10 # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_READ_SIZE = 1024 * 1024
+UPLOAD_QUEUE_SIZE = 4  # compressed chunks buffered ahead of the upload
 
 
 class CallbackReader:
@@ -41,18 +46,96 @@ def atomic_write_in_dir(path: str, mode: str = 'w', buffering: int = -1, encodin
   os.replace(tmp_file_name, path)
 
 
-def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.BufferedIOBase, int]:
+def compress_chunks(f, level: int = LOG_COMPRESSION_LEVEL) -> Iterator[bytes]:
+  """Zstd compress a file into a single frame, chunk by chunk. The output only depends on the file contents."""
+  compressor = zstd.ZstdCompressor(level=level).compressobj()
+  while chunk := f.read(UPLOAD_READ_SIZE):
+    if out := compressor.compress(chunk):
+      yield out
+  yield compressor.flush()
+
+
+class CompressedUploadStream(io.RawIOBase):
+  """Zstd compressed file, compressed on its own thread while it's being read.
+
+  Uploads need to know their size up front, so the file is compressed once to count the bytes,
+  and compressed again as it's sent. Only a few compressed chunks are ever held in memory."""
+  def __init__(self, filepath: str):
+    super().__init__()
+    self._stop = threading.Event()
+    self._thread: threading.Thread | None = None
+    with open(filepath, "rb") as f:
+      # requests takes the Content-Length from len, also through wrappers like CallbackReader
+      self.len = sum(len(chunk) for chunk in compress_chunks(f))
+
+    self._pos = 0
+    self._buf = memoryview(b"")
+    self._done = False
+    self._queue: queue.Queue[bytes | Exception | None] = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    self._thread = threading.Thread(target=self._compress, args=(filepath,), daemon=True)
+    self._thread.start()
+
+  def _put(self, item: bytes | Exception | None) -> bool:
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _compress(self, filepath: str) -> None:
+    try:
+      with open(filepath, "rb") as f:
+        for chunk in compress_chunks(f):
+          if not self._put(chunk):
+            return
+    except Exception as e:
+      self._put(e)
+      return
+    self._put(None)
+
+  def readable(self) -> bool:
+    return True
+
+  def tell(self) -> int:
+    return self._pos
+
+  def readinto(self, b) -> int:
+    while not len(self._buf):
+      if self._done:
+        return 0
+      item = self._queue.get()
+      if isinstance(item, Exception):
+        raise item
+      elif item is None:
+        self._done = True
+        if self._pos != self.len:
+          raise OSError(f"compressed size changed during upload, expected {self.len} bytes and got {self._pos}")
+      else:
+        self._buf = memoryview(item)
+        if self._pos + len(item) > self.len:
+          raise OSError(f"compressed size changed during upload, expected {self.len} bytes")
+
+    n = min(len(b), len(self._buf))
+    b[:n] = self._buf[:n]
+    self._buf = self._buf[n:]
+    self._pos += n
+    return n
+
+  def close(self) -> None:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+    super().close()
+
+
+def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.RawIOBase | io.BufferedIOBase, int]:
   if not should_compress:
     file_size = os.path.getsize(filepath)
     file_stream = open(filepath, "rb")
     return file_stream, file_size
 
-  # Compress the file on the fly
-  compressed_stream = io.BytesIO()
-  compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
-
-  with open(filepath, "rb") as f:
-    compressor.copy_stream(f, compressed_stream)
-    compressed_size = compressed_stream.tell()
-    compressed_stream.seek(0)
-    return compressed_stream, compressed_size
+  # compressed on the fly, nothing is written to disk or held in memory beyond a few chunks
+  compressed_stream = CompressedUploadStream(filepath)
+  return compressed_stream, compressed_stream.len
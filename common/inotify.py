@@ -0,0 +1,94 @@
+import ctypes
+import os
+import select
+import struct
+from typing import NamedTuple
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+  wd: int
+  mask: int
+  cookie: int
+  name: str
+
+
+class Inotify:
+  """
+    Minimal wrapper around the Linux inotify API.
+    Raises OSError on platforms without inotify, callers are expected to fall back to polling.
+  """
+  def __init__(self):
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+      self._init1 = libc.inotify_init1
+      self._add_watch = libc.inotify_add_watch
+      self._rm_watch = libc.inotify_rm_watch
+    except AttributeError as e:
+      raise OSError("inotify is not supported on this platform") from e
+    self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+    self.fd = self._init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd = self._add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    self._rm_watch(self.fd, wd)
+
+  def read(self, timeout: float = 0) -> list[InotifyEvent]:
+    """Read all pending events, waiting up to timeout seconds for the first one."""
+    if timeout > 0 and not select.select([self.fd], [], [], timeout)[0]:
+      return []
+
+    events = []
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        break
+
+      pos = 0
+      while pos < len(buf):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+        pos += EVENT_HEADER.size
+        name = os.fsdecode(buf[pos:pos + length].rstrip(b"\0"))
+        pos += length
+        events.append(InotifyEvent(wd, mask, cookie, name))
+    return events
+
+  def fileno(self) -> int:
+    return self.fd
+
+  def close(self) -> None:
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
@@ -1,7 +1,9 @@
 import os
+import requests
+import zstandard as zstd
 from uuid import uuid4
 
-from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.common.file_helpers import atomic_write_in_dir, get_upload_stream, UPLOAD_READ_SIZE
 
 
 class TestFileHelpers:
@@ -17,3 +19,30 @@ class TestFileHelpers:
 
   def test_atomic_write_in_dir(self):
     self.run_atomic_write_func(atomic_write_in_dir)
+
+  def test_compressed_upload_stream(self, tmp_path):
+    path = tmp_path / "qlog"
+    dat = os.urandom(UPLOAD_READ_SIZE) + b"0" * (3 * UPLOAD_READ_SIZE + 123)
+    path.write_bytes(dat)
+
+    stream, size = get_upload_stream(str(path), True)
+    try:
+      # nothing is written next to the log
+      assert os.listdir(tmp_path) == ["qlog"]
+      assert requests.Request("PUT", "http://localhost", data=stream).prepare().headers["Content-Length"] == str(size)
+      compressed = b"".join(iter(lambda: stream.read(16384), b""))
+    finally:
+      stream.close()
+
+    assert len(compressed) == size
+    assert zstd.ZstdDecompressor().decompressobj().decompress(compressed) == dat
+
+  def test_compressed_upload_stream_close(self, tmp_path):
+    path = tmp_path / "qlog"
+    path.write_bytes(os.urandom(8 * UPLOAD_READ_SIZE))
+
+    # closing an upload part way through stops the compression thread
+    stream, _ = get_upload_stream(str(path), True)
+    assert len(stream.read(16384)) == 16384
+    stream.close()
+    assert not stream._thread.is_alive()
@@ -99,7 +99,7 @@ class TestLocationdScenarios:
 
   @classmethod
   def setup_class(cls):
-    cls.logs = migrate_all(LogReader(TEST_ROUTE))
+    cls.logs = list(migrate_all(LogReader(TEST_ROUTE)))
 
   def test_base(self):
     """
@@ -2,44 +2,201 @@
 import sys
 import math
 import capnp
-import numbers
-import dictdiffer
+import numpy as np
 from collections import Counter
+from typing import Any
 
 from openpilot.tools.lib.logreader import LogReader
 
 EPSILON = sys.float_info.epsilon
 
+# schema node id -> (has union, non union field names)
+_struct_fields: dict[int, tuple[bool, tuple[str, ...]]] = {}
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
 
-    for k in keys[:-1]:
-      # indexing into list
-      if k.isdigit():
-        attr = attr[int(k)]
-      else:
-        attr = getattr(attr, k)
-
-    v = getattr(attr, keys[-1])
-    if isinstance(v, bool):
-      val = False
-    elif isinstance(v, numbers.Number):
-      val = 0
-    elif isinstance(v, (list, capnp.lib.capnp._DynamicListBuilder)):
-      val = []
-    else:
-      raise NotImplementedError(f"Unknown type: {type(v)}")
-    setattr(attr, keys[-1], val)
-  return msg
+class DiffLimitReached(Exception):
+  pass
 
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+def build_ignore_tree(ignore_fields: list[str]) -> dict[str, Any]:
+  """Turns paths like "carState.vEgo" into nested dicts, ignored fields map to True"""
+  tree: dict[str, Any] = {}
+  for key in ignore_fields:
+    node = tree
+    *parents, leaf = key.split(".")
+    for k in parents:
+      child = node.setdefault(k, {})
+      if child is True:
+        break
+      node = child
+    else:
+      node[leaf] = True
+  return tree
+
+
+def to_python(v):
+  if isinstance(v, (capnp.lib.capnp._DynamicStructReader, capnp.lib.capnp._DynamicStructBuilder)):
+    return v.to_dict(verbose=True)
+  elif isinstance(v, (capnp.lib.capnp._DynamicListReader, capnp.lib.capnp._DynamicListBuilder)):
+    return [to_python(x) for x in v]
+  elif isinstance(v, capnp.lib.capnp._DynamicEnum):
+    return v._as_str()
+  return v
+
+
+def format_path(path: list[str | int]) -> str | list[str | int]:
+  # same notation as dictdiffer: dotted if there's no list index in the path
+  if all(isinstance(k, str) for k in path):
+    return ".".join(path)  # type: ignore[arg-type]
+  return list(path)
+
+
+def outside_tolerance(a, b, tolerance: float) -> bool:
+  if a == b:
+    return False
+
+  a_nan, b_nan = a != a, b != b
+  if a_nan or b_nan:
+    return not (a_nan and b_nan)
+
+  if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+    if not (math.isfinite(a) and math.isfinite(b)):
+      return True
+    diff, scale = abs(a - b), max(abs(a), abs(b))
+    return diff > EPSILON * scale and diff > max(tolerance, tolerance * scale)
+  return True
+
+
+def outside_tolerance_array(a: np.ndarray, b: np.ndarray, tolerance: float) -> np.ndarray:
+  with np.errstate(invalid="ignore", over="ignore"):
+    changed = (a != b) & ~(np.isnan(a) & np.isnan(b))
+    finite = np.isfinite(a) & np.isfinite(b)
+    diff, scale = np.abs(a - b), np.maximum(np.abs(a), np.abs(b))
+    return changed & (~finite | ((diff > EPSILON * scale) & (diff > np.maximum(tolerance, tolerance * scale))))
+
+
+class LogDiff:
+  """
+    Diffs capnp readers by walking their schema, without building dicts or copying messages.
+
+    The differences are reported in the format of dictdiffer.diff on to_dict(verbose=True) of the messages,
+    filtered by the absolute and relative tolerance. A service stops being compared after max_diffs differences.
+  """
+  def __init__(self, ignore: dict[str, Any], tolerance: float, max_diffs: int | None = None):
+    self.ignore = ignore
+    self.tolerance = tolerance
+    self.max_diffs = max_diffs
+    self.diff: list[tuple] = []
+    self.counts: Counter[str] = Counter()
+    self.service = ""
+
+  def report(self, d: tuple) -> None:
+    self.diff.append(d)
+    self.counts[self.service] += 1
+    if self.max_diffs is not None and self.counts[self.service] >= self.max_diffs:
+      raise DiffLimitReached
+
+  def compare_msgs(self, msg1: capnp._DynamicStructReader, msg2: capnp._DynamicStructReader) -> None:
+    which = msg1.which()
+    if which != msg2.which():
+      raise Exception("msgs not aligned between logs")
+    if self.max_diffs is not None and self.counts[which] >= self.max_diffs:
+      return
+
+    self.service = which
+    try:
+      self._compare_msgs(which, msg1, msg2)
+    except DiffLimitReached:
+      self.diff.append(("limit", which, f"stopped comparing after {self.max_diffs} differences"))
+
+  def _compare_msgs(self, which: str, msg1: capnp._DynamicStructReader, msg2: capnp._DynamicStructReader) -> None:
+    service_ignore = self.ignore.get(which)
+    if service_ignore is not True:
+      # most services don't change. pycapnp readers don't expose the bytes they're read from, so the fast path
+      # copies each service out to compare its bytes, which is still 10x+ faster than walking an unchanged one
+      # (see test_compare_logs.py test_fast_path). the whole event isn't compared this way, its logMonoTime almost always differs
+      service1, service2 = getattr(msg1, which), getattr(msg2, which)
+      if not isinstance(service1, capnp.lib.capnp._DynamicStructReader) or service1.as_builder().to_bytes() != service2.as_builder().to_bytes():
+        self.compare_value(service1, service2, [which], service_ignore)
+
+    for name in msg1.schema.non_union_fields:
+      sub_ignore = self.ignore.get(name)
+      if sub_ignore is not True:
+        self.compare_value(getattr(msg1, name), getattr(msg2, name), [name], sub_ignore)
+
+  def compare_value(self, v1, v2, path: list[str | int], ignore: dict[str, Any] | None) -> None:
+    if isinstance(v1, capnp.lib.capnp._DynamicStructReader):
+      self.compare_struct(v1, v2, path, ignore)
+    elif isinstance(v1, capnp.lib.capnp._DynamicListReader):
+      self.compare_list(v1, v2, path, ignore)
+    else:
+      a, b = to_python(v1), to_python(v2)
+      if outside_tolerance(a, b, self.tolerance):
+        self.report(("change", format_path(path), (a, b)))
+
+  def compare_struct(self, s1: capnp._DynamicStructReader, s2: capnp._DynamicStructReader, path: list[str | int], ignore: dict[str, Any] | None) -> None:
+    schema = s1.schema
+    node_id = schema.node.id
+    if node_id not in _struct_fields:
+      _struct_fields[node_id] = (len(schema.union_fields) > 0, tuple(schema.non_union_fields))
+    has_union, fields = _struct_fields[node_id]
+
+    added, removed = None, None
+    if has_union:
+      which1, which2 = s1.which(), s2.which()
+      if which1 == which2:
+        fields = (which1, *fields)
+      else:
+        added, removed = which2, which1
+
+    for name in fields:
+      sub_ignore = ignore.get(name) if ignore is not None else None
+      if sub_ignore is not True:
+        self.compare_value(getattr(s1, name), getattr(s2, name), [*path, name], sub_ignore)
+
+    if added is not None and (ignore is None or ignore.get(added) is not True):
+      self.report(("add", format_path(path), [(added, to_python(getattr(s2, added)))]))
+    if removed is not None and (ignore is None or ignore.get(removed) is not True):
+      self.report(("remove", format_path(path), [(removed, to_python(getattr(s1, removed)))]))
+
+  def compare_list(self, l1: capnp._DynamicListReader, l2: capnp._DynamicListReader, path: list[str | int], ignore: dict[str, Any] | None) -> None:
+    n = min(len(l1), len(l2))
+    if n > 0 and ignore is None:
+      first = l1[0]
+      if isinstance(first, float):
+        values1, values2 = list(l1), list(l2)
+        if values1 != values2:
+          outside = outside_tolerance_array(np.array(values1[:n], dtype=np.float64), np.array(values2[:n], dtype=np.float64), self.tolerance)
+          for i in np.flatnonzero(outside):
+            self.report(("change", format_path([*path, int(i)]), (values1[i], values2[i])))
+        l1, l2 = values1, values2
+      elif not isinstance(first, (capnp.lib.capnp._DynamicStructReader, capnp.lib.capnp._DynamicListReader)):
+        values1, values2 = to_python(l1), to_python(l2)
+        if values1[:n] != values2[:n]:
+          for i in range(n):
+            if outside_tolerance(values1[i], values2[i], self.tolerance):
+              self.report(("change", format_path([*path, i]), (values1[i], values2[i])))
+        l1, l2 = values1, values2
+      else:
+        for i in range(n):
+          self.compare_value(l1[i], l2[i], [*path, i], None)
+    else:
+      for i in range(n):
+        sub_ignore = ignore.get(str(i)) if ignore is not None else None
+        if sub_ignore is not True:
+          self.compare_value(l1[i], l2[i], [*path, i], sub_ignore)
+
+    if len(l2) > n:
+      self.report(("add", format_path(path), [(i, to_python(l2[i])) for i in range(n, len(l2))]))
+    if len(l1) > n:
+      self.report(("remove", format_path(path), [(i, to_python(l1[i])) for i in reversed(range(n, len(l1)))]))
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, max_diffs=None):
+  """
+  Diffs two aligned logs, ignore_fields are paths like "carState.vEgo" or "logMonoTime".
+  With max_diffs, each service stops being compared after that many differences.
+  """
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -56,37 +213,10 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
+  log_diff = LogDiff(build_ignore_tree(ignore_fields), tolerance, max_diffs)
   for msg1, msg2 in zip(log1, log2, strict=True):
-    if msg1.which() != msg2.which():
-      raise Exception("msgs not aligned between logs")
-
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
-
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
-
-      diff.extend(dd)
-  return diff
+    log_diff.compare_msgs(msg1, msg2)
+  return log_diff.diff
 
 
 def format_process_diff(diff):
@@ -97,14 +227,20 @@ def format_process_diff(diff):
     diff_long += f"\t{diff}\n"
   else:
     cnt: dict[str, int] = {}
+    limits = []
     for d in diff:
       diff_long += f"\t{str(d)}\n"
+      if d[0] == "limit":
+        limits.append(d)
+        continue
 
       k = str(d[1])
       cnt[k] = 1 if k not in cnt else cnt[k] + 1
 
     for k, v in sorted(cnt.items()):
       diff_short += f"        {k}: {v}\n"
+    for _, service, msg in limits:
+      diff_short += f"        {service}: {msg}\n"
 
   return diff_short, diff_long
 
@@ -0,0 +1,248 @@
+import importlib
+import queue
+import threading
+import time
+from collections import defaultdict
+from types import ModuleType
+from typing import Any
+
+import capnp
+
+import cereal.messaging as messaging
+
+
+class Patches:
+  """Replaces attributes of objects until restore()"""
+  def __init__(self):
+    self.saved: list[tuple[Any, str, Any]] = []
+
+  def set(self, obj: Any, name: str, value: Any) -> None:
+    self.saved.append((obj, name, getattr(obj, name)))
+    setattr(obj, name, value)
+
+  def restore(self) -> None:
+    while len(self.saved):
+      obj, name, value = self.saved.pop()
+      setattr(obj, name, value)
+
+
+class ReplayStopped(BaseException):
+  """Raised in the daemon thread to stop it, not an Exception so the daemon can't catch it by accident"""
+
+
+class ReplayReset(BaseException):
+  """Raised in the daemon thread to run its main() again"""
+
+
+class ReplaySubSocket:
+  def __init__(self, endpoint: str, conflate: bool):
+    self.endpoint = endpoint
+    self.conflate = conflate
+    self.msgs: list[capnp._DynamicStructReader] = []
+
+  def push(self, msg: capnp._DynamicStructReader):
+    if self.conflate:
+      self.msgs = [msg]
+    else:
+      self.msgs.append(msg)
+
+  def pop(self) -> capnp._DynamicStructReader | None:
+    return self.msgs.pop(0) if len(self.msgs) else None
+
+  def drain(self) -> list[capnp._DynamicStructReader]:
+    msgs, self.msgs = self.msgs, []
+    return msgs
+
+
+class ReplayPoller:
+  def registerSocket(self, sock):
+    pass
+
+
+class InProcessDaemon:
+  """
+    Runs a python daemon's main() in a thread of the replay process, in lock-step with the replay.
+
+    messaging is replaced in the daemon's module: its SubMaster and sockets receive the replayed messages
+    directly, and what it publishes is collected instead of being sent. Like the fake sockets of the socket
+    based replay, each socket of the locked pubs is read once per cycle: reading one again ends the cycle and
+    waits for the next messages, whether that's through SubMaster.update or a blocking recv_one.
+
+    reset() runs main() again in the same thread, so the daemon sets itself up from the current params
+    without importing its module or starting a thread again. State kept in module globals isn't reset.
+  """
+  def __init__(self, module: str, timeout: float, locked_pubs: list[str]):
+    self.module_name = module
+    self.timeout = timeout
+    self.locked_pubs = set(locked_pubs)
+    self.module: ModuleType | None = None
+    self.patches = Patches()
+
+    self.sockets: dict[str, list[ReplaySubSocket]] = defaultdict(list)
+    self.outputs: dict[str, list[capnp._DynamicStructReader]] = defaultdict(list)
+    # sockets read in this cycle, None until the first messages
+    self.read: set[ReplaySubSocket] | None = None
+
+    self.thread: threading.Thread | None = None
+    # messages for the next cycle, or the exception to raise in the daemon thread
+    self.inbox: queue.Queue[list[capnp._DynamicStructReader] | type[BaseException]] = queue.Queue()
+    self.waiting: queue.Queue[BaseException | None] = queue.Queue()
+
+  # *** messaging replacements, called from the daemon thread ***
+
+  def sub_sock(self, endpoint: str, poller=None, addr: str = "127.0.0.1", conflate: bool = False, timeout=None) -> ReplaySubSocket:
+    sock = ReplaySubSocket(endpoint, conflate)
+    self.sockets[endpoint].append(sock)
+    return sock
+
+  def wait_for_msgs(self) -> None:
+    self.waiting.put(None)
+    msgs = self.inbox.get()
+    if not isinstance(msgs, list):
+      raise msgs
+
+    for msg in msgs:
+      for sock in self.sockets.get(msg.which(), []):
+        sock.push(msg)
+    self.read = set()
+
+  def receive(self, socks: list[ReplaySubSocket]) -> None:
+    locked = [sock for sock in socks if sock.endpoint in self.locked_pubs]
+    if self.read is None or not self.read.isdisjoint(locked):
+      self.wait_for_msgs()
+    assert self.read is not None
+    self.read.update(locked)
+
+  def messaging(self) -> ModuleType:
+    daemon = self
+
+    class SubMaster(messaging.SubMaster):
+      def __init__(self, services, *args, **kwargs):
+        patches = Patches()
+        patches.set(messaging, "sub_sock", daemon.sub_sock)
+        patches.set(messaging, "Poller", ReplayPoller)
+        try:
+          super().__init__(services, *args, **kwargs)
+        finally:
+          patches.restore()
+
+      def update(self, timeout: int = 100) -> None:
+        daemon.receive(list(self.sock.values()))
+        self.update_msgs(time.monotonic(), [self.sock[s].pop() for s in self.services])
+
+    class PubMaster:
+      def __init__(self, services: list[str]):
+        self.services = services
+
+      def send(self, s: str, dat) -> None:
+        if not isinstance(dat, bytes):
+          dat = dat.to_bytes()
+        daemon.outputs[s].append(messaging.log_from_bytes(dat))
+
+      def all_readers_updated(self, s: str) -> bool:
+        return True
+
+      def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
+        return True
+
+    def drain_sock(sock: ReplaySubSocket, wait_for_one: bool = False) -> list[capnp._DynamicStructReader]:
+      daemon.receive([sock])
+      return sock.drain()
+
+    def recv_sock(sock: ReplaySubSocket, wait: bool = False) -> capnp._DynamicStructReader | None:
+      daemon.receive([sock])
+      msgs = sock.drain()
+      return msgs[-1] if len(msgs) else None
+
+    def recv_one_or_none(sock: ReplaySubSocket) -> capnp._DynamicStructReader | None:
+      daemon.receive([sock])
+      return sock.pop()
+
+    def recv_one_retry(sock: ReplaySubSocket) -> capnp._DynamicStructReader:
+      while (msg := recv_one_or_none(sock)) is None:
+        pass
+      return msg
+
+    # anything not replaced is shared with the real messaging module
+    replay_messaging = ModuleType(messaging.__name__)
+    replay_messaging.__dict__.update(messaging.__dict__)
+    replay_messaging.__dict__.update({
+      "SubMaster": SubMaster,
+      "PubMaster": PubMaster,
+      "sub_sock": self.sub_sock,
+      "drain_sock": drain_sock,
+      "recv_sock": recv_sock,
+      "recv_one_or_none": recv_one_or_none,
+      # a replayed recv with a timeout returns None when there's no message in the cycle, like recv_one_or_none
+      "recv_one": recv_one_or_none,
+      "recv_one_retry": recv_one_retry,
+    })
+    return replay_messaging
+
+  # *** replay side ***
+
+  def _run(self) -> None:
+    assert self.module is not None
+    while True:
+      try:
+        self.module.main()
+        self.waiting.put(RuntimeError(f"{self.module_name} exited"))
+      except ReplayReset:
+        # the sockets and outputs of the previous main() are dropped with it
+        self.sockets.clear()
+        self.outputs.clear()
+        self.read = None
+        continue
+      except ReplayStopped:
+        pass
+      except BaseException as e:
+        self.waiting.put(e)
+      return
+
+  def _wait(self) -> None:
+    try:
+      err = self.waiting.get(timeout=self.timeout)
+    except queue.Empty:
+      raise Exception(f"timed out testing process {repr(self.module_name)}") from None
+    if err is not None:
+      raise err
+
+  def start(self) -> None:
+    """Starts the daemon and waits until it's ready for its first messages"""
+    self.module = importlib.import_module(self.module_name)
+    self.patches.set(self.module, "messaging", self.messaging())
+    if hasattr(self.module, "config_realtime_process"):
+      # don't change the scheduling or disable the gc of the replay process
+      self.patches.set(self.module, "config_realtime_process", lambda *args, **kwargs: None)
+
+    self.thread = threading.Thread(target=self._run, name=self.module_name, daemon=True)
+    self.thread.start()
+    self._wait()
+
+  def step(self, msgs: list[capnp._DynamicStructReader]) -> None:
+    """Runs one cycle of the daemon with msgs"""
+    self.inbox.put(msgs)
+    self._wait()
+
+  def reset(self, locked_pubs: list[str]) -> None:
+    """Runs main() again and waits until it's ready for its first messages"""
+    assert self.is_alive
+    self.locked_pubs = set(locked_pubs)
+    self.inbox.put(ReplayReset)
+    self._wait()
+
+  def take_outputs(self, service: str, count: int | None = None) -> list[capnp._DynamicStructReader]:
+    msgs = self.outputs[service]
+    count = len(msgs) if count is None else count
+    self.outputs[service] = msgs[count:]
+    return msgs[:count]
+
+  def stop(self) -> None:
+    if self.thread is not None and self.thread.is_alive():
+      self.inbox.put(ReplayStopped)
+      self.thread.join(self.timeout)
+    self.patches.restore()
+
+  @property
+  def is_alive(self) -> bool:
+    return self.thread is not None and self.thread.is_alive()
@@ -22,10 +22,12 @@ from openpilot.common.prefix import OpenpilotPrefix
 from openpilot.common.timeout import Timeout
 from openpilot.common.realtime import DT_CTRL
 from openpilot.selfdrive.car.card import can_comm_callbacks
+from openpilot.system.manager.process import PythonProcess
 from openpilot.system.manager.process_config import managed_processes
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_camera_state, available_streams
 from openpilot.selfdrive.test.process_replay.migration import migrate_all
 from openpilot.selfdrive.test.process_replay.capture import ProcessOutputCapture
+from openpilot.selfdrive.test.process_replay.inprocess import InProcessDaemon
 from openpilot.tools.lib.logreader import LogIterable
 from openpilot.tools.lib.framereader import FrameReader
 
@@ -317,6 +319,106 @@ class ProcessContainer:
     return output_msgs
 
 
+class InProcessContainer(ProcessContainer):
+  """
+  Replays a python process in the replay process itself, see InProcessDaemon.
+  Messages are handed to the process in the same cycles as ProcessContainer, so the output is the same.
+  After finish(), the container can be reset() for another replay of the same process instead of stopped.
+  """
+  def __init__(self, cfg: ProcessConfig):
+    super().__init__(cfg)
+    self.daemon: InProcessDaemon | None = None
+
+  @staticmethod
+  def supported(cfg: ProcessConfig) -> bool:
+    return isinstance(managed_processes[cfg.proc_name], PythonProcess) and cfg.main_pub is None and len(cfg.vision_pubs) == 0
+
+  def start(
+    self, params_config: dict[str, Any], environ_config: dict[str, Any],
+    all_msgs: LogIterable, frs: dict[str, FrameReader] | None,
+    fingerprint: str | None, capture_output: bool
+  ):
+    assert self.supported(self.cfg) and not capture_output
+
+    with self.prefix:
+      self._configure(params_config, environ_config, all_msgs, fingerprint)
+      self.daemon = InProcessDaemon(self.process.module, self.cfg.timeout, self.locked_pubs)
+      self.daemon.start()
+
+  def reset(
+    self, cfg: ProcessConfig, params_config: dict[str, Any], environ_config: dict[str, Any],
+    all_msgs: LogIterable, fingerprint: str | None
+  ):
+    """Sets up the daemon of a finished replay for another one, keeping its imported module and thread"""
+    assert self.daemon is not None and self.daemon.is_alive
+    self.cfg = copy.deepcopy(cfg)
+    self.msg_queue = []
+    self.cnt = 0
+
+    with self.prefix:
+      self._configure(params_config, environ_config, all_msgs, fingerprint)
+      self.daemon.reset(self.locked_pubs)
+
+  @property
+  def locked_pubs(self) -> list[str]:
+    return [s for s in self.cfg.pubs if s not in self.cfg.unlocked_pubs]
+
+  def _configure(self, params_config: dict[str, Any], environ_config: dict[str, Any], all_msgs: LogIterable, fingerprint: str | None):
+    self._setup_env(params_config, environ_config)
+
+    if self.cfg.config_callback is not None:
+      params = Params()
+      self.cfg.config_callback(params, self.cfg, all_msgs)
+
+    if self.cfg.init_callback is not None:
+      self.cfg.init_callback(None, None, all_msgs, fingerprint)
+
+  def finish(self):
+    """Cleans up after a replay, the daemon is kept waiting for reset()"""
+    with self.prefix:
+      self.prefix.clean_dirs()
+      self._clean_env()
+
+  def stop(self):
+    if self.daemon is not None:
+      with self.prefix:
+        self.daemon.stop()
+    self.finish()
+
+  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, FrameReader] | None) -> list[capnp._DynamicStructReader]:
+    assert self.daemon is not None
+
+    output_msgs = []
+    with self.prefix:
+      end_of_cycle = True
+      if self.cfg.should_recv_callback is not None:
+        end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+      self.msg_queue.append(msg)
+      if end_of_cycle:
+        # the socket based replay drops one message of each output published before the first cycle
+        if self.cnt == 0:
+          for s in self.cfg.subs:
+            self.daemon.take_outputs(s, 1)
+
+        self.daemon.step(self.msg_queue)
+        self.msg_queue = []
+
+        for s in self.cfg.subs:
+          for m in self.daemon.take_outputs(s):
+            m = m.as_builder()
+            m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+            output_msgs.append(m.as_reader())
+        self.cnt += 1
+    assert self.daemon.is_alive
+
+    return output_msgs
+
+
+# in-process daemons kept by replay_process(reuse_daemons=True), by process name
+IDLE_CONTAINERS: dict[str, InProcessContainer] = {}
+
+
 def card_fingerprint_callback(rc, pm, msgs, fingerprint):
   print("start fingerprinting")
   params = Params()
@@ -655,18 +757,23 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False, in_process: bool = False,
+  migrated: bool = False, reuse_daemons: bool = False
 ) -> list[capnp._DynamicStructReader]:
+  """
+  Replays the processes of cfg over the messages in lr. With in_process, python processes that support it
+  are run in lock-step inside this process instead of over sockets, see InProcessContainer.
+  With reuse_daemons, those are kept after the replay and reset for the next one of the same process.
+  With migrated, lr was already migrated with get_migration_options(cfg).
+  """
   if isinstance(cfg, Iterable):
     cfgs = list(cfg)
   else:
     cfgs = [cfg]
 
-  all_msgs = migrate_all(lr,
-                         manager_states=True,
-                         panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
-                         camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  all_msgs = list(lr if migrated else migrate_all(lr, **get_migration_options(cfgs)))
+  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress, in_process,
+                                       reuse_daemons)
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -680,9 +787,18 @@ def replay_process(
   return log_msgs
 
 
+def get_migration_options(cfgs: list[ProcessConfig]) -> dict[str, bool]:
+  return {
+    "manager_states": True,
+    "panda_states": any("pandaStates" in cfg.pubs for cfg in cfgs),
+    "camera_states": any(len(cfg.vision_pubs) != 0 for cfg in cfgs),
+  }
+
+
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  in_process: bool = False, reuse_daemons: bool = False
 ) -> list[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
@@ -703,12 +819,23 @@ def _replay_multi_process(
 
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
   log_msgs = []
+  finished = False
   try:
-    containers = []
+    containers: list[ProcessContainer] = []
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      idle = IDLE_CONTAINERS.pop(cfg.proc_name, None)
+      if in_process and captured_output_store is None and InProcessContainer.supported(cfg):
+        container = idle if reuse_daemons and idle is not None else InProcessContainer(cfg)
+      else:
+        container = ProcessContainer(cfg)
+      if idle is not None and container is not idle:
+        idle.stop()
+
       containers.append(container)
-      container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
+      if container is idle:
+        idle.reset(cfg, params_config, env_config, all_msgs, fingerprint)
+      else:
+        container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
     all_pubs = {pub for container in containers for pub in container.pubs}
     all_subs = {sub for container in containers for sub in container.subs}
@@ -739,10 +866,15 @@ def _replay_multi_process(
             internal_pub_queue.append(m)
             heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
         log_msgs.extend(output_msgs)
+    finished = True
   finally:
     for container in containers:
-      container.stop()
-      if captured_output_store is not None:
+      if reuse_daemons and finished and isinstance(container, InProcessContainer):
+        container.finish()
+        IDLE_CONTAINERS[container.cfg.proc_name] = container
+      else:
+        container.stop()
+      if captured_output_store is not None and not isinstance(container, InProcessContainer):
         assert container.capture is not None
         out, err = container.capture.read_outerr()
         captured_output_store[container.cfg.proc_name] = {"out": out, "err": err}
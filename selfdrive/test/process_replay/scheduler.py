@@ -0,0 +1,102 @@
+import json
+import os
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import capnp
+
+from openpilot.selfdrive.test.process_replay.migration import get_migrations, migrate_all, migrations_hash
+from openpilot.selfdrive.test.process_replay.process_replay import FAKEDATA, ProcessConfig, get_migration_options, replay_process
+from openpilot.tools.lib.logreader import LogIterable, LogReader, save_log
+
+MIGRATED_LOG_CACHE = os.path.join(FAKEDATA, "migrated")
+TIMINGS_FN = os.path.join(FAKEDATA, "replay_timings.json")
+
+
+@dataclass
+class ReplayTiming:
+  proc_name: str
+  segment: str
+  wall_time: float  # seconds spent replaying
+  log_time: float  # seconds of log replayed
+
+  @property
+  def speed(self) -> float:
+    return self.log_time / self.wall_time if self.wall_time > 0 else 0.
+
+
+def migrated_log_path(segment: str, cfg: ProcessConfig) -> str:
+  key = migrations_hash(get_migrations(**get_migration_options([cfg])))
+  return os.path.join(MIGRATED_LOG_CACHE, f"{segment}_{key}")
+
+
+def cache_migrated_logs(segment: str, log_path: str, cfgs: list[ProcessConfig]) -> None:
+  """
+  Caches the log of segment migrated for each of cfgs, keyed by the segment and the set of migrations.
+  The log is only read if something is missing from the cache.
+  """
+  lr: list[capnp._DynamicStructReader] | None = None
+  for cfg in cfgs:
+    path = migrated_log_path(segment, cfg)
+    if os.path.exists(path):
+      continue
+
+    if lr is None:
+      lr = list(LogReader(log_path))
+    os.makedirs(MIGRATED_LOG_CACHE, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_log(tmp_path, migrate_all(lr, **get_migration_options([cfg])), compress=False)
+    os.replace(tmp_path, path)
+
+
+def replay_timed(cfg: ProcessConfig, segment: str, lr: LogIterable, **kwargs) -> tuple[list[capnp._DynamicStructReader], ReplayTiming]:
+  lr = list(lr)
+  log_time = (lr[-1].logMonoTime - lr[0].logMonoTime) / 1e9 if len(lr) else 0.
+
+  st = time.monotonic()
+  log_msgs = replay_process(cfg, lr, **kwargs)
+  return log_msgs, ReplayTiming(cfg.proc_name, segment, time.monotonic() - st, log_time)
+
+
+def load_timings() -> dict[tuple[str, str], float]:
+  try:
+    with open(TIMINGS_FN) as f:
+      return {(t["proc_name"], t["segment"]): t["wall_time"] for t in json.load(f)}
+  except (OSError, ValueError, KeyError):
+    return {}
+
+
+def save_timings(timings: list[ReplayTiming]) -> None:
+  os.makedirs(os.path.dirname(TIMINGS_FN), exist_ok=True)
+  with open(TIMINGS_FN, "w") as f:
+    json.dump([asdict(t) for t in timings], f)
+
+
+def schedule(jobs: list[Any], key=lambda job: job) -> list[Any]:
+  """
+  Orders jobs longest first by the wall times of the previous run, so the slowest replays don't end up
+  running alone at the end. key maps a job to its (proc_name, segment).
+  """
+  prev = load_timings()
+  default = max(prev.values(), default=0.)
+  return sorted(jobs, key=lambda job: prev.get(key(job), default), reverse=True)
+
+
+def format_timings(timings: list[ReplayTiming], total_wall_time: float | None = None) -> str:
+  by_proc: defaultdict[str, list[ReplayTiming]] = defaultdict(list)
+  for t in timings:
+    by_proc[t.proc_name].append(t)
+
+  lines = [f"{'process':<20} {'segments':>8} {'wall time':>10} {'log time':>10} {'realtime':>9}"]
+  for proc_name, ts in sorted(by_proc.items(), key=lambda kv: -sum(t.wall_time for t in kv[1])):
+    wall_time = sum(t.wall_time for t in ts)
+    log_time = sum(t.log_time for t in ts)
+    speed = log_time / wall_time if wall_time > 0 else 0.
+    lines.append(f"{proc_name:<20} {len(ts):>8} {wall_time:>9.1f}s {log_time:>9.1f}s {speed:>8.1f}x")
+
+  if total_wall_time is not None and total_wall_time > 0:
+    busy = sum(t.wall_time for t in timings)
+    lines.append(f"replayed {busy:.1f}s of process time in {total_wall_time:.1f}s ({busy / total_wall_time:.1f} cores busy)")
+  return "\n".join(lines)
@@ -0,0 +1,94 @@
+import math
+import random
+import time
+
+from cereal import log
+from openpilot.selfdrive.test.process_replay.compare_logs import EPSILON, LogDiff, compare_logs
+
+
+def car_state(v_ego=0., gear="drive", button_events=0, cum_lag_ms=0.):
+  msg = log.Event.new_message(logMonoTime=1, valid=True)
+  msg.init("carState")
+  msg.carState.vEgo = v_ego
+  msg.carState.gearShifter = gear
+  msg.carState.cumLagMs = cum_lag_ms
+  msg.carState.init("buttonEvents", button_events)
+  return msg.as_reader()
+
+
+def model(xs):
+  msg = log.Event.new_message(logMonoTime=1, valid=True)
+  msg.init("modelV2")
+  msg.modelV2.position.x = xs
+  return msg.as_reader()
+
+
+def full_model(seed):
+  # roughly the size of a real modelV2, read from bytes like a log
+  rnd = random.Random(seed)
+  msg = log.Event.new_message(logMonoTime=1, valid=True)
+  msg.init("modelV2")
+  for name in ("position", "velocity", "acceleration", "orientation", "orientationRate"):
+    for axis in ("t", "x", "y", "z", "xStd", "yStd", "zStd"):
+      setattr(getattr(msg.modelV2, name), axis, [rnd.random() for _ in range(33)])
+  for line in msg.modelV2.init("laneLines", 4):
+    line.x, line.y, line.z = ([rnd.random() for _ in range(33)] for _ in range(3))
+  with log.Event.from_bytes(msg.to_bytes()) as m:
+    return m
+
+
+class TestCompareLogs:
+  def test_identical(self):
+    assert compare_logs([car_state(1.), model([1., 2.])], [car_state(1.), model([1., 2.])]) == []
+
+  def test_changes(self):
+    diff = compare_logs([car_state(1., "drive", 1)], [car_state(2., "park", 0)])
+    assert sorted(diff, key=str) == sorted([
+      ("change", "carState.vEgo", (1., 2.)),
+      ("change", "carState.gearShifter", ("drive", "park")),
+      ("remove", "carState.buttonEvents", [(0, {"pressed": False, "type": "unknown"})]),
+    ], key=str)
+
+  def test_ignore(self):
+    diff = compare_logs([car_state(1., cum_lag_ms=1.)], [car_state(1., cum_lag_ms=2.)], ignore_fields=["carState.cumLagMs"])
+    assert diff == []
+
+  def test_tolerance(self):
+    assert compare_logs([model([1., 100.])], [model([1.05, 100.5])], tolerance=0.1) == []
+    assert compare_logs([model([1., 100.])], [model([1.25, 100.])], tolerance=0.1) == [("change", ["modelV2", "position", "x", 0], (1., 1.25))]
+
+    # nan only matches nan, inf is never within tolerance
+    assert compare_logs([model([math.nan])], [model([math.nan])]) == []
+    assert len(compare_logs([model([math.nan, math.inf])], [model([0., 1e30])], tolerance=1.)) == 2
+
+  def test_max_diffs(self):
+    log1 = [car_state(float(i)) for i in range(10)]
+    log2 = [car_state(float(i + 1)) for i in range(10)]
+    diff = compare_logs(log1, log2, max_diffs=3)
+    assert [d[0] for d in diff] == ["change", "change", "change", "limit"]
+
+  def test_event_fields(self):
+    # the service is the same, only the event around it changed
+    msg1, msg2 = car_state(1.).as_builder(), car_state(1.).as_builder()
+    msg2.logMonoTime, msg2.valid = 2, False
+    assert compare_logs([msg1.as_reader()], [msg2.as_reader()]) == [("change", "logMonoTime", (1, 2)), ("change", "valid", (True, False))]
+    assert compare_logs([msg1.as_reader()], [msg2.as_reader()], ignore_fields=["logMonoTime", "valid"]) == []
+
+  def test_fast_path(self):
+    # unchanged services are compared by copying out their bytes, not walked field by field
+    logs = [[f(i) for i in range(50) for f in (full_model, car_state)] for _ in range(2)]
+    assert compare_logs(*logs) == []
+
+    def timed(fn):
+      st = time.perf_counter()
+      fn()
+      return time.perf_counter() - st
+
+    def walk():
+      log_diff = LogDiff({}, EPSILON)
+      for m1, m2 in zip(*logs, strict=True):
+        log_diff.compare_value(getattr(m1, m1.which()), getattr(m2, m2.which()), [m1.which()], None)
+      assert log_diff.diff == []
+
+    fast = min(timed(lambda: compare_logs(*logs)) for _ in range(3))
+    assert fast * 5 < min(timed(walk) for _ in range(3))
@@ -0,0 +1,149 @@
+import sys
+from types import ModuleType
+
+import pytest
+
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+from openpilot.selfdrive.test.process_replay.inprocess import InProcessDaemon
+from openpilot.selfdrive.test.process_replay.process_replay import IDLE_CONTAINERS, InProcessContainer, get_process_config, replay_process
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+DAEMON = "replay_test_daemon"
+
+
+def new_message(service, t):
+  msg = messaging.new_message(service)
+  msg.logMonoTime = t
+  return msg.as_reader()
+
+
+def run_daemon(monkeypatch, loop, setup=None):
+  # loop runs one cycle with the messaging module the daemon sees, setup runs when main() starts
+  module = ModuleType(DAEMON)
+  module.messaging = messaging
+  def main():
+    if setup is not None:
+      setup()
+    m = module.messaging
+    socks = {s: m.sub_sock(s) for s in ("carState", "deviceState")}
+    pm = m.PubMaster(["carControl"])
+    while True:
+      loop(m, socks, pm)
+  module.main = main
+  monkeypatch.setitem(sys.modules, DAEMON, module)
+
+  daemon = InProcessDaemon(DAEMON, 5, ["carState", "deviceState"])
+  daemon.start()
+  return daemon
+
+
+def send(pm, car_state, device_state):
+  # what the daemon received this cycle, as times
+  msg = messaging.new_message("carControl")
+  msg.logMonoTime = car_state.logMonoTime if car_state is not None else 0
+  msg.valid = device_state is not None
+  pm.send("carControl", msg)
+
+
+class TestInProcessDaemon:
+  def test_recv_one(self, monkeypatch):
+    # like selfdrived, a blocking recv on carState ends each cycle
+    def loop(m, socks, pm):
+      car_state = m.recv_one(socks["carState"])
+      send(pm, car_state, m.recv_one_or_none(socks["deviceState"]))
+
+    daemon = run_daemon(monkeypatch, loop)
+    try:
+      cycles = [
+        ([new_message("carState", 1), new_message("deviceState", 2)], (1, True)),
+        ([new_message("deviceState", 3)], (0, True)),
+        ([new_message("carState", 4)], (4, False)),
+      ]
+      for msgs, expected in cycles:
+        daemon.step(msgs)
+        assert [(m.logMonoTime, m.valid) for m in daemon.take_outputs("carControl")] == [expected]
+    finally:
+      daemon.stop()
+    assert not daemon.is_alive
+
+  def test_recv_one_retry(self, monkeypatch):
+    def loop(m, socks, pm):
+      car_state = m.recv_one_retry(socks["carState"])
+      send(pm, car_state, m.recv_one_or_none(socks["deviceState"]))
+
+    daemon = run_daemon(monkeypatch, loop)
+    try:
+      # nothing is published until there's a carState
+      daemon.step([new_message("deviceState", 1)])
+      assert daemon.take_outputs("carControl") == []
+      daemon.step([new_message("carState", 2), new_message("deviceState", 3)])
+      assert [(m.logMonoTime, m.valid) for m in daemon.take_outputs("carControl")] == [(2, True)]
+    finally:
+      daemon.stop()
+    assert not daemon.is_alive
+
+  def test_reset(self, monkeypatch):
+    # like CarParams, the offset is read from the params once when main() starts
+    params = {"offset": 10}
+    offsets = []
+    def loop(m, socks, pm):
+      car_state = m.recv_one(socks["carState"])
+      msg = messaging.new_message("carControl")
+      msg.logMonoTime = car_state.logMonoTime + offsets[-1]
+      pm.send("carControl", msg)
+
+    daemon = run_daemon(monkeypatch, loop, setup=lambda: offsets.append(params["offset"]))
+    thread = daemon.thread
+    try:
+      daemon.step([new_message("carState", 1)])
+      # the second carState is left unread
+      daemon.step([new_message("carState", 2), new_message("carState", 3)])
+      assert [m.logMonoTime for m in daemon.take_outputs("carControl")] == [11, 12]
+
+      params["offset"] = 20
+      daemon.step([new_message("carState", 4)])
+      daemon.reset(["carState", "deviceState"])
+      assert offsets == [10, 20]
+      assert daemon.thread is thread and daemon.is_alive
+
+      # nothing from before the reset is received or published
+      assert daemon.take_outputs("carControl") == []
+      daemon.step([new_message("carState", 5)])
+      assert [m.logMonoTime for m in daemon.take_outputs("carControl")] == [25]
+    finally:
+      daemon.stop()
+    assert not daemon.is_alive
+
+
+@pytest.mark.slow
+class TestInProcessReplay:
+  @pytest.fixture(scope="class")
+  def lr(self):
+    # the first 10s of the TOYOTA segment of test_processes
+    msgs = list(LogReader(get_url("regen218A4DCFAA1|2025-04-08--22-57-51", "0", "rlog.zst")))
+    t0 = min(m.logMonoTime for m in msgs)
+    return [m for m in msgs if m.logMonoTime < t0 + 10e9]
+
+  @pytest.mark.parametrize("proc_name", ["selfdrived", "controlsd", "plannerd", "radard", "calibrationd", "dmonitoringd", "locationd",
+                                         "paramsd", "lagd", "torqued"])
+  def test_same_as_sockets(self, lr, proc_name):
+    cfg = get_process_config(proc_name)
+    assert InProcessContainer.supported(cfg)
+    socket_msgs = replay_process(cfg, lr, disable_progress=True)
+    in_process_msgs = replay_process(cfg, lr, disable_progress=True, in_process=True)
+    assert len(in_process_msgs) > 0
+    assert compare_logs(socket_msgs, in_process_msgs, cfg.ignore, tolerance=cfg.tolerance) == []
+
+  @pytest.mark.parametrize("proc_name", ["selfdrived", "controlsd", "plannerd"])
+  def test_reuse_daemons(self, lr, proc_name):
+    cfg = get_process_config(proc_name)
+    expected = replay_process(cfg, lr, disable_progress=True, in_process=True)
+    try:
+      for _ in range(2):
+        msgs = replay_process(cfg, lr, disable_progress=True, in_process=True, reuse_daemons=True)
+        assert compare_logs(expected, msgs, cfg.ignore, tolerance=cfg.tolerance) == []
+        assert IDLE_CONTAINERS[proc_name].daemon.is_alive
+    finally:
+      IDLE_CONTAINERS.pop(proc_name).stop()
@@ -0,0 +1,116 @@
+import sys
+
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay import migration as migration_module
+from openpilot.selfdrive.test.process_replay.migration import REORDER_WINDOW_NS, SCAN_LOOKAHEAD_NS, get_migrations, migrate, migrations_hash
+
+SECOND = int(1e9)
+
+
+def new_message(service, t, *args):
+  msg = messaging.new_message(service, *args)
+  msg.logMonoTime = t
+  return msg
+
+
+def old_log(duration=150):
+  # a log from before most migrations, that already has driverAssistance
+  t0 = 1000 * SECOND
+  init = new_message('initData', t0)
+  init.initData.deviceType = 'tici'
+  cp = new_message('carParams', t0 + SECOND)
+  cp.carParams.carFingerprint = "MOCK"
+  cp.carParams.init('safetyConfigs', 1)
+  cp.carParams.safetyConfigs[0].safetyParam = 3
+  msgs = [init, cp]
+
+  for n in range(duration * 10):
+    t = t0 + 2 * SECOND + n * SECOND // 10
+    ps = new_message('pandaStateDEPRECATED', t + 1)
+    ps.pandaStateDEPRECATED.ignitionLine = True
+    lp = new_message('longitudinalPlan', t + 4)
+    lp.longitudinalPlan.speeds = [1. + 0.1 * i for i in range(17)]
+    lp.longitudinalPlan.accels = [0.5] * 17
+    cs = new_message('roadCameraState', t + 5)
+    cs.roadCameraState.frameId = n
+    cs.roadCameraState.timestampEof = t
+    # encode indexes are logged after their frames
+    ei = new_message('roadEncodeIdx', t + 6)
+    ei.roadEncodeIdx.frameId = n
+    ei.roadEncodeIdx.segmentId = n % 1200
+    msgs += [new_message('deviceState', t), ps, new_message('carControl', t + 2), new_message('controlsState', t + 3), lp,
+             new_message('driverAssistance', t + 4), cs, ei]
+  return [m.as_reader() for m in msgs]
+
+
+def migrate_whole_log(msgs, migration_funcs):
+  # the previous implementation: scan the whole log, then migrate it
+  states = [{} for _ in migration_funcs]
+  for msg in msgs:
+    for migration, state in zip(migration_funcs, states, strict=True):
+      if migration.scan is not None and msg.which() in migration.inputs:
+        migration.scan(msg, state)
+
+  services = {msg.which() for msg in msgs}
+  out = []
+  for seq, msg in enumerate(msgs):
+    new_msg, deleted = msg, False
+    for i, (migration, state) in enumerate(zip(migration_funcs, states, strict=True)):
+      if migration.product in services or msg.which() not in migration.inputs:
+        continue
+      ret, add_msgs = migration(msg, state)
+      if ret is None:
+        deleted = True
+      elif ret is not msg:
+        new_msg = ret
+      out += [(m.logMonoTime, 1, i, seq, m) for m in add_msgs]
+    if not deleted:
+      out.append((new_msg.logMonoTime, 0, 0, seq, new_msg))
+  return [m for *_, m in sorted(out, key=lambda x: x[:4])]
+
+
+class TestMigration:
+  def test_same_as_whole_log(self):
+    msgs = old_log()
+    migrations = get_migrations(panda_states=True, camera_states=True)
+    expected = [m.as_builder().to_bytes() for m in migrate_whole_log(msgs, migrations)]
+
+    # streamed from a one-shot iterator, which is only read once
+    migrated = [m.as_builder().to_bytes() for m in migrate(iter(msgs), get_migrations(panda_states=True, camera_states=True))]
+    assert len(migrated) > len(msgs)
+    assert migrated == expected
+
+  def test_bounded(self):
+    msgs = old_log()
+    read = 0
+    def reader():
+      nonlocal read
+      for msg in msgs:
+        read += 1
+        yield msg
+
+    # the input is only read the lookahead and reorder windows past the output
+    for msg in migrate(reader(), get_migrations(panda_states=True, camera_states=True)):
+      assert msgs[read - 1].logMonoTime <= msg.logMonoTime + SCAN_LOOKAHEAD_NS + REORDER_WINDOW_NS + SECOND
+    assert read == len(msgs)
+
+  def test_hash(self, tmp_path, monkeypatch):
+    dep = tmp_path / "migration_dep.py"
+    dep.write_text("X = 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "migration_dep", raising=False)
+    monkeypatch.setattr(migration_module, "MIGRATION_DEPENDENCIES", ["migration_dep"])
+
+    migrations = get_migrations(panda_states=True, camera_states=True)
+    h = migrations_hash(migrations)
+    assert migrations_hash(get_migrations(panda_states=True, camera_states=True)) == h
+    assert migrations_hash(migrations[:-1]) != h
+
+    # a change to code the migrations call into
+    dep.write_text("X = 10\n")
+    assert migrations_hash(migrations) != h
+    dep.write_text("X = 1\n")
+    assert migrations_hash(migrations) == h
+
+    monkeypatch.setattr(migration_module, "MIGRATIONS_VERSION", migration_module.MIGRATIONS_VERSION + 1)
+    assert migrations_hash(migrations) != h
@@ -3,6 +3,7 @@ import argparse
 import concurrent.futures
 import os
 import sys
+import time
 from collections import defaultdict
 from tqdm import tqdm
 from typing import Any
@@ -11,9 +12,9 @@ from opendbc.car.car_helpers import interface_names
 from openpilot.common.git import get_commit
 from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
-from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
-                                                                   check_most_messages_valid
-from openpilot.tools.lib.filereader import FileReader
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, check_most_messages_valid
+from openpilot.selfdrive.test.process_replay.scheduler import cache_migrated_logs, format_timings, migrated_log_path, replay_timed, \
+                                                              save_timings, schedule
 from openpilot.tools.lib.logreader import LogReader, save_log
 
 source_segments = [
@@ -66,14 +67,16 @@ excluded_interfaces = ["mock", "body"]
 BASE_URL = "https://commadataci.blob.core.windows.net/openpilotci/"
 REF_COMMIT_FN = os.path.join(PROC_REPLAY_DIR, "ref_commit")
 EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
+MAX_DIFFS = 1000  # per service, the rest of a service isn't compared
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
-  res = None
+  segment, cfg, args, cur_log_fn, ref_log_path = data
+  res, timing = None, None
   if not args.upload_only:
-    lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    lr = LogReader(migrated_log_path(segment, cfg))
+    res, log_msgs, timing = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs, args.in_process,
+                                         migrated=True)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
 
@@ -82,16 +85,15 @@ def run_test_process(data):
     assert os.path.exists(cur_log_fn), f"Cannot find log to upload: {cur_log_fn}"
     upload_file(cur_log_fn, os.path.basename(cur_log_fn))
     os.remove(cur_log_fn)
-  return (segment, cfg.proc_name, res)
+  return (segment, cfg.proc_name, res, timing)
 
 
-def get_log_data(segment):
+def prepare_segment(segment, cfgs):
   r, n = segment.rsplit("--", 1)
-  with FileReader(get_url(r, n, "rlog.zst")) as f:
-    return (segment, f.read())
+  cache_migrated_logs(segment, get_url(r, n, "rlog.zst"), cfgs)
 
 
-def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None, in_process=False, migrated=False):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -100,24 +102,24 @@ def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=Non
   ref_log_msgs = list(LogReader(ref_log_path))
 
   try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
+    log_msgs, timing = replay_timed(cfg, segment, lr, disable_progress=True, in_process=in_process, migrated=migrated, reuse_daemons=in_process)
   except Exception as e:
     raise Exception("failed on segment: " + segment) from e
 
   if not check_most_messages_valid(log_msgs):
-    return f"Route did not have enough valid messages: {new_log_path}", log_msgs
+    return f"Route did not have enough valid messages: {new_log_path}", log_msgs, timing
 
   # skip this check if the segment is using qcom gps
   if cfg.proc_name != 'ubloxd' or any(m.which() in cfg.pubs for m in lr):
     seen_msgs = {m.which() for m in log_msgs}
     expected_msgs = set(cfg.subs)
     if seen_msgs != expected_msgs:
-      return f"Expected messages: {expected_msgs}, but got: {seen_msgs}", log_msgs
+      return f"Expected messages: {expected_msgs}, but got: {seen_msgs}", log_msgs, timing
 
   try:
-    return compare_logs(ref_log_msgs, log_msgs, ignore_fields + cfg.ignore, ignore_msgs, cfg.tolerance), log_msgs
+    return compare_logs(ref_log_msgs, log_msgs, ignore_fields + cfg.ignore, ignore_msgs, cfg.tolerance, MAX_DIFFS), log_msgs, timing
   except Exception as e:
-    return str(e), log_msgs
+    return str(e), log_msgs, timing
 
 
 if __name__ == "__main__":
@@ -143,6 +145,8 @@ if __name__ == "__main__":
                       help="Updates reference logs using current commit")
   parser.add_argument("--upload-only", action="store_true",
                       help="Skips testing processes and uploads logs from previous test run")
+  parser.add_argument("--in-process", action="store_true",
+                      help="Runs the python processes in lock-step inside the test process instead of over sockets")
   parser.add_argument("-j", "--jobs", type=int, default=max(cpu_count - 2, 1),
                       help="Max amount of parallel jobs")
   args = parser.parse_args()
@@ -177,14 +181,9 @@ if __name__ == "__main__":
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
+  # workers are reused across jobs, so daemon modules are only imported once per worker. with --in-process,
+  # a worker's daemons are also kept and reset for the next segment of the same process
   with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
-    if not args.upload_only:
-      download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
-
     pool_args: Any = []
     for car_brand, segment in segments:
       if car_brand not in tested_cars:
@@ -205,17 +204,32 @@ if __name__ == "__main__":
           ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
           ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
 
-        dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
+        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path))
 
         log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
         log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
 
+    if not args.upload_only:
+      # download and migrate each segment once, replays read the migrated logs from the cache
+      segment_cfgs: defaultdict[str, list] = defaultdict(list)
+      for segment, cfg, *_ in pool_args:
+        segment_cfgs[segment].append(cfg)
+      p1 = pool.map(prepare_segment, segment_cfgs.keys(), segment_cfgs.values())
+      list(tqdm(p1, desc="Getting Logs", total=len(segment_cfgs)))
+
     results: Any = defaultdict(dict)
-    p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
+    timings = []
+    st = time.monotonic()
+    p2 = pool.map(run_test_process, schedule(pool_args, key=lambda a: (a[1].proc_name, a[0])))
+    for (segment, proc, result, timing) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
       if not args.upload_only:
         results[segment][proc] = result
+        timings.append(timing)
+
+  if len(timings):
+    save_timings(timings)
+    print(format_timings(timings, time.monotonic() - st))
+    print()
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import base64
+import bisect
 import hashlib
 import io
 import json
@@ -22,6 +23,7 @@ from typing import cast
 from collections.abc import Callable
 
 import requests
+import zstandard as zstd
 from jsonrpc import JSONRPCResponseManager, dispatcher
 from websocket import (ABNF, WebSocket, WebSocketException, WebSocketTimeoutException,
                        create_connection)
@@ -30,7 +32,8 @@ import cereal.messaging as messaging
 from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import CallbackReader, get_upload_stream
+from openpilot.common.file_helpers import CallbackReader, get_upload_stream, LOG_COMPRESSION_LEVEL
+from openpilot.common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
@@ -54,6 +57,12 @@ MAX_AGE = 31 * 24 * 3600  # seconds
 WS_FRAME_SIZE = 4096
 DEVICE_STATE_UPDATE_INTERVAL = 1.0  # in seconds
 DEFAULT_UPLOAD_PRIORITY = 99  # higher number = lower priority
+JOURNAL_MIN_COMPACT = 100  # upload queue journal entries before it's compacted into the param
+LOG_BATCH_BYTES = 1024 * 1024  # swaglogs are packed into forwardLogs requests of up to this size
+LOG_MAX_IN_FLIGHT = 4  # forwardLogs requests waiting for a response
+LOG_RESPONSE_TIMEOUT = 100  # seconds
+LOG_RESEND_TIMEOUT = 3600  # seconds, assume send failed and we lost the response after this
+LOG_COMPRESSION = os.getenv("ATHENA_LOG_COMPRESSION") is not None
 
 NetworkType = log.DeviceState.NetworkType
 
@@ -128,25 +137,94 @@ class AbortTransferException(Exception):
 
 
 class UploadQueueCache:
+  """
+    Persists the upload queue across restarts.
+
+    Enqueued and finished items are appended to a journal, so a change costs one small write instead of
+    rewriting the whole queue. Once the journal outgrows the queue it is compacted into the AthenadUploadQueue
+    param, which holds the queue as of the last compaction.
+  """
+  lock = threading.Lock()
+  journal_len = 0
 
   @staticmethod
-  def initialize(upload_queue: Queue[UploadItem]) -> None:
+  def journal_path() -> str:
+    return os.path.join(Paths.athena_root(), "upload_queue.jsonl")
+
+  @classmethod
+  def initialize(cls, upload_queue: Queue[UploadItem]) -> None:
     try:
+      items: dict[str | None, UploadItem] = {}
       upload_queue_json = Params().get("AthenadUploadQueue")
       if upload_queue_json is not None:
         for item in json.loads(upload_queue_json):
-          upload_queue.put(UploadItem.from_dict(item))
+          items[item["id"]] = UploadItem.from_dict(item)
+
+      try:
+        with open(cls.journal_path()) as f:
+          for line in f:
+            try:
+              op, value = json.loads(line)
+            except ValueError:
+              # torn write at the end of the journal
+              continue
+            if op == "put":
+              items[value["id"]] = UploadItem.from_dict(value)
+            elif op == "remove":
+              items.pop(value, None)
+      except FileNotFoundError:
+        pass
+
+      for item in items.values():
+        upload_queue.put(item)
     except Exception:
       cloudlog.exception("athena.UploadQueueCache.initialize.exception")
 
-  @staticmethod
-  def cache(upload_queue: Queue[UploadItem]) -> None:
-    try:
-      queue: list[UploadItem | None] = list(upload_queue.queue)
-      items = [asdict(i) for i in queue if i is not None and (i.id not in cancelled_uploads)]
-      Params().put("AthenadUploadQueue", json.dumps(items))
-    except Exception:
-      cloudlog.exception("athena.UploadQueueCache.cache.exception")
+    cls.cache(upload_queue)
+
+  @classmethod
+  def cache(cls, upload_queue: Queue[UploadItem]) -> None:
+    """Write out the whole queue and start a new journal."""
+    with cls.lock:
+      try:
+        queue: list[UploadItem | None] = list(upload_queue.queue)
+        items = [asdict(i) for i in queue if i is not None and (i.id not in cancelled_uploads)]
+        Params().put("AthenadUploadQueue", json.dumps(items))
+        os.makedirs(Paths.athena_root(), exist_ok=True)
+        with open(cls.journal_path(), "w"):
+          pass
+        cls.journal_len = 0
+      except Exception:
+        cloudlog.exception("athena.UploadQueueCache.cache.exception")
+
+  @classmethod
+  def _append(cls, upload_queue: Queue[UploadItem], ops: list[tuple[str, UploadItemDict | str | None]]) -> None:
+    if not ops:
+      return
+
+    with cls.lock:
+      try:
+        os.makedirs(Paths.athena_root(), exist_ok=True)
+        with open(cls.journal_path(), "a") as f:
+          f.write("".join(json.dumps(op) + "\n" for op in ops))
+          f.flush()
+          os.fsync(f.fileno())
+        cls.journal_len += len(ops)
+        compact = cls.journal_len > max(JOURNAL_MIN_COMPACT, 2 * upload_queue.qsize())
+      except Exception:
+        cloudlog.exception("athena.UploadQueueCache.append.exception")
+        return
+
+    if compact:
+      cls.cache(upload_queue)
+
+  @classmethod
+  def put(cls, upload_queue: Queue[UploadItem], items: list[UploadItem]) -> None:
+    cls._append(upload_queue, [("put", asdict(i)) for i in items])
+
+  @classmethod
+  def remove(cls, upload_queue: Queue[UploadItem], ids: list[str | None]) -> None:
+    cls._append(upload_queue, [("remove", i) for i in ids])
 
 
 def handle_long_poll(ws: WebSocket, exit_event: threading.Event | None) -> None:
@@ -214,7 +292,7 @@ def retry_upload(tid: int, end_event: threading.Event, increase_count: bool = Tr
       current=False
     )
     upload_queue.put_nowait(item)
-    UploadQueueCache.cache(upload_queue)
+    UploadQueueCache.put(upload_queue, [item])
 
     cur_upload_items[tid] = None
 
@@ -222,6 +300,8 @@ def retry_upload(tid: int, end_event: threading.Event, increase_count: bool = Tr
       time.sleep(1)
       if end_event.is_set():
         break
+  elif item is not None:
+    UploadQueueCache.remove(upload_queue, [item.id])
 
 
 def cb(sm, item, tid, end_event: threading.Event, sz: int, cur: int) -> None:
@@ -257,6 +337,7 @@ def upload_handler(end_event: threading.Event) -> None:
       age = datetime.now() - datetime.fromtimestamp(item.created_at / 1000)
       if age.total_seconds() > MAX_AGE:
         cloudlog.event("athena.upload_handler.expired", item=item, error=True)
+        UploadQueueCache.remove(upload_queue, [item.id])
         continue
 
       # Check if uploading over metered connection is allowed
@@ -282,8 +363,7 @@ def upload_handler(end_event: threading.Event) -> None:
             retry_upload(tid, end_event)
           else:
             cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, network_type=network_type, metered=metered)
-
-        UploadQueueCache.cache(upload_queue)
+            UploadQueueCache.remove(upload_queue, [item.id])
       except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
         cloudlog.event("athena.upload_handler.timeout", fn=fn, sz=sz, network_type=network_type, metered=metered)
         retry_upload(tid, end_event)
@@ -295,6 +375,10 @@ def upload_handler(end_event: threading.Event) -> None:
       pass
     except Exception:
       cloudlog.exception("athena.upload_handler.exception")
+      # the item is dropped, so it shouldn't come back after a restart either
+      item = cur_upload_items[tid]
+      if item is not None:
+        UploadQueueCache.remove(upload_queue, [item.id])
 
 
 def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.Response:
@@ -388,8 +472,9 @@ def uploadFileToUrl(fn: str, url: str, headers: dict[str, str]) -> UploadFilesTo
 def uploadFilesToUrls(files_data: list[UploadFileDict]) -> UploadFilesToUrlResponse:
   files = map(UploadFile.from_dict, files_data)
 
-  items: list[UploadItemDict] = []
+  items: list[UploadItem] = []
   failed: list[str] = []
+  queued_urls = {item['url'].split('?')[0] for item in listUploadQueue()}
   for file in files:
     if len(file.fn) == 0 or file.fn[0] == '/' or '..' in file.fn or len(file.url) == 0:
       failed.append(file.fn)
@@ -402,7 +487,7 @@ def uploadFilesToUrls(files_data: list[UploadFileDict]) -> UploadFilesToUrlRespo
 
     # Skip item if already in queue
     url = file.url.split('?')[0]
-    if any(url == item['url'].split('?')[0] for item in listUploadQueue()):
+    if url in queued_urls:
       continue
 
     item = UploadItem(
@@ -417,11 +502,12 @@ def uploadFilesToUrls(files_data: list[UploadFileDict]) -> UploadFilesToUrlRespo
     upload_id = hashlib.sha1(str(item).encode()).hexdigest()
     item = replace(item, id=upload_id)
     upload_queue.put_nowait(item)
-    items.append(asdict(item))
+    queued_urls.add(url)
+    items.append(item)
 
-  UploadQueueCache.cache(upload_queue)
+  UploadQueueCache.put(upload_queue, items)
 
-  resp: UploadFilesToUrlResponse = {"enqueued": len(items), "items": items}
+  resp: UploadFilesToUrlResponse = {"enqueued": len(items), "items": [asdict(i) for i in items]}
   if failed:
     cloudlog.event("athena.uploadFilesToUrls.failed", failed=failed, error=True)
     resp["failed"] = failed
@@ -446,6 +532,7 @@ def cancelUpload(upload_id: str | list[str]) -> dict[str, int | str]:
     return {"success": 0, "error": "not found"}
 
   cancelled_uploads.update(cancelled_ids)
+  UploadQueueCache.remove(upload_queue, list(cancelled_ids))
   return {"success": 1}
 
 @dispatcher.add_method
@@ -562,83 +649,172 @@ def takeSnapshot() -> str | dict[str, str] | None:
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
-  curr_time = int(time.time())
-  logs = []
-  for log_entry in os.listdir(Paths.swaglog_root()):
-    log_path = os.path.join(Paths.swaglog_root(), log_entry)
-    time_sent = 0
+def get_log_time_sent(log_entry: str) -> int:
+  time_sent = 0
+  try:
+    value = getxattr(os.path.join(Paths.swaglog_root(), log_entry), LOG_ATTR_NAME)
+    if value is not None:
+      time_sent = int.from_bytes(value, sys.byteorder)
+  except (OSError, ValueError, TypeError):
+    pass
+  return time_sent
+
+
+class PendingLogs:
+  """
+    The swaglogs that still need to be forwarded, newest first.
+
+    The swaglog dir is scanned once, then new and rotated out logs are tracked with inotify.
+    Logs that were sent but never acknowledged are sent again after LOG_RESEND_TIMEOUT, and the
+    send and ack times are stored in an xattr so they survive restarts.
+  """
+  def __init__(self, root: str):
+    self.root = root
+    self._pending: list[str] = []
+    self._sent: dict[str, int] = {}  # log entry -> unix time it was sent
+    self._newest = ""
+    self._inotify: Inotify | None = None
     try:
-      value = getxattr(log_path, LOG_ATTR_NAME)
-      if value is not None:
-        time_sent = int.from_bytes(value, sys.byteorder)
-    except (ValueError, TypeError):
-      pass
-    # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+      self._inotify = Inotify()
+      self._inotify.add_watch(root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+    except OSError:
+      cloudlog.exception("athena.log_handler: inotify not available, falling back to scanning")
+      self._inotify = None
+    self._last_scan = 0.
+    self.scan()
+
+  def _add(self, log_entry: str) -> None:
+    self._newest = max(self._newest, log_entry)
+    time_sent = get_log_time_sent(log_entry)
+    if time_sent == int.from_bytes(LOG_ATTR_VALUE_MAX_UNIX_TIME, sys.byteorder):
+      return  # already forwarded
+    elif time_sent:
+      self._sent[log_entry] = time_sent
+    elif log_entry not in self._sent:
+      idx = bisect.bisect_left(self._pending, log_entry)
+      if idx == len(self._pending) or self._pending[idx] != log_entry:
+        self._pending.insert(idx, log_entry)
+
+  def _remove(self, log_entry: str) -> None:
+    self._sent.pop(log_entry, None)
+    idx = bisect.bisect_left(self._pending, log_entry)
+    if idx < len(self._pending) and self._pending[idx] == log_entry:
+      del self._pending[idx]
+
+  def scan(self) -> None:
+    self._pending, self._sent = [], {}
+    self._last_scan = time.monotonic()
+    try:
+      log_entries = os.listdir(self.root)
+    except OSError:
+      return
+    for log_entry in log_entries:
+      self._add(log_entry)
+
+  def update(self) -> None:
+    if self._inotify is None:
+      if time.monotonic() - self._last_scan > 10:
+        self.scan()
+    else:
+      for ev in self._inotify.read():
+        if ev.mask & IN_Q_OVERFLOW:
+          self.scan()
+          break
+        elif ev.mask & (IN_CREATE | IN_MOVED_TO):
+          self._add(ev.name)
+        elif ev.mask & (IN_DELETE | IN_MOVED_FROM):
+          self._remove(ev.name)
+
+    curr_time = int(time.time())
+    for log_entry in [e for e, t in self._sent.items() if curr_time - t > LOG_RESEND_TIMEOUT]:
+      del self._sent[log_entry]
+      bisect.insort(self._pending, log_entry)
+
+  def next_batch(self, max_bytes: int = LOG_BATCH_BYTES) -> tuple[list[str], str]:
+    """Take the newest pending logs, up to max_bytes of them, and mark them as sent."""
+    log_entries: list[str] = []
+    logs: list[str] = []
+    size = 0
+    curr_time = int(time.time())
+    while self._pending and size < max_bytes:
+      # excluding most recent (active) log file
+      if self._pending[-1] == self._newest:
+        if len(self._pending) == 1:
+          break
+        log_entry = self._pending.pop(-2)
+      else:
+        log_entry = self._pending.pop()
+
+      log_path = os.path.join(self.root, log_entry)
+      try:
+        setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
+        with open(log_path) as f:
+          logs.append(f.read())
+      except OSError:
+        continue  # file could be deleted by log rotation
+      self._sent[log_entry] = curr_time
+      log_entries.append(log_entry)
+      size += len(logs[-1])
+    return log_entries, "".join(logs)
+
+  def ack(self, log_entry: str) -> None:
+    self._remove(log_entry)
+    try:
+      setxattr(os.path.join(self.root, log_entry), LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+    except OSError:
+      pass  # file could be deleted by log rotation
+
+  def __len__(self):
+    return len(self._pending)
 
 
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
-  last_scan = 0.
+  pending_logs = PendingLogs(Paths.swaglog_root())
+  in_flight: dict[str, tuple[list[str], float]] = {}  # request id -> (log entries, time sent)
   while not end_event.is_set():
     try:
-      curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
+      pending_logs.update()
 
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
-          curr_time = int(time.time())
-          log_path = os.path.join(Paths.swaglog_root(), log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path) as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
+      # give up waiting on requests without a response, their logs are sent again after LOG_RESEND_TIMEOUT
+      curr_time = time.monotonic()
+      for log_id in [k for k, (_, t) in in_flight.items() if curr_time - t > LOG_RESPONSE_TIMEOUT]:
+        del in_flight[log_id]
 
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
+      # send batches of the newest logs
+      while len(in_flight) < LOG_MAX_IN_FLIGHT:
+        log_entries, logs = pending_logs.next_batch()
+        if not log_entries:
           break
-        try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(Paths.swaglog_root(), log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
-        except queue.Empty:
-          if curr_log is None:
-            break
+        # the newest log of a batch is its id, swaglogs are newline delimited so they can just be concatenated
+        log_id = log_entries[0]
+        cloudlog.debug(f"athena.log_handler.forward_request {log_id} {len(log_entries)}")
+        params: dict[str, str] = {"logs": logs}
+        if LOG_COMPRESSION:
+          params = {"logs": base64.b64encode(zstd.compress(logs.encode(), LOG_COMPRESSION_LEVEL)).decode(), "compression": "zstd"}
+        jsonrpc = {
+          "method": "forwardLogs",
+          "params": params,
+          "jsonrpc": "2.0",
+          "id": log_id
+        }
+        low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+        in_flight[log_id] = (log_entries, curr_time)
+
+      # always read queue at least once to process any old responses that arrive
+      try:
+        log_resp = json.loads(log_recv_queue.get(timeout=1))
+        log_id = log_resp.get("id")
+        log_success = "result" in log_resp and log_resp["result"].get("success")
+        cloudlog.debug(f"athena.log_handler.forward_response {log_id} {log_success}")
+        log_entries = in_flight.pop(log_id, ([log_id], 0.))[0] if log_id else []
+        if log_success:
+          for log_entry in log_entries:
+            pending_logs.ack(log_entry)
+      except queue.Empty:
+        pass
 
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
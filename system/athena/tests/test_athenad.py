@@ -275,6 +275,24 @@ class TestAthenadMethods:
     assert athenad.upload_queue.qsize() == 1
     assert athenad.upload_queue.get().retry_count == 1
 
+  @with_upload_handler
+  def test_upload_handler_exception(self, mocker):
+    """Items dropped because of an unexpected error are removed from the persisted queue too"""
+    mocker.patch('openpilot.system.athena.athenad._do_upload', side_effect=ValueError)
+    athenad.UploadQueueCache.cache(athenad.upload_queue)
+    fn = self._create_file('qlog.zst')
+    resp = dispatcher["uploadFilesToUrls"]([{"fn": "qlog.zst", "url": "http://localhost:44444/qlog.zst", "headers": {}}])
+    assert resp['enqueued'] == 1 and os.path.exists(fn)
+
+    self._wait_for_upload()
+    time.sleep(0.1)
+    assert athenad.upload_queue.qsize() == 0
+
+    # restored into another queue, the upload handler is still running
+    restored: queue.PriorityQueue = queue.PriorityQueue()
+    athenad.UploadQueueCache.initialize(restored)
+    assert restored.qsize() == 0
+
   @with_upload_handler
   def test_cancel_upload(self):
     item = athenad.UploadItem(path="qlog.zst", url="http://localhost:44444/qlog.zst", headers={},
@@ -375,6 +393,23 @@ class TestAthenadMethods:
     assert athenad.upload_queue.qsize() == 1
     assert asdict(athenad.upload_queue.queue[-1]) == asdict(item1)
 
+  def test_upload_queue_journal(self, host):
+    athenad.UploadQueueCache.cache(athenad.upload_queue)
+    for i in range(5):
+      self._create_file(f'qlog{i}.zst')
+    resp = dispatcher["uploadFilesToUrls"]([{"fn": f"qlog{i}.zst", "url": f"{host}/qlog{i}.zst", "headers": {}} for i in range(5)])
+    assert resp['enqueued'] == 5
+    dispatcher["cancelUpload"](resp['items'][0]['id'])
+
+    # changes are persisted without writing out the whole queue
+    assert json.loads(self.params.get("AthenadUploadQueue")) == []
+
+    athenad.upload_queue.queue.clear()
+    athenad.cancelled_uploads.clear()
+    athenad.UploadQueueCache.initialize(athenad.upload_queue)
+
+    assert sorted(item.id for item in athenad.upload_queue.queue) == sorted(item['id'] for item in resp['items'][1:])
+
   def test_start_local_proxy(self, mock_create_connection):
     end_event = threading.Event()
 
@@ -436,13 +471,40 @@ class TestAthenadMethods:
       end_event.set()
       thread.join()
 
-  def test_get_logs_to_send_sorted(self):
+  def test_pending_logs_sorted(self):
     fl = list()
     for i in range(10):
       file = f'swaglog.{i:010}'
       self._create_file(file, Paths.swaglog_root())
       fl.append(file)
 
-    # ensure the list is all logs except most recent
-    sl = athenad.get_logs_to_send_sorted()
-    assert sl == fl[:-1]
+    # ensure the pending logs are all logs except most recent, newest first
+    log_entries, _ = athenad.PendingLogs(Paths.swaglog_root()).next_batch()
+    assert log_entries == fl[:-1][::-1]
+
+  def test_pending_logs(self):
+    fl = list()
+    for i in range(10):
+      file = f'swaglog.{i:010}'
+      self._create_file(file, Paths.swaglog_root(), data=f'{{"msg": {i}}}\n'.encode())
+      fl.append(file)
+
+    pending_logs = athenad.PendingLogs(Paths.swaglog_root())
+
+    # newest logs first, packed into one batch, excluding the active log
+    log_entries, logs = pending_logs.next_batch(max_bytes=20)
+    assert log_entries == [fl[8], fl[7]]
+    assert logs == '{"msg": 8}\n{"msg": 7}\n'
+    for log_entry in log_entries:
+      pending_logs.ack(log_entry)
+    assert len(pending_logs) == 8
+
+    # new logs are picked up without a rescan
+    fl.append(self._create_file('swaglog.0000000010', Paths.swaglog_root(), data=b'{"msg": 10}\n'))
+    pending_logs.update()
+    log_entries, _ = pending_logs.next_batch(max_bytes=1)
+    assert log_entries == [fl[9]]
+
+    # acknowledged logs are not sent again after a restart
+    pending_logs = athenad.PendingLogs(Paths.swaglog_root())
+    assert len(pending_logs) == 8
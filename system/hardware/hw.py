@@ -51,6 +51,13 @@ class Paths:
     else:
       return "/data/stats/"
 
+  @staticmethod
+  def athena_root() -> str:
+    if PC:
+      return str(Path(Paths.comma_home()) / "athena")
+    else:
+      return "/data/athena/"
+
   @staticmethod
   def config_root() -> str:
     if PC:
@@ -7,12 +7,14 @@ import struct
 import subprocess
 import time
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 import openpilot.system.updated.casync.casync as casync
 
 SPARSE_CHUNK_FMT = struct.Struct('H2xI4x')
+RAW_HASH_CHUNK_SIZE = 4 * 1024 * 1024
 CAIBX_URL = "https://commadist.azureedge.net/agnosupdate/"
 
 AGNOS_MANIFEST_FILE = "system/hardware/tici/agnos.json"
@@ -115,13 +117,18 @@ def get_partition_path(target_slot_number: int, partition: dict) -> str:
 
 def get_raw_hash(path: str, partition_size: int) -> str:
   raw_hash = hashlib.sha256()
-  pos, chunk_size = 0, 1024 * 1024
 
-  with open(path, 'rb+') as out:
-    while pos < partition_size:
-      n = min(chunk_size, partition_size - pos)
-      raw_hash.update(out.read(n))
-      pos += n
+  # read the next block while hashing the current one
+  with open(path, 'rb+') as out, ThreadPoolExecutor(max_workers=1) as pool:
+    def read(pos: int) -> bytes:
+      return os.pread(out.fileno(), min(RAW_HASH_CHUNK_SIZE, partition_size - pos), pos)
+
+    next_block = pool.submit(read, 0)
+    for pos in range(0, partition_size, RAW_HASH_CHUNK_SIZE):
+      block = next_block.result()
+      if pos + RAW_HASH_CHUNK_SIZE < partition_size:
+        next_block = pool.submit(read, pos + RAW_HASH_CHUNK_SIZE)
+      raw_hash.update(block)
 
   return raw_hash.hexdigest().lower()
 
@@ -193,23 +200,31 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
 
   target = casync.parse_caibx(partition['casync_caibx'])
 
+  # Chunks already in the target partition are left alone, this allows for resuming
+  in_place = casync.find_chunks_in_place(path, target)
+  in_place_bytes = sum(c.length for c in in_place)
+  in_place_offsets = {c.offset for c in in_place}
+  missing = [c for c in target if c.offset not in in_place_offsets]
+  cloudlog.info(f"casync {partition['name']}: {len(missing)}/{len(target)} chunks, {sum(c.length for c in missing)} bytes changed")
+
   sources: list[tuple[str, casync.ChunkReader, casync.ChunkDict]] = []
 
   # First source is the current partition.
-  try:
-    raw_hash = get_raw_hash(seed_path, partition['size'])
-    caibx_url = f"{CAIBX_URL}{partition['name']}-{raw_hash}.caibx"
-
+  if missing:
     try:
-      cloudlog.info(f"casync fetching {caibx_url}")
-      sources += [('seed', casync.FileChunkReader(seed_path), casync.build_chunk_dict(casync.parse_caibx(caibx_url)))]
-    except requests.RequestException:
-      cloudlog.error(f"casync failed to load {caibx_url}")
-  except Exception:
-    cloudlog.exception("casync failed to hash seed partition")
+      raw_hash = get_raw_hash(seed_path, partition['size'])
+      caibx_url = f"{CAIBX_URL}{partition['name']}-{raw_hash}.caibx"
+
+      try:
+        cloudlog.info(f"casync fetching {caibx_url}")
+        sources += [('seed', casync.FileChunkReader(seed_path), casync.build_chunk_dict(casync.parse_caibx(caibx_url)))]
+      except requests.RequestException:
+        cloudlog.error(f"casync failed to load {caibx_url}")
+    except Exception:
+      cloudlog.exception("casync failed to hash seed partition")
 
-  # Second source is the target partition, this allows for resuming
-  sources += [('target', casync.FileChunkReader(path), casync.build_chunk_dict(target))]
+  # Second source is the target partition, for chunks that are already in it somewhere else
+  sources += [('target', casync.FileChunkReader(path), casync.build_chunk_dict(in_place))]
 
   # Finally we add the remote source to download any missing chunks
   sources += [('remote', casync.RemoteChunkReader(partition['casync_store']), casync.build_chunk_dict(target))]
@@ -218,12 +233,13 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
 
   def progress(cur):
     nonlocal last_p
-    p = int(cur / partition['size'] * 100)
+    p = int((in_place_bytes + cur) / partition['size'] * 100)
     if p != last_p:
       last_p = p
       print(f"Installing {partition['name']}: {p}", flush=True)
 
-  stats = casync.extract(target, sources, path, progress)
+  stats = casync.extract(missing, sources, path, progress)
+  stats['in_place'] = in_place_bytes
   cloudlog.error(f'casync done {json.dumps(stats)}')
 
   os.sync()
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
+import bisect
 import os
 import shutil
 import threading
+import psutil
+from openpilot.common.inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_ISDIR, \
+                                     IN_MOVE_SELF, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
-from openpilot.system.loggerd.uploader import listdir_by_creation
-from openpilot.system.loggerd.xattr_cache import getxattr
+from openpilot.system.loggerd.uploader import dirs_to_watch, get_directory_sort, listdir_by_creation
+from openpilot.system.loggerd.xattr_cache import getxattr, invalidate
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
@@ -45,26 +48,209 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
   return preserved
 
 
+def get_bytes_to_free() -> int:
+  # bytes to delete to get back above both MIN_BYTES and MIN_PERCENT
+  try:
+    statvfs = os.statvfs(Paths.log_root())
+  except OSError:
+    return 0
+  available = statvfs.f_bavail * statvfs.f_frsize
+  total = statvfs.f_blocks * statvfs.f_frsize
+  return max(MIN_BYTES - available, int(total * MIN_PERCENT / 100) - available, 0)
+
+
+class LogDirIndex:
+  """
+    The directories in the log root in creation order, with their lock state and size.
+
+    The log root is scanned once, then the index is kept up to date with inotify. Only the log root and
+    the directories that can still change are watched, like in the uploader's UploadQueue. Sizes are computed
+    when first needed, and again after the files in a directory change. Without inotify, the log
+    root is scanned again on every update, and so are the directories that couldn't be watched.
+  """
+  def __init__(self, root: str):
+    self.root = root
+    self._dirs: list[tuple[list[str], str]] = []
+    self._sizes: dict[str, int | None] = {}
+    self._locks: dict[str, set[str]] = {}
+
+    self._inotify: Inotify | None = None
+    self._root_wd = -1
+    self._dir_wds: dict[int, str] = {}
+    self._watched: dict[str, int] = {}
+    self._unwatched: set[str] = set()
+    try:
+      self._inotify = Inotify()
+    except OSError:
+      cloudlog.warning("deleter: inotify not available, falling back to scanning")
+    self.scan()
+
+  def _watch(self, d: str) -> None:
+    assert self._inotify is not None
+    try:
+      wd = self._inotify.add_watch(os.path.join(self.root, d), IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB)
+    except OSError:
+      if d not in self._unwatched:
+        cloudlog.exception(f"deleter: failed to watch {d}, rescanning it on every update")
+        self._unwatched.add(d)
+      return
+    self._dir_wds[wd] = d
+    self._watched[d] = wd
+    self._unwatched.discard(d)
+
+  def _unwatch(self, d: str) -> None:
+    wd = self._watched.pop(d, None)
+    if wd is not None:
+      assert self._inotify is not None
+      del self._dir_wds[wd]
+      self._inotify.rm_watch(wd)
+
+  def _unwatch_settled(self) -> None:
+    # segments that aren't among the newest anymore are done changing once they're unlocked
+    dirs = sorted(self._watched.keys() | self._unwatched, key=get_directory_sort)
+    keep = dirs_to_watch(dirs)
+    for d in dirs:
+      if d not in keep and not self._locks.get(d):
+        self._unwatch(d)
+        self._unwatched.discard(d)
+        # sized and read once more, after the last changes
+        if d in self._sizes:
+          self._sizes[d] = None
+        invalidate(os.path.join(self.root, d))
+
+  def _add(self, d: str, watch: bool = True) -> None:
+    path = os.path.join(self.root, d)
+    if self._inotify is not None and watch:
+      self._watch(d)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      self.remove(d)
+      return
+
+    locks = {name for name in names if name.endswith(".lock")}
+    if locks and self._inotify is not None and not watch:
+      # still being written to, so it's watched until it's unlocked
+      self._add(d)
+      return
+
+    if d not in self._sizes:
+      bisect.insort(self._dirs, (get_directory_sort(d), d))
+    self._sizes[d] = None
+    self._locks[d] = locks
+    invalidate(path)
+
+  def remove(self, d: str) -> None:
+    if d in self._sizes:
+      del self._sizes[d]
+      self._dirs.remove((get_directory_sort(d), d))
+    self._locks.pop(d, None)
+    self._unwatch(d)
+    self._unwatched.discard(d)
+
+  def scan(self) -> None:
+    self._dirs, self._sizes, self._locks = [], {}, {}
+    self._unwatched = set()
+    if self._inotify is not None:
+      for wd in [self._root_wd, *self._dir_wds]:
+        if wd >= 0:
+          self._inotify.rm_watch(wd)
+      self._dir_wds, self._watched = {}, {}
+      try:
+        self._root_wd = self._inotify.add_watch(self.root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+      except OSError:
+        self._root_wd = -1
+
+    dirs = listdir_by_creation(self.root)
+    watch = dirs_to_watch(dirs)
+    for d in dirs:
+      self._add(d, d in watch)
+
+  def update(self) -> None:
+    if self._inotify is None or self._root_wd < 0:
+      self.scan()
+      return
+
+    for ev in self._inotify.read():
+      if ev.mask & IN_Q_OVERFLOW or (ev.wd == self._root_wd and ev.mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED)):
+        # missed events, or the log root itself went away
+        self.scan()
+        return
+
+      if ev.wd == self._root_wd:
+        if ev.mask & IN_ISDIR and ev.mask & (IN_CREATE | IN_MOVED_TO):
+          self._add(ev.name)
+        elif ev.mask & IN_ISDIR and ev.mask & (IN_DELETE | IN_MOVED_FROM):
+          self.remove(ev.name)
+      elif ev.wd in self._dir_wds:
+        d = self._dir_wds[ev.wd]
+        if ev.mask & IN_IGNORED:
+          del self._dir_wds[ev.wd]
+          del self._watched[d]
+        elif d not in self._sizes:
+          continue
+        elif not ev.name:
+          # the preserve attribute of the directory itself changed
+          invalidate(os.path.join(self.root, d))
+        elif ev.name.endswith(".lock"):
+          if ev.mask & (IN_CREATE | IN_MOVED_TO):
+            self._locks[d].add(ev.name)
+          elif ev.mask & (IN_DELETE | IN_MOVED_FROM):
+            self._locks[d].discard(ev.name)
+        else:
+          self._sizes[d] = None
+
+    for d in sorted(self._unwatched):
+      self._add(d)
+    self._unwatch_settled()
+
+  def dirs_by_creation(self) -> list[str]:
+    return [d for _, d in self._dirs]
+
+  def is_locked(self, d: str) -> bool:
+    return bool(self._locks.get(d))
+
+  def size(self, d: str) -> int:
+    if self._sizes.get(d) is None:
+      size = 0
+      try:
+        with os.scandir(os.path.join(self.root, d)) as it:
+          for entry in it:
+            try:
+              size += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+              pass
+      except OSError:
+        pass
+      self._sizes[d] = size
+    return self._sizes[d] or 0
+
+
 def deleter_thread(exit_event: threading.Event):
+  index = LogDirIndex(Paths.log_root())
   while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+    bytes_to_free = get_bytes_to_free()
 
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
+    if bytes_to_free > 0:
+      index.update()
+      dirs = index.dirs_by_creation()
       preserved_dirs = get_preserved_segments(dirs)
 
-      # remove the earliest directory we can
+      # remove the earliest directories we can, until enough space is freed
+      freed = 0
       for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
-
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
+        if freed >= bytes_to_free or exit_event.is_set():
+          break
+        if index.is_locked(delete_dir):
           continue
 
+        delete_path = os.path.join(Paths.log_root(), delete_dir)
+        size = index.size(delete_dir)
         try:
           cloudlog.info(f"deleting {delete_path}")
           shutil.rmtree(delete_path)
-          break
+          index.remove(delete_dir)
+          freed += size
         except OSError:
           cloudlog.exception(f"issue deleting {delete_path}")
       exit_event.wait(.1)
@@ -73,6 +259,9 @@ def deleter_thread(exit_event: threading.Event):
 
 
 def main():
+  # stay out of the way of loggerd's writes
+  if psutil.LINUX:
+    psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
   deleter_thread(threading.Event())
 
 
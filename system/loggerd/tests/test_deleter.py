@@ -1,3 +1,6 @@
+import errno
+import os
+import shutil
 import time
 import threading
 from collections import namedtuple
@@ -5,8 +8,11 @@ from pathlib import Path
 from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
+from openpilot.common.inotify import Inotify
+from openpilot.system.hardware.hw import Paths
 from openpilot.common.timeout import Timeout, TimeoutException
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from openpilot.system.loggerd.uploader import WATCHED_SEGMENTS
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
 
@@ -90,6 +96,28 @@ class TestDeleter(UploaderTestCase):
       self.make_file_with_data("crash", self.seg_format2[:-4]),
     ])
 
+  def test_delete_only_needed(self):
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), self.f_type, 1) for i in range(3)]
+
+    # free space goes up as files are deleted, deleting the first two is enough
+    block_size = 4096
+    def fake_statvfs(d):
+      used = sum(f.stat().st_size for f in f_paths if f.exists())
+      available = deleter.MIN_BYTES + int(1.5 * 1024 * 1024) - used
+      return Stats(f_bavail=available // block_size, f_blocks=10 * available // block_size, f_frsize=block_size)
+    deleter.os.statvfs = fake_statvfs
+
+    self.start_thread()
+    try:
+      with Timeout(2, "Timeout waiting for files to be deleted"):
+        while f_paths[1].exists():
+          time.sleep(0.01)
+      time.sleep(0.5)
+    finally:
+      self.join_thread()
+
+    assert [f.exists() for f in f_paths] == [False, False, True]
+
   def test_no_delete_when_available_space(self):
     f_path = self.make_file_with_data(self.seg_dir, self.f_type)
 
@@ -115,3 +143,53 @@ class TestDeleter(UploaderTestCase):
     self.join_thread()
 
     assert f_path.exists(), "File deleted when locked"
+
+  def test_unwatched_dir(self, mocker):
+    # e.g. once the inotify watch limit is hit, only the log root can be watched
+    add_watch = Inotify.add_watch
+    def watch_root_only(inotify, path, mask):
+      if path != Paths.log_root():
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+      return add_watch(inotify, path, mask)
+    mocker.patch.object(Inotify, "add_watch", watch_root_only)
+
+    f_path = self.make_file_with_data(self.seg_dir, self.f_type, 1, lock=True)
+    index = deleter.LogDirIndex(Paths.log_root())
+    assert index.dirs_by_creation() == [self.seg_dir]
+    assert index.is_locked(self.seg_dir)
+    assert index.size(self.seg_dir) == f_path.stat().st_size
+
+    # changes to the directory are picked up by rescanning it
+    f_path.with_suffix(f_path.suffix + ".lock").unlink()
+    with open(f_path, "ab") as f:
+      f.write(b"\0" * 1024)
+    index.update()
+    assert not index.is_locked(self.seg_dir)
+    assert index.size(self.seg_dir) == f_path.stat().st_size
+
+  def test_watched_dirs(self):
+    # only boot/, the newest segments, and older segments that are still locked are watched
+    seg_dirs = [self.seg_format.format(i) for i in range(10)]
+    for d in seg_dirs:
+      self.make_file_with_data(d, self.f_type, .01)
+    f_path = self.make_file_with_data(seg_dirs[2], "rlog", .01, lock=True)
+    self.make_file_with_data("boot", self.seg_dir, .01)
+    index = deleter.LogDirIndex(Paths.log_root())
+    assert set(index._watched) == {"boot", seg_dirs[2], *seg_dirs[-WATCHED_SEGMENTS:]}
+
+    # a new segment takes the place of the oldest watched one, and unlocked segments aren't watched anymore
+    new_dir = self.seg_format.format(10)
+    self.make_file_with_data(new_dir, self.f_type, .01)
+    f_path.with_suffix(f_path.suffix + ".lock").unlink()
+    with open(f_path, "ab") as f:
+      f.write(b"\0" * 1024)
+    index.update()
+    assert set(index._watched) == {"boot", *seg_dirs[-WATCHED_SEGMENTS + 1:], new_dir}
+    assert not index.is_locked(seg_dirs[2])
+    assert index.size(seg_dirs[2]) == sum(f.stat().st_size for f in f_path.parent.iterdir())
+
+    # segments that aren't watched are still dropped when they're deleted
+    shutil.rmtree(Path(Paths.log_root()) / seg_dirs[0])
+    index.update()
+    assert seg_dirs[0] not in index.dirs_by_creation()
+    assert len(index.dirs_by_creation()) == 11
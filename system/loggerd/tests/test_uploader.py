@@ -1,13 +1,16 @@
+import errno
 import os
 import time
 import threading
 import logging
 import json
+import shutil
 from pathlib import Path
 from openpilot.system.hardware.hw import Paths
 
+from openpilot.common.inotify import Inotify
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.system.loggerd.uploader import main, NetworkType, Uploader, UploadQueue, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE, WATCHED_SEGMENTS
 
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
@@ -18,12 +21,15 @@ class FakeLogHandler(logging.Handler):
     self.reset()
 
   def reset(self):
+    self.start_order = list()
     self.upload_order = list()
     self.upload_ignored = list()
 
   def emit(self, record):
     try:
       j = json.loads(record.getMessage())
+      if j["event"] == "upload_start":
+        self.start_order.append(j["key"])
       if j["event"] == "upload_success":
         self.upload_order.append(j["key"])
       if j["event"] == "upload_ignored":
@@ -84,7 +90,8 @@ class TestUploader(UploaderTestCase):
     for f_path in exp_order:
       assert os.getxattr((Path(Paths.log_root()) / f_path).with_suffix(""), UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE, "All files not uploaded"
 
-    assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Wrong files uploaded"
+    assert log_handler.start_order == exp_order, "Files uploaded in wrong order"
 
   def test_upload_with_wrong_xattr(self):
     self.gen_files(lock=False, xattr=b'0')
@@ -102,7 +109,8 @@ class TestUploader(UploaderTestCase):
     for f_path in exp_order:
       assert os.getxattr((Path(Paths.log_root()) / f_path).with_suffix(""), UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE, "All files not uploaded"
 
-    assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Wrong files uploaded"
+    assert log_handler.start_order == exp_order, "Files uploaded in wrong order"
 
   def test_upload_ignored(self):
     self.set_ignore()
@@ -121,7 +129,8 @@ class TestUploader(UploaderTestCase):
     for f_path in exp_order:
       assert os.getxattr((Path(Paths.log_root()) / f_path).with_suffix(""), UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE, "All files not ignored"
 
-    assert log_handler.upload_ignored == exp_order, "Files ignored in wrong order"
+    assert sorted(log_handler.upload_ignored) == sorted(exp_order), "Wrong files ignored"
+    assert log_handler.start_order == exp_order, "Files ignored in wrong order"
 
   def test_upload_files_in_create_order(self):
     seg1_nums = [0, 1, 2, 10, 20]
@@ -146,7 +155,8 @@ class TestUploader(UploaderTestCase):
     for f_path in exp_order:
       assert os.getxattr((Path(Paths.log_root()) / f_path).with_suffix(""), UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE, "All files not uploaded"
 
-    assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Wrong files uploaded"
+    assert log_handler.start_order == exp_order, "Files uploaded in wrong order"
 
   def test_no_upload_with_lock_file(self):
     self.start_thread()
@@ -163,6 +173,21 @@ class TestUploader(UploaderTestCase):
       uploaded = UPLOAD_ATTR_NAME in os.listxattr(fn) and os.getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
       assert not uploaded, "File upload when locked"
 
+  def test_upload_after_unlock(self):
+    self.start_thread()
+
+    time.sleep(0.25)
+    f_paths = self.gen_files(lock=True, boot=False)
+    time.sleep(0.25)
+    for f_path in f_paths:
+      f_path.with_suffix(f_path.suffix + ".lock").unlink()
+
+    # files are picked up once their segment is unlocked
+    time.sleep(1)
+    self.join_thread()
+
+    assert log_handler.upload_order == self.gen_order([self.seg_num], [], boot=False), "Files not uploaded after unlock"
+
   def test_no_upload_with_xattr(self):
     self.gen_files(lock=False, xattr=UPLOAD_ATTR_VALUE)
 
@@ -182,3 +207,73 @@ class TestUploader(UploaderTestCase):
     for f_path in f_paths:
       lock_path = f_path.with_suffix(f_path.suffix + ".lock")
       assert not lock_path.is_file(), "File lock not cleared on startup"
+
+  def test_unwatched_dir(self, mocker):
+    # e.g. once the inotify watch limit is hit, only the log root can be watched
+    add_watch = Inotify.add_watch
+    def watch_root_only(inotify, path, mask):
+      if path != Paths.log_root():
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+      return add_watch(inotify, path, mask)
+    mocker.patch.object(Inotify, "add_watch", watch_root_only)
+
+    self.gen_files(boot=False)
+    queue = UploadQueue(Paths.log_root(), ["crash/", "boot/"], {"qlog": 0, "qcamera.ts": 1})
+    assert queue.next(False, []) == (self.seg_dir, "qlog")
+
+    # changes to the directory are picked up by rescanning it
+    self.make_file_with_data(self.seg_dir, "qcamera.ts", 1)
+    os.unlink(Path(Paths.log_root()) / self.seg_dir / "qlog")
+    assert queue.next(False, []) == (self.seg_dir, "qcamera.ts")
+    assert len(queue) == 1
+
+  def test_watched_dirs(self):
+    # only boot/, the newest segments, and older segments that are still locked are watched
+    seg_dirs = [self.seg_format.format(i) for i in range(10)]
+    for d in seg_dirs:
+      self.make_file_with_data(d, "qlog", .01)
+    self.make_file_with_data(seg_dirs[2], "rlog", .01, lock=True)
+    self.make_file_with_data("boot", self.seg_dir, .01)
+    queue = UploadQueue(Paths.log_root(), ["crash/", "boot/"], {"qlog": 0, "qcamera.ts": 1})
+    assert set(queue._watched) == {"boot", seg_dirs[2], *seg_dirs[-WATCHED_SEGMENTS:]}
+    assert len(queue) == 11
+
+    # a new segment takes the place of the oldest watched one, and unlocked segments aren't watched anymore
+    new_dir = self.seg_format.format(10)
+    self.make_file_with_data(new_dir, "qlog", .01)
+    os.unlink(Path(Paths.log_root()) / seg_dirs[2] / "rlog.lock")
+    queue.update()
+    assert set(queue._watched) == {"boot", *seg_dirs[-WATCHED_SEGMENTS + 1:], new_dir}
+    assert len(queue) == 12
+
+    # segments that aren't watched are still dropped when they're deleted
+    shutil.rmtree(Path(Paths.log_root()) / seg_dirs[0])
+    queue.update()
+    assert len(queue) == 11
+
+  def test_out_of_order_completion(self, mocker):
+    self.gen_files()
+    up = Uploader("0000000000000000", Paths.log_root())
+    up.concurrency = 2
+
+    # the bootlog upload is slow, so the qlog started after it finishes first
+    boot_sent = threading.Event()
+    do_upload = up.do_upload
+    def slow_boot_upload(key, fn):
+      if key.startswith("boot/"):
+        assert boot_sent.wait(5)
+      return do_upload(key, fn)
+    mocker.patch.object(up, "do_upload", side_effect=slow_boot_upload)
+
+    assert up.step(NetworkType.wifi, False)
+    assert log_handler.upload_order == [f"{self.seg_dir}/qlog.zst"]
+
+    # a rescan doesn't queue the bootlog again while it's in flight
+    up.queue.scan()
+    assert up.next_file_to_upload(False) is None
+
+    boot_sent.set()
+    assert up.step(NetworkType.wifi, False)
+    assert up.step(NetworkType.wifi, False) is None
+    up.close()
+    assert log_handler.upload_order == [f"{self.seg_dir}/qlog.zst", f"boot/{self.seg_dir}.zst"]
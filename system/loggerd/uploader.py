@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import bisect
 import json
 import os
 import random
@@ -7,16 +8,20 @@ import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
 from openpilot.common.file_helpers import get_upload_stream
+from openpilot.common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_ISDIR, IN_MOVE_SELF, \
+                                     IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
+from openpilot.system.statsd import statlog
 from openpilot.common.swaglog import cloudlog
 
 NetworkType = log.DeviceState.NetworkType
@@ -29,6 +34,14 @@ MAX_UPLOAD_SIZES = {
   "qcam": 5*1e6,
 }
 
+# the newest segments are still being written to, older ones only change by being deleted
+WATCHED_SEGMENTS = 3
+
+# uploads in flight at once on unmetered connections, small files are mostly bound by request latency
+MAX_CONCURRENT_UPLOADS = 4
+# adding an upload needs to improve the total throughput by this much to keep it
+CONCURRENCY_GAIN = 1.1
+
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
@@ -50,6 +63,15 @@ def get_directory_sort(d: str) -> list[str]:
   o = ["0", ] if d.startswith("2024-") else ["1", ]
   return o + [s.rjust(10, '0') for s in d.rsplit('--', 1)]
 
+def is_segment_dir(d: str) -> bool:
+  route, _, seg = d.rpartition("--")
+  return bool(route) and seg.isdigit()
+
+def dirs_to_watch(dirs: list[str]) -> set[str]:
+  # the newest segments, and the directories that aren't segments (e.g. crash/ and boot/), which keep getting new files
+  segments = [d for d in dirs if is_segment_dir(d)]
+  return set(segments[-WATCHED_SEGMENTS:]) | {d for d in dirs if not is_segment_dir(d)}
+
 def listdir_by_creation(d: str) -> list[str]:
   if not os.path.isdir(d):
     return []
@@ -73,71 +95,291 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
-class Uploader:
-  def __init__(self, dongle_id: str, root: str):
-    self.dongle_id = dongle_id
-    self.api = Api(dongle_id)
-    self.root = root
+UploadKey = tuple[int, list[str], int, str, str]  # (tier, directory sort, name priority, name, logdir)
 
-    self.params = Params()
 
-    # stats for last successfully uploaded file
-    self.last_filename = ""
+@dataclass
+class PendingUpload:
+  name: str
+  key: str
+  fn: str
+  sz: int
+  network_type: int
+  metered: bool
+  concurrency: int
+  future: Future | None  # None if there's nothing to send
 
-    self.immediate_folders = ["crash/", "boot/"]
-    self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
 
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
-    requested_routes = [] if r is None else [route for route in r.split(",") if route]
+class UploadQueue:
+  """
+    Index of the files under the log root that are waiting to be uploaded, in upload order.
+
+    The log root is scanned once, then the index is kept up to date with inotify, so picking the next
+    file doesn't touch the filesystem. Only the log root and the directories that can still change are
+    watched (see dirs_to_watch, and segments that are still locked), so the number of watches doesn't
+    grow with the number of segments. Without inotify, the log root is scanned again on every update,
+    and so are the directories that couldn't be watched (e.g. once the inotify watch limit is hit).
 
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
+    Files taken for upload stay out of the index, even across rescans, until they're released.
+  """
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+
+    # qcameras are only uploaded on unmetered connections, or for requested routes
+    self._queue: list[UploadKey] = []
+    self._qcameras: list[UploadKey] = []
+    self._keys: dict[tuple[str, str], UploadKey] = {}
+    self._locks: dict[str, set[str]] = {}
+    self._in_flight: set[tuple[str, str]] = set()
+
+    self._inotify: Inotify | None = None
+    self._root_wd = -1
+    self._dir_wds: dict[int, str] = {}
+    self._watched: dict[str, int] = {}
+    self._unwatched: set[str] = set()
+    try:
+      self._inotify = Inotify()
+    except OSError:
+      cloudlog.warning("uploader: inotify not available, falling back to scanning")
+    self.scan()
+
+  def _upload_key(self, logdir: str, name: str) -> UploadKey | None:
+    if name.endswith(".lock"):
+      return None
+    if logdir + "/" in self.immediate_folders:
+      tier = 0
+    elif name in self.immediate_priority:
+      tier = 1
+    else:
+      # never picked by the uploader, these are uploaded on request by athenad
+      return None
+    return (tier, get_directory_sort(logdir), self.immediate_priority.get(name, 1000), name, logdir)
+
+  def _list(self, key: UploadKey) -> list[UploadKey]:
+    return self._qcameras if key[0] != 0 and key[3] == "qcamera.ts" else self._queue
+
+  def add(self, logdir: str, name: str) -> None:
+    key = self._upload_key(logdir, name)
+    if key is None or (logdir, name) in self._keys or (logdir, name) in self._in_flight:
+      return
+    try:
+      if getxattr(os.path.join(self.root, logdir, name), UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE:
+        return
+    except OSError:
+      # deleter could have deleted, so skip
+      return
+    self._keys[(logdir, name)] = key
+    bisect.insort(self._list(key), key)
+
+  def remove(self, logdir: str, name: str) -> None:
+    key = self._keys.pop((logdir, name), None)
+    if key is not None:
+      queue = self._list(key)
+      del queue[bisect.bisect_left(queue, key)]
+
+  def take(self, logdir: str, name: str) -> None:
+    self.remove(logdir, name)
+    self._in_flight.add((logdir, name))
+
+  def release(self, logdir: str, name: str, requeue: bool) -> None:
+    self._in_flight.discard((logdir, name))
+    if requeue:
+      self.add(logdir, name)
+
+  def _remove_dir(self, logdir: str) -> None:
+    self._locks.pop(logdir, None)
+    self._unwatch_dir(logdir)
+    self._unwatched.discard(logdir)
+    for d, name in [k for k in self._keys if k[0] == logdir]:
+      self.remove(d, name)
+
+  def _watch_dir(self, logdir: str) -> None:
+    assert self._inotify is not None
+    try:
+      wd = self._inotify.add_watch(os.path.join(self.root, logdir), IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+    except OSError:
+      if logdir not in self._unwatched:
+        cloudlog.exception(f"uploader: failed to watch {logdir}, rescanning it on every update")
+        self._unwatched.add(logdir)
+      return
+    self._dir_wds[wd] = logdir
+    self._watched[logdir] = wd
+    self._unwatched.discard(logdir)
+
+  def _unwatch_dir(self, logdir: str) -> None:
+    wd = self._watched.pop(logdir, None)
+    if wd is not None:
+      assert self._inotify is not None
+      del self._dir_wds[wd]
+      self._inotify.rm_watch(wd)
+
+  def _unwatch_settled(self) -> None:
+    # segments that aren't among the newest anymore are done changing once they're unlocked
+    dirs = sorted(self._watched.keys() | self._unwatched, key=get_directory_sort)
+    keep = dirs_to_watch(dirs)
+    for logdir in dirs:
+      if logdir not in keep and not self._locks.get(logdir):
+        self._unwatch_dir(logdir)
+        self._unwatched.discard(logdir)
+
+  def _scan_dir(self, logdir: str, watch: bool = True) -> None:
+    if self._inotify is not None and watch:
+      self._watch_dir(logdir)
+    try:
+      names = os.listdir(os.path.join(self.root, logdir))
+    except OSError:
+      self._remove_dir(logdir)
+      return
+
+    locks = {name for name in names if name.endswith(".lock")}
+    if locks and self._inotify is not None and not watch:
+      # still being written to, so it's watched until it's unlocked
+      self._scan_dir(logdir)
+      return
+    if locks:
+      self._locks[logdir] = locks
+    else:
+      self._locks.pop(logdir, None)
+
+    for name in names:
+      if not name.endswith(".lock"):
+        self.add(logdir, name)
+
+    # without a watch, files deleted since the last scan are only noticed here
+    if logdir in self._unwatched:
+      present = set(names)
+      for d, name in [k for k in self._keys if k[0] == logdir and k[1] not in present]:
+        self.remove(d, name)
+
+  def scan(self) -> None:
+    self._queue, self._qcameras, self._keys, self._locks = [], [], {}, {}
+    self._unwatched = set()
+    if self._inotify is not None:
+      for wd in [self._root_wd, *self._dir_wds]:
+        if wd >= 0:
+          self._inotify.rm_watch(wd)
+      self._dir_wds, self._watched = {}, {}
       try:
-        names = os.listdir(path)
+        self._root_wd = self._inotify.add_watch(self.root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
       except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
+        self._root_wd = -1
+
+    logdirs = listdir_by_creation(self.root)
+    watch = dirs_to_watch(logdirs)
+    for logdir in logdirs:
+      self._scan_dir(logdir, logdir in watch)
+
+  def update(self) -> None:
+    if self._inotify is None or self._root_wd < 0:
+      self.scan()
+      return
+
+    for ev in self._inotify.read():
+      if ev.mask & IN_Q_OVERFLOW or (ev.wd == self._root_wd and ev.mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED)):
+        # missed events, or the log root itself went away
+        self.scan()
+        return
+
+      if ev.wd == self._root_wd:
+        if ev.mask & IN_ISDIR and ev.mask & (IN_CREATE | IN_MOVED_TO):
+          self._scan_dir(ev.name)
+        elif ev.mask & IN_ISDIR and ev.mask & (IN_DELETE | IN_MOVED_FROM):
+          self._remove_dir(ev.name)
+      elif ev.wd in self._dir_wds:
+        logdir = self._dir_wds[ev.wd]
+        if ev.mask & IN_IGNORED:
+          del self._dir_wds[ev.wd]
+          del self._watched[logdir]
+        elif ev.name.endswith(".lock"):
+          locks = self._locks.setdefault(logdir, set())
+          if ev.mask & (IN_CREATE | IN_MOVED_TO):
+            locks.add(ev.name)
+          else:
+            locks.discard(ev.name)
+        elif ev.mask & (IN_CREATE | IN_MOVED_TO):
+          self.add(logdir, ev.name)
+        elif ev.mask & (IN_DELETE | IN_MOVED_FROM):
+          self.remove(logdir, ev.name)
+
+    for logdir in sorted(self._unwatched):
+      self._scan_dir(logdir)
+    self._unwatch_settled()
+
+  def _allowed(self, key: UploadKey, metered: bool, requested_routes: list[str]) -> bool:
+    _, _, _, name, logdir = key
+    if self._locks.get(logdir):
+      return False
 
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
+    # limit uploading on metered connections
+    if metered:
+      dt = datetime.timedelta(hours=12)
+      if logdir in self.immediate_folders:
         try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+          ctime = os.path.getctime(os.path.join(self.root, logdir, name))
         except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
-          continue
+          return False
+        if (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
+          return False
 
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
+      if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+        return False
+    return True
 
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
+  def next(self, metered: bool, requested_routes: list[str]) -> tuple[str, str] | None:
+    self.update()
 
-        yield name, key, fn
+    candidates = []
+    for queue in (self._queue, self._qcameras):
+      if queue is self._qcameras and metered and not requested_routes:
+        continue
+      candidate = next((key for key in queue if self._allowed(key, metered, requested_routes)), None)
+      if candidate is not None:
+        candidates.append(candidate)
 
-  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
+    if not candidates:
+      return None
+    _, _, _, name, logdir = min(candidates)
+    return logdir, name
 
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
+  def __len__(self):
+    return len(self._keys)
 
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
 
-    return None
+class Uploader:
+  def __init__(self, dongle_id: str, root: str):
+    self.dongle_id = dongle_id
+    self.api = Api(dongle_id)
+    self.root = root
+
+    self.params = Params()
+
+    # stats for last successfully uploaded file
+    self.last_filename = ""
+
+    self.immediate_folders = ["crash/", "boot/"]
+    self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self.queue = UploadQueue(root, self.immediate_folders, self.immediate_priority)
+
+    # uploads are sent concurrently over pooled connections, and finished in the order they complete
+    self.session = requests.Session()
+    self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENT_UPLOADS))
+    self.pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS)
+    self.in_flight: list[PendingUpload] = []
+    self.concurrency = 1
+    self.throughput: dict[int, float] = {}  # concurrency -> total upload throughput in MB/s
+
+  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
+    r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
+    requested_routes = [] if r is None else [route for route in r.split(",") if route]
+
+    d = self.queue.next(metered, requested_routes)
+    if d is None:
+      return None
+    logdir, name = d
+    key = os.path.join(logdir, name)
+    return name, key, os.path.join(self.root, key)
 
   def do_upload(self, key: str, fn: str):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -156,74 +398,122 @@ class Uploader:
     try:
       compress = key.endswith('.zst') and not fn.endswith('.zst')
       stream, _ = get_upload_stream(fn, compress)
-      response = requests.put(url, data=stream, headers=headers, timeout=10)
+      response = self.session.put(url, data=stream, headers=headers, timeout=10)
       return response
     finally:
       if stream:
         stream.close()
 
-  def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> bool:
+  def _timed_upload(self, key: str, fn: str) -> tuple[requests.Response | None, tuple | None, float]:
+    start_time = time.monotonic()
+    try:
+      return self.do_upload(key, fn), None, time.monotonic() - start_time
+    except Exception as e:
+      return None, (e, traceback.format_exc()), time.monotonic() - start_time
+
+  def start_upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> PendingUpload | None:
     try:
       sz = os.path.getsize(fn)
     except OSError:
       cloudlog.exception("upload: getsize failed")
-      return False
+      return None
 
     cloudlog.event("upload_start", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
 
-    if sz == 0:
-      # tag files of 0 size as uploaded
-      success = True
-    elif name in MAX_UPLOAD_SIZES and sz > MAX_UPLOAD_SIZES[name]:
+    # files of 0 size and files that are too large are tagged as uploaded without sending them
+    future = None
+    if name in MAX_UPLOAD_SIZES and sz > MAX_UPLOAD_SIZES[name]:
       cloudlog.event("uploader_too_large", key=key, fn=fn, sz=sz)
+    elif sz > 0:
+      future = self.pool.submit(self._timed_upload, key, fn)
+    return PendingUpload(name, key, fn, sz, network_type, metered, len(self.in_flight) + 1, future)
+
+  def finish_upload(self, up: PendingUpload) -> bool:
+    last_exc = None
+    if up.future is None:
       success = True
     else:
-      start_time = time.monotonic()
-
-      stat = None
-      last_exc = None
-      try:
-        stat = self.do_upload(key, fn)
-      except Exception as e:
-        last_exc = (e, traceback.format_exc())
-
+      stat, last_exc, dt = up.future.result()
       if stat is not None and stat.status_code in (200, 201, 401, 403, 412):
-        self.last_filename = fn
-        dt = time.monotonic() - start_time
+        self.last_filename = up.fn
         if stat.status_code == 412:
-          cloudlog.event("upload_ignored", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
+          cloudlog.event("upload_ignored", key=up.key, fn=up.fn, sz=up.sz, network_type=up.network_type, metered=up.metered)
         else:
           content_length = int(stat.request.headers.get("Content-Length", 0))
           speed = (content_length / 1e6) / dt
-          cloudlog.event("upload_success", key=key, fn=fn, sz=sz, content_length=content_length,
-                         network_type=network_type, metered=metered, speed=speed)
+          cloudlog.event("upload_success", key=up.key, fn=up.fn, sz=up.sz, content_length=content_length,
+                         network_type=up.network_type, metered=up.metered, speed=speed)
+          statlog.sample("uploader_speed", speed)
+          self._update_concurrency(up.concurrency, speed * up.concurrency)
         success = True
       else:
         success = False
-        cloudlog.event("upload_failed", stat=stat, exc=last_exc, key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
+        self.concurrency = max(1, self.concurrency // 2)
+        cloudlog.event("upload_failed", stat=stat, exc=last_exc, key=up.key, fn=up.fn, sz=up.sz, network_type=up.network_type, metered=up.metered)
 
+    logdir, name = os.path.split(os.path.relpath(up.fn, self.root))
     if success:
       # tag file as uploaded
       try:
-        setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+        setxattr(up.fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
       except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=last_exc, key=key, fn=fn, sz=sz)
+        cloudlog.event("uploader_setxattr_failed", exc=last_exc, key=up.key, fn=up.fn, sz=up.sz)
 
+    # failed uploads go back in the queue to be retried
+    self.queue.release(logdir, name, requeue=not success)
     return success
 
+  def _update_concurrency(self, concurrency: int, throughput: float) -> None:
+    prev = self.throughput.get(concurrency, throughput)
+    self.throughput[concurrency] = 0.8 * prev + 0.2 * throughput
+    if concurrency != self.concurrency:
+      return
+
+    # keep adding uploads while it helps the total throughput, and back off when it stops helping
+    lower = self.throughput.get(concurrency - 1)
+    if lower is None or self.throughput[concurrency] > CONCURRENCY_GAIN * lower:
+      self.concurrency = min(self.concurrency + 1, MAX_CONCURRENT_UPLOADS)
+    elif self.throughput[concurrency] < lower:
+      self.concurrency -= 1
 
   def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
-    if d is None:
+    # only one upload at a time on metered connections
+    while len(self.in_flight) < (1 if metered else self.concurrency):
+      d = self.next_file_to_upload(metered)
+      if d is None:
+        break
+
+      name, key, fn = d
+      self.queue.take(*os.path.split(key))
+
+      # qlogs and bootlogs need to be compressed before uploading
+      if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
+        key += ".zst"
+
+      up = self.start_upload(name, key, fn, network_type, metered)
+      if up is None:
+        self.queue.release(*os.path.split(d[1]), requeue=True)
+        return False
+      self.in_flight.append(up)
+
+    statlog.gauge("uploader_queue_depth", len(self.queue))
+    statlog.gauge("uploader_in_flight", len(self.in_flight))
+    if not self.in_flight:
       return None
 
-    name, key, fn = d
+    # a slow upload doesn't hold back the ones started after it
+    up = next((up for up in self.in_flight if up.future is None), None)
+    if up is None:
+      done, _ = wait([up.future for up in self.in_flight if up.future is not None], return_when=FIRST_COMPLETED)
+      up = next(up for up in self.in_flight if up.future in done)
+    self.in_flight.remove(up)
+    return self.finish_upload(up)
 
-    # qlogs and bootlogs need to be compressed before uploading
-    if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
-      key += ".zst"
-
-    return self.upload(name, key, fn, network_type, metered)
+  def close(self) -> None:
+    while self.in_flight:
+      self.finish_upload(self.in_flight.pop(0))
+    self.pool.shutdown()
+    self.session.close()
 
 
 def main(exit_event: threading.Event = None) -> None:
@@ -268,6 +558,8 @@ def main(exit_event: threading.Event = None) -> None:
     if allow_sleep:
       time.sleep(backoff + random.uniform(0, backoff))
 
+  uploader.close()
+
 
 if __name__ == "__main__":
   main()
@@ -21,3 +21,8 @@ def getxattr(path: str, attr_name: str) -> bytes | None:
 def setxattr(path: str, attr_name: str, attr_value: bytes) -> None:
   _cached_attributes.pop((path, attr_name), None)
   xattr.setxattr(path, attr_name, attr_value)
+
+def invalidate(path: str) -> None:
+  """Forget the cached attributes of path, e.g. after another process changed them."""
+  for key in [k for k in _cached_attributes if k[0] == path]:
+    del _cached_attributes[key]
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
+import atexit
+import math
 import os
+import struct
+import threading
 import zmq
 import time
 import uuid
 from pathlib import Path
-from collections import defaultdict
 from datetime import datetime, UTC
 from typing import NoReturn
+from collections.abc import Iterator
 
 from openpilot.common.params import Params
 from cereal.messaging import SubMaster
@@ -17,10 +21,91 @@ from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.version import get_build_metadata
 from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET, STATS_FLUSH_TIME_S
 
+STATS_SEND_INTERVAL_S = 1.0  # metrics are batched for up to this long before being sent
+STATS_BATCH_BYTES = 8 * 1024
+
+# each metric is a record of type, value and name length, followed by the utf-8 name
+METRIC_RECORD = struct.Struct("<BdH")
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BINS = 1024
+
 
 class METRIC_TYPE:
-  GAUGE = 'g'
-  SAMPLE = 'sa'
+  GAUGE = 0
+  SAMPLE = 1
+
+
+def encode_metric(metric_type: int, name: str, value: float) -> bytes:
+  name_bytes = name.encode()
+  return METRIC_RECORD.pack(metric_type, value, len(name_bytes)) + name_bytes
+
+
+def decode_metrics(dat: bytes) -> Iterator[tuple[int, str, float]]:
+  pos = 0
+  while pos < len(dat):
+    metric_type, value, name_len = METRIC_RECORD.unpack_from(dat, pos)
+    pos += METRIC_RECORD.size
+    if pos + name_len > len(dat):
+      raise ValueError("truncated metric")
+    yield metric_type, dat[pos:pos + name_len].decode(), value
+    pos += name_len
+
+
+class QuantileSketch:
+  """
+    Fixed size summary of a stream of samples (DDSketch).
+    Count, sum, min and max are exact, quantiles are within SKETCH_RELATIVE_ACCURACY of a sample's value.
+  """
+  def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY, max_bins: int = SKETCH_MAX_BINS):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_bins = max_bins
+
+    self.count = 0
+    self.sum = 0.0
+    self.min = math.inf
+    self.max = -math.inf
+    self.zeros = 0
+    # bins of positive and negative samples by index, bin i holds magnitudes in (gamma^(i-1), gamma^i]
+    self.positive: dict[int, int] = {}
+    self.negative: dict[int, int] = {}
+
+  def add(self, value: float) -> None:
+    self.count += 1
+    self.sum += value
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+
+    if value == 0:
+      self.zeros += 1
+      return
+
+    bins = self.positive if value > 0 else self.negative
+    i = math.ceil(math.log(abs(value)) / self.log_gamma)
+    bins[i] = bins.get(i, 0) + 1
+    if len(bins) > self.max_bins:
+      # merge the bins closest to zero, which keeps the high quantiles accurate
+      lowest = sorted(bins)[:2]
+      bins[lowest[1]] += bins.pop(lowest[0])
+
+  def _bin_value(self, i: int) -> float:
+    return 2 * self.gamma ** i / (self.gamma + 1)
+
+  def quantile(self, q: float) -> float:
+    # same rank as indexing into the sorted samples
+    rank = int(round(q * (self.count - 1)))
+
+    seen = 0
+    values = [(-self._bin_value(i), n) for i, n in sorted(self.negative.items(), reverse=True)]
+    values += [(0.0, self.zeros)]
+    values += [(self._bin_value(i), n) for i, n in sorted(self.positive.items())]
+    for value, n in values:
+      seen += n
+      if seen > rank:
+        return min(max(value, self.min), self.max)
+    return self.max
+
 
 class StatLog:
   def __init__(self):
@@ -28,6 +113,12 @@ class StatLog:
     self.zctx = None
     self.sock = None
 
+    # metrics are batched, and only the latest value of a gauge is sent
+    self.lock = threading.Lock()
+    self.gauges: dict[str, float] = {}
+    self.samples = bytearray()
+    atexit.register(self.flush)
+
   def connect(self) -> None:
     self.zctx = zmq.Context()
     self.sock = self.zctx.socket(zmq.PUSH)
@@ -35,29 +126,59 @@ class StatLog:
     self.sock.connect(STATS_SOCKET)
     self.pid = os.getpid()
 
+    # don't send metrics recorded by the parent process, or wait on a lock held by one of its threads
+    self.lock = threading.Lock()
+    self.gauges.clear()
+    self.samples.clear()
+
+    # batches are sent on a timer, so rarely recorded metrics aren't held back until the next one,
+    # and at most one interval of metrics is lost when the process is killed
+    threading.Thread(target=self._send_thread, daemon=True).start()
+
   def __del__(self):
     if self.sock is not None:
       self.sock.close()
     if self.zctx is not None:
       self.zctx.term()
 
-  def _send(self, metric: str) -> None:
+  def _send_thread(self) -> None:
+    while True:
+      time.sleep(STATS_SEND_INTERVAL_S)
+      self.flush()
+
+  def flush(self) -> None:
+    """Send the metrics recorded since the last send"""
     if os.getpid() != self.pid:
-      self.connect()
+      return
 
-    try:
-      self.sock.send_string(metric, zmq.NOBLOCK)
-    except zmq.error.Again:
-      # drop :/
-      pass
+    with self.lock:
+      if not (self.gauges or self.samples):
+        return
+      dat = b"".join(encode_metric(METRIC_TYPE.GAUGE, name, value) for name, value in self.gauges.items()) + self.samples
+      self.gauges.clear()
+      self.samples.clear()
+
+      try:
+        self.sock.send(dat, zmq.NOBLOCK)
+      except zmq.error.Again:
+        # drop :/
+        pass
 
   def gauge(self, name: str, value: float) -> None:
-    self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
+    if os.getpid() != self.pid:
+      self.connect()
+    with self.lock:
+      self.gauges[name] = value
 
-  # Samples will be recorded in a buffer and at aggregation time,
+  # Samples will be summarized at aggregation time,
   # statistical properties will be logged (mean, count, percentiles, ...)
   def sample(self, name: str, value: float):
-    self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
+    if os.getpid() != self.pid:
+      self.connect()
+    with self.lock:
+      self.samples += encode_metric(METRIC_TYPE.SAMPLE, name, value)
+    if len(self.samples) > STATS_BATCH_BYTES:
+      self.flush()
 
 
 def main() -> NoReturn:
@@ -106,7 +227,7 @@ def main() -> NoReturn:
   boot_uid = str(uuid.uuid4())[:8]
   last_flush_time = time.monotonic()
   gauges = {}
-  samples: dict[str, list[float]] = defaultdict(list)
+  samples: dict[str, QuantileSketch] = {}
   try:
     while True:
       started_prev = sm['deviceState'].started
@@ -115,20 +236,19 @@ def main() -> NoReturn:
       # Update metrics
       while True:
         try:
-          metric = sock.recv_string(zmq.NOBLOCK)
+          dat = sock.recv(zmq.NOBLOCK)
           try:
-            metric_type = metric.split('|')[1]
-            metric_name = metric.split(':')[0]
-            metric_value = float(metric.split('|')[0].split(':')[1])
-
-            if metric_type == METRIC_TYPE.GAUGE:
-              gauges[metric_name] = metric_value
-            elif metric_type == METRIC_TYPE.SAMPLE:
-              samples[metric_name].append(metric_value)
-            else:
-              cloudlog.event("unknown metric type", metric_type=metric_type)
+            for metric_type, metric_name, metric_value in decode_metrics(dat):
+              if metric_type == METRIC_TYPE.GAUGE:
+                gauges[metric_name] = metric_value
+              elif metric_type == METRIC_TYPE.SAMPLE:
+                if metric_name not in samples:
+                  samples[metric_name] = QuantileSketch()
+                samples[metric_name].add(metric_value)
+              else:
+                cloudlog.event("unknown metric type", metric_type=metric_type)
           except Exception:
-            cloudlog.event("malformed metric", metric=metric)
+            cloudlog.event("malformed metric", metric=dat)
         except zmq.error.Again:
           break
 
@@ -141,20 +261,15 @@ def main() -> NoReturn:
         for key, value in gauges.items():
           result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
 
-        for key, values in samples.items():
-          values.sort()
-          sample_count = len(values)
-          sample_sum = sum(values)
-
+        for key, sketch in samples.items():
           stats = {
-            'count': sample_count,
-            'min': values[0],
-            'max': values[-1],
-            'mean': sample_sum / sample_count,
+            'count': sketch.count,
+            'min': sketch.min,
+            'max': sketch.max,
+            'mean': sketch.sum / sketch.count,
           }
           for percentile in [0.05, 0.5, 0.95]:
-            value = values[int(round(percentile * (sample_count - 1)))]
-            stats[f"p{int(percentile * 100)}"] = value
+            stats[f"p{int(percentile * 100)}"] = sketch.quantile(percentile)
 
           result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
 
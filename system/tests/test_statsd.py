@@ -0,0 +1,49 @@
+import random
+import zmq
+
+import openpilot.system.statsd as statsd
+from openpilot.system.statsd import METRIC_TYPE, QuantileSketch, SKETCH_RELATIVE_ACCURACY, STATS_SEND_INTERVAL_S, StatLog, decode_metrics, \
+                                    encode_metric
+
+
+class TestStatsd:
+  def test_metric_encoding(self):
+    metrics = [(METRIC_TYPE.GAUGE, "free_space_percent", 42.5), (METRIC_TYPE.SAMPLE, "power_draw", -1.25)]
+    dat = b"".join(encode_metric(*m) for m in metrics)
+    assert list(decode_metrics(dat)) == metrics
+
+  def test_quantile_sketch(self):
+    values = [random.expovariate(0.01) for _ in range(10000)] + [0.0] * 100 + [-random.uniform(0, 10) for _ in range(100)]
+    sketch = QuantileSketch()
+    for v in values:
+      sketch.add(v)
+
+    values.sort()
+    assert sketch.count == len(values)
+    assert sketch.min == values[0]
+    assert sketch.max == values[-1]
+    for q in (0.05, 0.5, 0.95):
+      expected = values[int(round(q * (len(values) - 1)))]
+      assert abs(sketch.quantile(q) - expected) <= SKETCH_RELATIVE_ACCURACY * abs(expected) * 1.01
+
+  def test_send_timer(self, tmp_path, monkeypatch):
+    addr = f"ipc://{tmp_path}/stats"
+    monkeypatch.setattr(statsd, "STATS_SOCKET", addr)
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(addr)
+    try:
+      stat_log = StatLog()
+      stat_log.gauge("free_space_percent", 42.5)
+      stat_log.sample("power_draw", -1.25)
+
+      # the last metric is sent without waiting for another one to be recorded
+      received = []
+      while sock.poll(int(STATS_SEND_INTERVAL_S * 2 * 1000)):
+        received += decode_metrics(sock.recv())
+        if len(received) == 2:
+          break
+      assert received == [(METRIC_TYPE.GAUGE, "free_space_percent", 42.5), (METRIC_TYPE.SAMPLE, "power_draw", -1.25)]
+    finally:
+      sock.close()
+      ctx.term()
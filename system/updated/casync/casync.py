@@ -5,13 +5,19 @@ import os
 import pathlib
 import struct
 import sys
+import tempfile
 import time
 from abc import ABC, abstractmethod
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
 from typing import IO
 
+import numpy as np
 import requests
+import zstandard as zstd
+from requests.adapters import HTTPAdapter
 from Crypto.Hash import SHA512
 from openpilot.system.updated.casync import tar
 from openpilot.system.updated.casync.common import create_casync_tar_package
@@ -28,14 +34,59 @@ CA_TABLE_MIN_LEN = CA_TABLE_HEADER_LEN + CA_TABLE_ENTRY_LEN
 
 CHUNK_DOWNLOAD_TIMEOUT = 60
 CHUNK_DOWNLOAD_RETRIES = 3
+CHUNK_DOWNLOAD_WORKERS = 8
+MAX_PENDING_CHUNKS = 2 * CHUNK_DOWNLOAD_WORKERS  # bounds the decompressed chunks held in memory
 
 CAIBX_DOWNLOAD_TIMEOUT = 120
 
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+CHUNKER_WINDOW_SIZE = 48
+CHUNKER_HASH_BLOCK = 1024 * 1024  # bytes hashed at once by the chunker
+# casync's buzhash table (src/cachunker.c), so chunk boundaries are the same as with casync make
+BUZHASH_TABLE = np.array([
+  0x458be752, 0xc10748cc, 0xfbbcdbb8, 0x6ded5b68, 0xb10a82b5, 0x20d75648, 0xdfc5665f, 0xa8428801,
+  0x7ebf5191, 0x841135c7, 0x65cc53b3, 0x280a597c, 0x16f60255, 0xc78cbc3e, 0x294415f5, 0xb938d494,
+  0xec85c4e6, 0xb7d33edc, 0xe549b544, 0xfdeda5aa, 0x882bf287, 0x3116737c, 0x05569956, 0xe8cc1f68,
+  0x0806ac5e, 0x22a14443, 0x15297e10, 0x50d090e7, 0x4ba60f6f, 0xefd9f1a7, 0x5c5c885c, 0x82482f93,
+  0x9bfd7c64, 0x0b3e7276, 0xf2688e77, 0x8fad8abc, 0xb0509568, 0xf1ada29f, 0xa53efdfe, 0xcb2b1d00,
+  0xf2a9e986, 0x6463432b, 0x95094051, 0x5a223ad2, 0x9be8401b, 0x61e579cb, 0x1a556a14, 0x5840fdc2,
+  0x9261ddf6, 0xcde002bb, 0x52432bb0, 0xbf17373e, 0x7b7c222f, 0x2955ed16, 0x9f10ca59, 0xe840c4c9,
+  0xccabd806, 0x14543f34, 0x1462417a, 0x0d4a1f9c, 0x087ed925, 0xd7f8f24c, 0x7338c425, 0xcf86c8f5,
+  0xb19165cd, 0x9891c393, 0x325384ac, 0x0308459d, 0x86141d7e, 0xc922116a, 0xe2ffa6b6, 0x53f52aed,
+  0x2cd86197, 0xf5b9f498, 0xbf319c8f, 0xe0411fae, 0x977eb18c, 0xd8770976, 0x9833466a, 0xc674df7f,
+  0x8c297d45, 0x8ca48d26, 0xc49ed8e2, 0x7344f874, 0x556f79c7, 0x6b25eaed, 0xa03e2b42, 0xf68f66a4,
+  0x8e8b09a2, 0xf2e0e62a, 0x0d3a9806, 0x9729e493, 0x8c72b0fc, 0x160b94f6, 0x450e4d3d, 0x7a320e85,
+  0xbef8f0e1, 0x21d73653, 0x4e3d977a, 0x1e7b3929, 0x1cc6c719, 0xbe478d53, 0x8d752809, 0xe6d8c2c6,
+  0x275f0892, 0xc8acc273, 0x4cc21580, 0xecc4a617, 0xf5f7be70, 0xe795248a, 0x375a2fe9, 0x425570b6,
+  0x8898dcf8, 0xdc2d97c4, 0x0106114b, 0x364dc22f, 0x1e0cad1f, 0xbe63803c, 0x5f69fac2, 0x4d5afa6f,
+  0x1bc0dfb5, 0xfb273589, 0x0ea47f7b, 0x3c1c2b50, 0x21b2a932, 0x6b1223fd, 0x2fe706a8, 0xf9bd6ce2,
+  0xa268e64e, 0xe987f486, 0x3eacf563, 0x1ca2018c, 0x65e18228, 0x2207360a, 0x57cf1715, 0x34c37d2b,
+  0x1f8f3cde, 0x93b657cf, 0x31a019fd, 0xe69eb729, 0x8bca7b9b, 0x4c9d5bed, 0x277ebeaf, 0xe0d8f8ae,
+  0xd150821c, 0x31381871, 0xafc3f1b0, 0x927db328, 0xe95effac, 0x305a47bd, 0x426ba35b, 0x1233af3f,
+  0x686a5b83, 0x50e072e5, 0xd9d3bb2a, 0x8befc475, 0x487f0de6, 0xc88dff89, 0xbd664d5e, 0x971b5d18,
+  0x63b14847, 0xd7d3c1ce, 0x7f583cf3, 0x72cbcb09, 0xc0d0a81c, 0x7fa3429b, 0xe9158a1b, 0x225ea19a,
+  0xd8ca9ea3, 0xc763b282, 0xbb0c6341, 0x020b8293, 0xd4cd299d, 0x58cfa7f8, 0x91b4ee53, 0x37e4d140,
+  0x95ec764c, 0x30f76b06, 0x5ee68d24, 0x679c8661, 0xa41979c2, 0xf2b61284, 0x4fac1475, 0x0adb49f9,
+  0x19727a23, 0x15a7e374, 0xc43a18d5, 0x3fb1aa73, 0x342fc615, 0x924c0793, 0xbee2d7f0, 0x8a279de9,
+  0x4aa2d70c, 0xe24dd37f, 0xbe862c0b, 0x177c22c2, 0x5388e5ee, 0xcd8a7510, 0xf901b4fd, 0xdbc13dbc,
+  0x6c0bae5b, 0x64efe8c7, 0x48b02079, 0x80331a49, 0xca3d8ae6, 0xf3546190, 0xfed7108b, 0xc49b941b,
+  0x32baf4a9, 0xeb833a4a, 0x88a3f1a5, 0x3a91ce0a, 0x3cc27da1, 0x7112e684, 0x4a3096b1, 0x3794574c,
+  0xa3c8b6f3, 0x1d213941, 0x6e0a2e00, 0x233479f1, 0x0f4cd82f, 0x6093edd2, 0x5d7d209e, 0x464fe319,
+  0xd4dcac9e, 0x0db845cb, 0xfb5e4bc3, 0xe0256ce1, 0x09fb4ed1, 0x0914be1e, 0xa5bdb2c3, 0xc6eb57bb,
+  0x30320350, 0x3f397e91, 0xa67791bc, 0x86bc0e2c, 0xefa0a7e2, 0xe9ff7543, 0xe733612c, 0xd185897b,
+  0x329e5388, 0x91dd236b, 0x2ecb0d93, 0xf4d82a3d, 0x35b5c03f, 0xe4e606f0, 0x05b21843, 0x37b45964,
+  0x5eff22f4, 0x6027f4cc, 0x77178b3c, 0xae507131, 0x7bf7cabc, 0xf9c18d66, 0x593ade65, 0xd95ddf11,
+], dtype=np.uint32)
+
 Chunk = namedtuple('Chunk', ['sha', 'offset', 'length'])
 ChunkDict = dict[bytes, Chunk]
 
 
 class ChunkReader(ABC):
+  # remote readers are safe to use from several threads, and are only tried for chunks not found locally
+  remote = False
+
   @abstractmethod
   def read(self, chunk: Chunk) -> bytes:
     ...
@@ -62,11 +113,15 @@ class FileChunkReader(BinaryChunkReader):
 
 class RemoteChunkReader(ChunkReader):
   """Reads lzma compressed chunks from a remote store"""
+  remote = True
 
   def __init__(self, url: str) -> None:
     super().__init__()
     self.url = url
     self.session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=CHUNK_DOWNLOAD_WORKERS)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
 
   def read(self, chunk: Chunk) -> bytes:
     sha_hex = chunk.sha.hex()
@@ -88,6 +143,9 @@ class RemoteChunkReader(ChunkReader):
       resp.raise_for_status()
       contents = resp.content
 
+    if contents.startswith(ZSTD_MAGIC):
+      return zstd.ZstdDecompressor().decompress(contents, max_output_size=chunk.length)
+
     decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_AUTO)
     return decompressor.decompress(contents)
 
@@ -155,6 +213,176 @@ def parse_caibx(caibx_path: str) -> list[Chunk]:
   return chunks
 
 
+def write_caibx(caibx_path: str, chunks: list[Chunk], min_size: int, avg_size: int, max_size: int) -> None:
+  """Writes a caibx index for a list of consecutive chunks, readable by parse_caibx and casync"""
+  with open(caibx_path, 'wb') as caibx:
+    caibx.write(struct.pack("<QQQQQQ", CA_HEADER_LEN, CA_FORMAT_INDEX, FLAGS, min_size, avg_size, max_size))
+    caibx.write(struct.pack("<QQ", 0xffffffffffffffff, CA_FORMAT_TABLE))
+    for c in chunks:
+      caibx.write(struct.pack("<Q", c.offset + c.length) + c.sha)
+    table_len = CA_TABLE_HEADER_LEN + len(chunks) * CA_TABLE_ENTRY_LEN + CA_TABLE_ENTRY_LEN
+    caibx.write(struct.pack("<QQQQQ", 0, 0, CA_HEADER_LEN, table_len, CA_FORMAT_TABLE_TAIL_MARKER))
+
+
+def rol32(x: np.ndarray, n: int) -> np.ndarray:
+  return (x << np.uint32(n)) | (x >> np.uint32(32 - n))
+
+
+def buzhash_windows(t: np.ndarray) -> np.ndarray:
+  """Buzhash of every CHUNKER_WINDOW_SIZE byte window, given the table values of the bytes.
+  Element i is the hash of the window ending at byte i + CHUNKER_WINDOW_SIZE - 1."""
+  # build up windows of 2, 4, 8, 16 and 32 bytes, h[i] = xor of rol(t[i + w - 1 - k], k) for k < w
+  windows = {1: t}
+  w = 1
+  while w < 32:
+    h = windows[w]
+    windows[w * 2] = h[w:] ^ rol32(h[:-w], w)
+    w *= 2
+  return windows[16][32:] ^ rol32(windows[32][:len(t) - CHUNKER_WINDOW_SIZE + 1], 16)
+
+
+def discriminator_from_avg(avg_size: int) -> int:
+  """casync's fit of the discriminator that gives chunks of avg_size on average, between avg_size / 4 and 4 * avg_size.
+  It's negative for averages above ~9MB. casync casts it to a size_t that no 32 bit hash matches, so only max_size cuts chunks."""
+  return int(avg_size / (-1.42888852e-7 * avg_size + 1.33237515))
+
+
+class Chunker:
+  """Content-defined chunker, splits a stream in chunks between min_size and max_size
+  at positions where the buzhash of the preceding bytes matches"""
+  def __init__(self, avg_size: int) -> None:
+    self.min_size = avg_size // 4
+    self.avg_size = avg_size
+    self.max_size = avg_size * 4
+    self.discriminator = discriminator_from_avg(avg_size)
+
+    self.buf = bytearray()
+    self.start = 0  # stream offset of buf
+    self.hashed = 0  # stream offset up to which boundaries were searched
+    self.boundaries: deque[int] = deque()
+
+  def _hash(self) -> None:
+    # include the window preceding the new data, if it's still in the buffer
+    begin = max(self.hashed - (CHUNKER_WINDOW_SIZE - 1), self.start)
+    data = np.frombuffer(self.buf, dtype=np.uint8, offset=begin - self.start)
+    if len(data) >= CHUNKER_WINDOW_SIZE and self.discriminator > 0:
+      h = buzhash_windows(BUZHASH_TABLE[data])
+      ends = np.flatnonzero(h % self.discriminator == self.discriminator - 1) + begin + CHUNKER_WINDOW_SIZE
+      self.boundaries.extend(ends[ends > self.hashed].tolist())
+    self.hashed = self.start + len(self.buf)
+
+  def _split(self, final: bool) -> list[bytes]:
+    chunks = []
+    end = self.start + len(self.buf)
+    while True:
+      while self.boundaries and self.boundaries[0] < self.start + self.min_size:
+        self.boundaries.popleft()
+
+      if self.boundaries and self.boundaries[0] - self.start <= self.max_size:
+        cut = self.boundaries.popleft()
+      elif end - self.start >= self.max_size:
+        cut = self.start + self.max_size
+      elif final and end > self.start:
+        cut = end
+      else:
+        break
+
+      chunks.append(bytes(self.buf[:cut - self.start]))
+      del self.buf[:cut - self.start]
+      self.start = cut
+    return chunks
+
+  def feed(self, data: bytes) -> list[bytes]:
+    """Returns the chunks completed by data"""
+    self.buf += data
+    if self.start + len(self.buf) - self.hashed < CHUNKER_HASH_BLOCK:
+      return []
+    self._hash()
+    return self._split(False)
+
+  def finish(self) -> list[bytes]:
+    """Returns the remaining chunks at the end of the stream"""
+    self._hash()
+    return self._split(True)
+
+
+def store_chunk(store_path: str, data: bytes, compression: str) -> bytes:
+  """Hashes and compresses a chunk into a chunk store, returns its hash"""
+  sha = SHA512.new(data, truncate="256").digest()
+  sha_hex = sha.hex()
+  chunk_dir = os.path.join(store_path, sha_hex[:4])
+  chunk_path = os.path.join(chunk_dir, sha_hex + ".cacnk")
+
+  if not os.path.exists(chunk_path):
+    if compression == "xz":
+      contents = lzma.compress(data, format=lzma.FORMAT_XZ)
+    elif compression == "zstd":
+      contents = zstd.ZstdCompressor().compress(data)
+    else:
+      raise ValueError(f"unsupported compression {compression}")
+
+    os.makedirs(chunk_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=chunk_dir, delete=False) as f:
+      f.write(contents)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, chunk_path)
+  return sha
+
+
+class ChunkStoreWriter(io.RawIOBase):
+  """File-like object that chunks everything written to it into a chunk store.
+  Chunks are hashed and compressed by a pool of workers, close() returns the list of chunks."""
+  def __init__(self, store_path: str, avg_size: int, compression: str = "xz", workers: int | None = None) -> None:
+    super().__init__()
+    self.store_path = store_path
+    self.compression = compression
+    self.chunker = Chunker(avg_size)
+
+    self.workers = workers or os.cpu_count() or 1
+    self.pool = ThreadPoolExecutor(max_workers=self.workers)
+    self.pending: deque[tuple[Future, int]] = deque()
+    self.offset = 0
+    self.chunks: list[Chunk] = []
+
+  def writable(self) -> bool:
+    return True
+
+  def _submit(self, chunks: list[bytes]) -> None:
+    for data in chunks:
+      # bounds the chunks held in memory
+      while len(self.pending) >= 2 * self.workers:
+        self._collect()
+      self.pending.append((self.pool.submit(store_chunk, self.store_path, data, self.compression), len(data)))
+
+  def _collect(self) -> None:
+    future, length = self.pending.popleft()
+    self.chunks.append(Chunk(future.result(), self.offset, length))
+    self.offset += length
+
+  def write(self, data) -> int:
+    self._submit(self.chunker.feed(data))
+    return len(data)
+
+  def close(self) -> None:
+    if not self.closed:
+      try:
+        self._submit(self.chunker.finish())
+        while self.pending:
+          self._collect()
+      finally:
+        self.pool.shutdown(cancel_futures=True)
+        super().close()
+
+
+def make(in_file: IO[bytes], caibx_path: str, store_path: str, avg_size: int, compression: str = "xz") -> list[Chunk]:
+  """Chunks a file into a chunk store and writes its caibx index, like casync make"""
+  with ChunkStoreWriter(store_path, avg_size, compression) as writer:
+    while data := in_file.read(CHUNKER_HASH_BLOCK):
+      writer.write(data)
+  write_caibx(caibx_path, writer.chunks, writer.chunker.min_size, writer.chunker.avg_size, writer.chunker.max_size)
+  return writer.chunks
+
+
 def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
   """Turn a list of chunks into a dict for faster lookups based on hash.
   Keep first chunk since it's more likely to be already downloaded."""
@@ -165,41 +393,116 @@ def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
   return r
 
 
+def read_chunk(chunk: Chunk, sources: list[tuple[str, ChunkReader, ChunkDict]]) -> tuple[str, bytes] | None:
+  """Read and verify a chunk from the first source that has it"""
+  for name, chunk_reader, store_chunks in sources:
+    if chunk.sha in store_chunks:
+      bts = chunk_reader.read(store_chunks[chunk.sha])
+
+      # Check length
+      if len(bts) != chunk.length:
+        continue
+
+      # Check hash
+      if SHA512.new(bts, truncate="256").digest() != chunk.sha:
+        continue
+
+      return name, bts
+  return None
+
+
+def find_chunks_in_place(path: str, chunks: list[Chunk], workers: int | None = None) -> list[Chunk]:
+  """Returns the chunks that are already in place in a file. Chunks are hashed in parallel."""
+  def matches(fd: int, chunk: Chunk) -> bool:
+    bts = os.pread(fd, chunk.length, chunk.offset)
+    return len(bts) == chunk.length and SHA512.new(bts, truncate="256").digest() == chunk.sha
+
+  try:
+    f = open(path, 'rb')
+  except OSError:
+    return []
+
+  with f, ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+    return [c for c, ok in zip(chunks, pool.map(partial(matches, f.fileno()), chunks), strict=True) if ok]
+
+
+def is_in_place(chunk: Chunk, chunk_reader: ChunkReader, store_chunks: ChunkDict, out_path: str) -> bool:
+  """Whether the chunk was read from the same place in the output it's supposed to be written to"""
+  if not isinstance(chunk_reader, FileChunkReader) or store_chunks[chunk.sha].offset != chunk.offset:
+    return False
+  try:
+    return os.path.samefile(chunk_reader.f.name, out_path)
+  except OSError:
+    return False
+
+
 def extract(target: list[Chunk],
             sources: list[tuple[str, ChunkReader, ChunkDict]],
             out_path: str,
             progress: Callable[[int], None] = None):
+  """Local sources are tried first, in order. Chunks not found locally are downloaded and verified
+  by a pool of workers while the rest of the target is processed."""
   stats: dict[str, int] = defaultdict(int)
+  local_sources = [s for s in sources if not s[1].remote]
+  remote_sources = [s for s in sources if s[1].remote]
 
-  mode = 'rb+' if os.path.exists(out_path) else 'wb'
-  with open(out_path, mode) as out:
-    for cur_chunk in target:
-
-      # Find source for desired chunk
-      for name, chunk_reader, store_chunks in sources:
-        if cur_chunk.sha in store_chunks:
-          bts = chunk_reader.read(store_chunks[cur_chunk.sha])
+  # chunks being downloaded, with all the places they go
+  pending: dict[bytes, tuple[Future, list[Chunk]]] = {}
 
-          # Check length
-          if len(bts) != cur_chunk.length:
-            continue
-
-          # Check hash
-          if SHA512.new(bts, truncate="256").digest() != cur_chunk.sha:
-            continue
+  mode = 'rb+' if os.path.exists(out_path) else 'wb'
+  with open(out_path, mode, buffering=0) as out, ThreadPoolExecutor(max_workers=CHUNK_DOWNLOAD_WORKERS) as pool:
+
+    def add_stats(name: str, cur_chunk: Chunk):
+      stats[name] += cur_chunk.length
+      if progress is not None:
+        progress(sum(stats.values()))
+
+    def write_local(cur_chunk: Chunk) -> bool:
+      for source in local_sources:
+        if (res := read_chunk(cur_chunk, [source])) is not None:
+          name, chunk_reader, store_chunks = source
+          if not is_in_place(cur_chunk, chunk_reader, store_chunks, out_path):
+            out.seek(cur_chunk.offset)
+            out.write(res[1])
+          add_stats(name, cur_chunk)
+          return True
+      return False
+
+    def finish(sha: bytes):
+      future, chunks = pending.pop(sha)
+      res = future.result()
+      if res is None:
+        raise RuntimeError("Desired chunk not found in provided stores")
 
-          # Write to output
+      name, bts = res
+      for i, cur_chunk in enumerate(chunks):
+        # once written, reused chunks are picked up locally as they would have been without the download
+        if i == 0 or not write_local(cur_chunk):
           out.seek(cur_chunk.offset)
           out.write(bts)
+          add_stats(name, cur_chunk)
 
-          stats[name] += cur_chunk.length
+    try:
+      for cur_chunk in target:
+        if cur_chunk.sha in pending:
+          pending[cur_chunk.sha][1].append(cur_chunk)
+          continue
 
-          if progress is not None:
-            progress(sum(stats.values()))
+        if write_local(cur_chunk):
+          continue
 
-          break
-      else:
-        raise RuntimeError("Desired chunk not found in provided stores")
+        while len(pending) >= MAX_PENDING_CHUNKS:
+          done, _ = wait([f for f, _ in pending.values()], return_when=FIRST_COMPLETED)
+          for sha in [sha for sha, (f, _) in pending.items() if f in done]:
+            finish(sha)
+
+        pending[cur_chunk.sha] = (pool.submit(read_chunk, cur_chunk, remote_sources), [cur_chunk])
+
+      while pending:
+        finish(next(iter(pending)))
+    finally:
+      for f, _ in pending.values():
+        f.cancel()
 
   return stats
 
@@ -8,6 +8,9 @@ from openpilot.system.updated.casync import tar
 
 
 CASYNC_ARGS = ["--with=symlinks", "--with=permissions", "--compression=xz", "--chunk-size=16M"]
+CASYNC_CHUNK_SIZE = 16 * 1024 * 1024
+CASYNC_COMPRESSION = "xz"
+CASYNC_STORE = "default.castr"
 CASYNC_FILES = [BUILD_METADATA_FILENAME]
 
 
@@ -46,16 +49,25 @@ def create_casync_tar_package(target_dir: pathlib.Path, output_path: pathlib.Pat
 
 
 def create_casync_from_file(file: pathlib.Path, output_dir: pathlib.Path, caibx_name: str):
+  # casync imports this module
+  from openpilot.system.updated.casync import casync
+
   caibx_file = output_dir / f"{caibx_name}.caibx"
-  run(["casync", "make", *CASYNC_ARGS, caibx_file, str(file)])
+  with open(file, "rb") as f:
+    casync.make(f, str(caibx_file), str(output_dir / CASYNC_STORE), CASYNC_CHUNK_SIZE, CASYNC_COMPRESSION)
 
   return caibx_file
 
 
 def create_casync_release(target_dir: pathlib.Path, output_dir: pathlib.Path, caibx_name: str):
-  tar_file = output_dir / f"{caibx_name}.tar"
-  create_casync_tar_package(target_dir, tar_file)
-  caibx_file = create_casync_from_file(tar_file, output_dir, caibx_name)
-  tar_file.unlink()
+  from openpilot.system.updated.casync import casync
+
+  # the tar is chunked as it's written, without going through disk
+  caibx_file = output_dir / f"{caibx_name}.caibx"
+  with casync.ChunkStoreWriter(str(output_dir / CASYNC_STORE), CASYNC_CHUNK_SIZE, CASYNC_COMPRESSION) as writer:
+    tar.write_tar_archive(writer, target_dir, is_not_git)
+  casync.write_caibx(str(caibx_file), writer.chunks, writer.chunker.min_size, writer.chunker.avg_size, writer.chunker.max_size)
+
+  # the catar digest of the directory, the same as `casync digest`
   digest = run(["casync", "digest", *CASYNC_ARGS, target_dir]).decode("utf-8").strip()
   return digest, caibx_file
@@ -11,8 +11,15 @@ def include_default(_) -> bool:
 def create_tar_archive(filename: pathlib.Path, directory: pathlib.Path, include: Callable[[pathlib.Path], bool] = include_default):
   """Creates a tar archive of a directory"""
 
-  with tarfile.open(filename, 'w') as tar:
-    for file in sorted(directory.rglob("*"), key=lambda f: f.stat().st_size if f.is_file() else 0, reverse=True):
+  with open(filename, 'wb') as f:
+    write_tar_archive(f, directory, include)
+
+
+def write_tar_archive(fh: IO[bytes], directory: pathlib.Path, include: Callable[[pathlib.Path], bool] = include_default):
+  """Writes a tar archive of a directory as a stream, fh doesn't need to be seekable"""
+
+  with tarfile.open(fileobj=fh, mode='w|') as tar:
+    for file in sorted(directory.rglob("*"), key=lambda f: (-f.stat().st_size if f.is_file() else 0, str(f))):
       if not include(file):
         continue
       relative_path = str(file.relative_to(directory))
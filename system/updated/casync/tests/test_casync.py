@@ -1,8 +1,12 @@
 import pytest
+import collections
+import io
+import itertools
 import os
 import pathlib
 import tempfile
-import subprocess
+import numpy as np
+from Crypto.Hash import SHA512
 
 from openpilot.system.updated.casync import casync
 from openpilot.system.updated.casync import tar
@@ -12,6 +16,8 @@ from openpilot.system.updated.casync import tar
 # losetup -a | grep img.raw
 LOOPBACK = os.environ.get('LOOPBACK', None)
 
+CHUNK_SIZE = 64 * 1024  # casync's default
+
 
 @pytest.mark.skip("not used yet")
 class TestCasync:
@@ -35,7 +41,8 @@ class TestCasync:
     # Create casync files
     cls.manifest_fn = os.path.join(cls.tmpdir.name, 'orig.caibx')
     cls.store_fn = os.path.join(cls.tmpdir.name, 'store')
-    subprocess.check_output(["casync", "make", "--compression=xz", "--store", cls.store_fn, cls.manifest_fn, cls.orig_fn])
+    with open(cls.orig_fn, 'rb') as f:
+      casync.make(f, cls.manifest_fn, cls.store_fn, CHUNK_SIZE)
 
     target = casync.parse_caibx(cls.manifest_fn)
     hashes = [c.sha.hex() for c in target]
@@ -188,7 +195,8 @@ class TestCasyncDirectory:
     cls.orig_fn = os.path.join(cls.tmpdir.name, 'orig.tar')
     tar.create_tar_archive(cls.orig_fn, pathlib.Path(cls.directory_to_extract.name))
 
-    subprocess.check_output(["casync", "make", "--compression=xz", "--store", cls.store_fn, cls.manifest_fn, cls.orig_fn])
+    with open(cls.orig_fn, 'rb') as f:
+      casync.make(f, cls.manifest_fn, cls.store_fn, CHUNK_SIZE)
 
   @classmethod
   def teardown_class(cls):
@@ -262,3 +270,179 @@ class TestCasyncDirectory:
     assert stats['remote'] > 0
     assert stats['cache'] > 0
     assert stats['cache'] > stats['remote']
+
+
+class TestChunker:
+  AVG_SIZE = 16 * 1024
+
+  @pytest.fixture
+  def contents(self):
+    # a repeated block, so some chunks are reused, and enough data to span several hash blocks
+    block = os.urandom(256 * 1024)
+    return block + os.urandom(casync.CHUNKER_HASH_BLOCK * 2) + block + b"\0" * (256 * 1024)
+
+  def make(self, tmp_path, contents, compression="xz"):
+    caibx_fn, store_fn = str(tmp_path / "orig.caibx"), str(tmp_path / "store")
+    chunks = casync.make(io.BytesIO(contents), caibx_fn, store_fn, self.AVG_SIZE, compression)
+    return chunks, caibx_fn, store_fn
+
+  def test_caibx_round_trip(self, tmp_path, contents):
+    chunks, caibx_fn, _ = self.make(tmp_path, contents, "zstd")
+    assert casync.parse_caibx(caibx_fn) == chunks
+
+    # chunks are consecutive, cover the whole file and are named by their hash
+    assert chunks[0].offset == 0
+    assert all(a.offset + a.length == b.offset for a, b in itertools.pairwise(chunks))
+    assert chunks[-1].offset + chunks[-1].length == len(contents)
+    for c in chunks:
+      assert c.sha == SHA512.new(contents[c.offset:c.offset + c.length], truncate="256").digest()
+
+    hashes = [c.sha for c in chunks]
+    assert len(hashes) > len(set(hashes))
+
+  def test_chunk_sizes(self, tmp_path, contents):
+    chunks, _, _ = self.make(tmp_path, contents, "zstd")
+    chunker = casync.Chunker(self.AVG_SIZE)
+    assert all(chunker.min_size <= c.length <= chunker.max_size for c in chunks[:-1])
+    assert 0 < chunks[-1].length <= chunker.max_size
+
+    # there are no boundaries in a run of zeroes, so it's cut at the max size
+    assert any(c.length == chunker.max_size for c in chunks)
+
+  @pytest.mark.parametrize("write_size", [4096 + 1, 100_000, casync.CHUNKER_HASH_BLOCK + 7])
+  def test_write_sizes(self, tmp_path, contents, write_size):
+    expected, _, _ = self.make(tmp_path, contents, "zstd")
+
+    with casync.ChunkStoreWriter(str(tmp_path / "store2"), self.AVG_SIZE, "zstd") as writer:
+      for i in range(0, len(contents), write_size):
+        writer.write(contents[i:i + write_size])
+    assert writer.chunks == expected
+
+  def test_content_defined(self, tmp_path, contents):
+    chunks, _, _ = self.make(tmp_path, contents, "zstd")
+    shifted, _, _ = self.make(tmp_path, os.urandom(100) + contents, "zstd")
+
+    # inserting data only changes the chunks around it
+    assert len({c.sha for c in chunks} - {c.sha for c in shifted}) <= 2
+
+  def test_buzhash(self):
+    # casync's definition: the hash of a window, then updated one byte at a time, rotations are mod 32
+    def rol(v, n):
+      n %= 32
+      return ((v << n) | (v >> (32 - n))) & 0xffffffff
+    table = [int(v) for v in casync.BUZHASH_TABLE]
+    # casync's table, which balances every bit
+    assert table[:2] == [0x458be752, 0xc10748cc] and len(set(table)) == 256
+    assert all(sum((v >> bit) & 1 for v in table) == 128 for bit in range(32))
+    data = os.urandom(1000)
+    w = casync.CHUNKER_WINDOW_SIZE
+
+    h = 0
+    for i, b in enumerate(data[:w]):
+      h ^= rol(table[b], w - i - 1)
+    expected = [h]
+    for i in range(w, len(data)):
+      h = rol(h, 1) ^ rol(table[data[i - w]], w) ^ table[data[i]]
+      expected.append(h)
+    assert casync.buzhash_windows(casync.BUZHASH_TABLE[np.frombuffer(data, dtype=np.uint8)]).tolist() == expected
+
+  def test_discriminator(self):
+    assert casync.Chunker(64 * 1024).discriminator == 49535
+
+    # casync's fit is negative for large chunks, so they're all cut at the max size, like casync does
+    chunker = casync.Chunker(16 * 1024 * 1024)
+    assert chunker.discriminator < 0
+    chunker.feed(os.urandom(casync.CHUNKER_HASH_BLOCK * 2))
+    assert len(chunker.boundaries) == 0
+
+  @pytest.mark.parametrize("compression, magic", [("xz", b"\xfd7zXZ\x00"), ("zstd", casync.ZSTD_MAGIC)])
+  def test_store_round_trip(self, tmp_path, contents, compression, magic):
+    chunks, caibx_fn, store_fn = self.make(tmp_path, contents, compression)
+    for c in chunks:
+      with open(os.path.join(store_fn, c.sha.hex()[:4], c.sha.hex() + ".cacnk"), "rb") as f:
+        assert f.read().startswith(magic)
+
+    target = casync.parse_caibx(caibx_fn)
+    sources = [('remote', casync.RemoteChunkReader(store_fn), casync.build_chunk_dict(target))]
+    out_fn = str(tmp_path / "out.bin")
+    stats = casync.extract(target, sources, out_fn)
+
+    with open(out_fn, "rb") as f:
+      assert f.read() == contents
+    assert stats['remote'] == len(contents)
+
+
+class CountingChunkReader(casync.RemoteChunkReader):
+  def __init__(self, url: str) -> None:
+    super().__init__(url)
+    self.reads: collections.Counter[bytes] = collections.Counter()
+
+  def read(self, chunk: casync.Chunk) -> bytes:
+    self.reads[chunk.sha] += 1
+    return super().read(chunk)
+
+
+class TestExtract:
+  def make_store(self, tmp_path, contents):
+    caibx_fn, store_fn = str(tmp_path / "orig.caibx"), str(tmp_path / "store")
+    casync.make(io.BytesIO(contents), caibx_fn, store_fn, 16 * 1024, "zstd")
+    return casync.parse_caibx(caibx_fn), store_fn
+
+  def test_reuse_downloaded(self, tmp_path):
+    block = os.urandom(256 * 1024)
+    contents = block + os.urandom(512 * 1024) + block
+    target, store_fn = self.make_store(tmp_path, contents)
+    out_fn = str(tmp_path / "out.bin")
+    open(out_fn, "wb").close()
+
+    remote = CountingChunkReader(store_fn)
+    sources = [('target', casync.FileChunkReader(out_fn), casync.build_chunk_dict(target))]
+    sources += [('remote', remote, casync.build_chunk_dict(target))]
+    stats = casync.extract(target, sources, out_fn)
+
+    with open(out_fn, "rb") as f:
+      assert f.read() == contents
+
+    # reused chunks are downloaded once, then copied from where they were written
+    first = casync.build_chunk_dict(target)
+    assert len(first) < len(target)
+    assert remote.reads == collections.Counter(first.keys())
+    assert stats['remote'] == sum(c.length for c in first.values())
+    assert stats['target'] == len(contents) - stats['remote']
+
+  def test_in_place(self, tmp_path):
+    contents = os.urandom(1024 * 1024)
+    target, store_fn = self.make_store(tmp_path, contents)
+    out_fn = str(tmp_path / "out.bin")
+    with open(out_fn, "wb") as f:
+      f.write(contents)
+    os.utime(out_fn, ns=(0, 0))
+
+    remote = CountingChunkReader(store_fn)
+    sources = [('target', casync.FileChunkReader(out_fn), casync.build_chunk_dict(target))]
+    sources += [('remote', remote, casync.build_chunk_dict(target))]
+    stats = casync.extract(target, sources, out_fn)
+
+    # chunks already in place aren't downloaded or written again
+    assert not remote.reads
+    assert os.stat(out_fn).st_mtime_ns == 0
+    assert stats['target'] == len(contents)
+    with open(out_fn, "rb") as f:
+      assert f.read() == contents
+
+  def test_find_chunks_in_place(self, tmp_path):
+    contents = os.urandom(1024 * 1024)
+    target, _ = self.make_store(tmp_path, contents)
+    assert len(target) > 8
+
+    # a target with a changed chunk, and cut off partway through a later chunk
+    changed, cut = target[2], target[-3]
+    partial = bytearray(contents[:cut.offset + cut.length // 2])
+    partial[changed.offset] ^= 0xff
+    out_fn = str(tmp_path / "out.bin")
+    with open(out_fn, "wb") as f:
+      f.write(partial)
+
+    in_place = casync.find_chunks_in_place(out_fn, target, workers=4)
+    assert in_place == [c for c in target[:-3] if c != changed]
+    assert casync.find_chunks_in_place(str(tmp_path / "missing.bin"), target) == []
@@ -0,0 +1,231 @@
+import atexit
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.hardware.hw import Paths
+
+# Byte budget of the download cache, least recently used chunks are evicted past it
+DEFAULT_MAX_BYTES = 20 * 1024**3
+INDEX_FN = "index.sqlite3"
+# cache hits are written to the index after this many hits or seconds
+FLUSH_ACCESSES = 100
+FLUSH_INTERVAL = 5.
+
+
+def get_max_bytes() -> int:
+  return int(os.environ.get("FILEREADER_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+
+class DownloadCache:
+  """
+    Size-bounded cache of downloaded file chunks under Paths.download_cache_root().
+
+    Chunks are stored as files, and a SQLite index next to them tracks the url, size and last access
+    of every chunk, plus hit/miss stats. The index is shared by all processes using the same cache
+    root, and the least recently used chunks are evicted once the cache grows past max_bytes.
+    Cache hits are recorded in memory and written to the index in batches.
+  """
+  _instances: dict[str, 'DownloadCache'] = {}
+
+  @staticmethod
+  def reset() -> None:
+    DownloadCache._instances = {}
+
+  @staticmethod
+  def close_all() -> None:
+    """Writes the pending hits of every instance to its index, called at exit"""
+    for cache in DownloadCache._instances.values():
+      # the cache root may be gone by now, e.g. removed by OpenpilotPrefix
+      with contextlib.suppress(sqlite3.Error):
+        cache.close()
+    DownloadCache.reset()
+
+  @staticmethod
+  def instance() -> 'DownloadCache':
+    root = Paths.download_cache_root()
+    # the cache root may have been wiped, e.g. by OpenpilotPrefix
+    if root not in DownloadCache._instances:
+      DownloadCache._instances[root] = DownloadCache(root)
+    elif not os.path.exists(os.path.join(root, INDEX_FN)):
+      DownloadCache._instances[root].reopen()
+    return DownloadCache._instances[root]
+
+  def __init__(self, root: str, max_bytes: int | None = None):
+    self.root = root
+    self.max_bytes = max_bytes if max_bytes is not None else get_max_bytes()
+    os.makedirs(root, exist_ok=True)
+
+    # hits not written to the index yet
+    self._accessed: dict[str, float] = {}
+    self._pending_stats: dict[str, int] = {}
+    self._last_flush = time.monotonic()
+
+    # one connection per process, shared by URLFile's download threads
+    self._lock = threading.Lock()
+    with self._lock:
+      self._connect()
+
+  def _connect(self) -> None:
+    os.makedirs(self.root, exist_ok=True)
+    self._db = sqlite3.connect(os.path.join(self.root, INDEX_FN), timeout=60, isolation_level=None, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    with self._transaction():
+      self._db.execute("CREATE TABLE IF NOT EXISTS chunks (name TEXT PRIMARY KEY, url TEXT, size INTEGER, last_access REAL)")
+      self._db.execute("CREATE INDEX IF NOT EXISTS chunks_last_access ON chunks (last_access)")
+      self._db.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)")
+
+      # the total size is kept up to date by triggers, so no one has to sum up the whole table
+      self._db.execute("INSERT OR IGNORE INTO stats SELECT 'size', COALESCE(SUM(size), 0) FROM chunks")
+      self._db.execute("""CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+                            UPDATE stats SET value = value + new.size WHERE key = 'size'; END""")
+      self._db.execute("""CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+                            UPDATE stats SET value = value - old.size WHERE key = 'size'; END""")
+      self._db.execute("""CREATE TRIGGER IF NOT EXISTS chunks_update AFTER UPDATE OF size ON chunks BEGIN
+                            UPDATE stats SET value = value - old.size + new.size WHERE key = 'size'; END""")
+
+  def reopen(self) -> None:
+    """Opens a new index after the cache root was removed, e.g. by OpenpilotPrefix"""
+    with self._lock:
+      self._db.close()
+      self._accessed.clear()
+      self._pending_stats.clear()
+      self._connect()
+
+  def close(self) -> None:
+    with self._lock:
+      self._flush()
+      self._db.close()
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    self._db.execute("BEGIN IMMEDIATE")
+    try:
+      yield
+      self._db.execute("COMMIT")
+    except BaseException:
+      self._db.execute("ROLLBACK")
+      raise
+
+  def _path(self, name: str) -> str:
+    return os.path.join(self.root, name)
+
+  def _count(self, key: str, value: int) -> None:
+    self._pending_stats[key] = self._pending_stats.get(key, 0) + value
+
+  def _index(self, name: str, url: str, size: int) -> None:
+    self._db.execute("INSERT INTO chunks VALUES (?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET url = excluded.url, size = excluded.size, " +
+                     "last_access = excluded.last_access", (name, url, size, time.time()))
+
+  def _flush(self) -> None:
+    if len(self._accessed) or len(self._pending_stats):
+      with self._transaction():
+        self._db.executemany("UPDATE chunks SET last_access = ? WHERE name = ?", [(t, name) for name, t in self._accessed.items()])
+        self._db.executemany("INSERT INTO stats VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                             list(self._pending_stats.items()))
+      self._accessed.clear()
+      self._pending_stats.clear()
+    self._last_flush = time.monotonic()
+
+  def _maybe_flush(self) -> None:
+    if len(self._accessed) >= FLUSH_ACCESSES or time.monotonic() - self._last_flush > FLUSH_INTERVAL:
+      self._flush()
+
+  def get(self, name: str, url: str = "") -> bytes | None:
+    path = self._path(name)
+    try:
+      with open(path, "rb") as f:
+        data = f.read()
+    except FileNotFoundError:
+      data = None
+
+    with self._lock:
+      row = self._db.execute("SELECT size FROM chunks WHERE name = ?", (name,)).fetchone()
+      if row is not None and (data is None or row[0] != len(data)):
+        # deleted outside of the cache, truncated or overwritten chunk, drop it and download again
+        with self._transaction():
+          self._db.execute("DELETE FROM chunks WHERE name = ?", (name,))
+          if data is not None:
+            self._remove(name)
+        data = None
+
+      if data is None:
+        self._count("misses", 1)
+        self._maybe_flush()
+        return None
+
+      if row is None:
+        # chunk written before the index existed, or by a process that died before indexing it.
+        # evictions remove files within their transaction, so only index it if it wasn't evicted meanwhile
+        with self._transaction():
+          if not os.path.exists(path):
+            self._count("misses", 1)
+            return None
+          self._index(name, url, len(data))
+      else:
+        self._accessed[name] = time.time()
+      self._count("hits", 1)
+      self._count("bytes_saved", len(data))
+      self._maybe_flush()
+    return data
+
+  def put(self, name: str, url: str, data: bytes) -> None:
+    with atomic_write_in_dir(self._path(name), mode="wb", overwrite=True) as f:
+      f.write(data)
+
+    with self._lock:
+      self._index(name, url, len(data))
+      self._evict()
+
+  def _evict(self) -> None:
+    if self.size() <= self.max_bytes:
+      return
+
+    # recent hits count towards the LRU order
+    self._flush()
+    with self._transaction():
+      total = self.size()
+      evicted = []
+      for name, size in self._db.execute("SELECT name, size FROM chunks ORDER BY last_access"):
+        if total <= self.max_bytes:
+          break
+        evicted.append(name)
+        total -= size
+      self._db.executemany("DELETE FROM chunks WHERE name = ?", [(name,) for name in evicted])
+
+      # readers of an evicted chunk will see it missing and download it again
+      for name in evicted:
+        self._accessed.pop(name, None)
+        self._remove(name)
+
+  def _remove(self, name: str) -> None:
+    try:
+      os.remove(self._path(name))
+    except FileNotFoundError:
+      pass
+
+  def size(self) -> int:
+    row = self._db.execute("SELECT value FROM stats WHERE key = 'size'").fetchone()
+    return row[0] if row is not None else 0
+
+  def stats(self) -> dict[str, float]:
+    with self._lock:
+      self._flush()
+      stats = dict(self._db.execute("SELECT key, value FROM stats").fetchall())
+      hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+      return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "bytes_saved": stats.get("bytes_saved", 0),
+        "size": stats.get("size", 0),
+        "max_bytes": self.max_bytes,
+      }
+
+
+os.register_at_fork(after_in_child=DownloadCache.reset)
+atexit.register(DownloadCache.close_all)
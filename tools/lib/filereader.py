@@ -37,8 +37,8 @@ def file_exists(fn):
   return os.path.exists(fn)
 
 
-def FileReader(fn, debug=False):
+def FileReader(fn, debug=False, readahead=0):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
-    return URLFile(fn, debug=debug)
+    return URLFile(fn, debug=debug, readahead=readahead)
   return open(fn, "rb")
@@ -1,12 +1,19 @@
 import os
+import struct
 import subprocess
+import threading
 import json
-from collections.abc import Iterator
+from collections.abc import Callable, Iterable, Iterator
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
 
 import numpy as np
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import DownloadCache
 from openpilot.tools.lib.filereader import FileReader, resolve_name
 from openpilot.tools.lib.exceptions import DataUnreadableError
+from openpilot.tools.lib.url_file import CHUNK_SIZE, URLFile, hash_256
 from openpilot.tools.lib.vidindex import hevc_index
 
 
@@ -14,24 +21,50 @@ HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+VIDEO_INDEX_MAGIC = b"OPVIDX01"
+# chunks of the file fetched ahead of the decoder
+DECODE_READAHEAD = 2
+# memory budget of the decoded frames kept by a FrameReader
+DEFAULT_CACHE_BYTES = 512 * 1024**2
+
 
 class LRUCache:
-  def __init__(self, capacity: int):
+  """
+    LRU cache holding up to capacity worth of values, as measured by sizeof (one per value by default).
+    A capacity of None means unbounded.
+  """
+  def __init__(self, capacity: int | None, sizeof: Callable[[Any], int] | None = None):
     self._cache: OrderedDict = OrderedDict()
+    self._sizes: dict = {}
     self.capacity = capacity
+    self.sizeof = sizeof
+    self.size = 0
 
   def __getitem__(self, key):
     self._cache.move_to_end(key)
     return self._cache[key]
 
   def __setitem__(self, key, value):
+    if key in self._cache:
+      del self._cache[key]
+      self.size -= self._sizes.pop(key)
     self._cache[key] = value
-    if len(self._cache) > self.capacity:
-        self._cache.popitem(last=False)
+    self._sizes[key] = self.sizeof(value) if self.sizeof is not None else 1
+    self.size += self._sizes[key]
+    # the newest value is always kept, even if it's over capacity on its own
+    while self.capacity is not None and self.size > self.capacity and len(self._cache) > 1:
+      key, _ = self._cache.popitem(last=False)
+      self.size -= self._sizes.pop(key)
 
   def __contains__(self, key):
     return key in self._cache
 
+  def __len__(self):
+    return len(self._cache)
+
+
+def frames_nbytes(frames: list[np.ndarray]) -> int:
+  return sum(f.nbytes for f in frames)
 
 def assert_hvec(fn: str) -> None:
   with FileReader(fn) as f:
@@ -42,9 +75,9 @@ def assert_hvec(fn: str) -> None:
     if 'hevc' not in fn:
       raise NotImplementedError(fn)
 
-def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.ndarray:
+def ffmpeg_decode_args(pix_fmt="rgb24", vid_fmt='hevc') -> list[str]:
   threads = os.getenv("FFMPEG_THREADS", "0")
-  args = ["ffmpeg", "-v", "quiet",
+  return ["ffmpeg", "-v", "quiet",
           "-threads", threads,
           "-c:v", "hevc",
           "-vsync", "0",
@@ -54,15 +87,18 @@ def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.n
           "-f", "rawvideo",
           "-pix_fmt", pix_fmt,
           "-"]
-  dat = subprocess.check_output(args, input=rawdat)
 
+def frame_shape(w: int, h: int, pix_fmt: str) -> tuple[int, ...]:
   if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
+    return (h, w, 3)
   elif pix_fmt in ["nv12", "yuv420p"]:
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  else:
-    raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
-  return ret
+    return (h*w*3//2, )
+  raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
+
+def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.ndarray:
+  shape = frame_shape(w, h, pix_fmt)
+  dat = subprocess.check_output(ffmpeg_decode_args(pix_fmt, vid_fmt), input=rawdat)
+  return np.frombuffer(dat, dtype=np.uint8).reshape(-1, *shape)
 
 def ffprobe(fn, fmt=None):
   fn = resolve_name(fn)
@@ -86,17 +122,140 @@ def get_index_data(fn: str, index_data: dict|None = None):
   stream = index_data["probe"]["streams"][0]
   return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
 
-def get_video_index(fn):
+def video_index_path(fn: str) -> str:
+  # the index is only valid for this exact file, so key it on the size (and mtime of local files) too
+  fn = resolve_name(fn)
+  if fn.startswith(("http://", "https://")):
+    key = f"{fn.split('?')[0]}:{URLFile(fn).get_length()}"
+  else:
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return os.path.join(Paths.download_cache_root(), hash_256(key) + "_vidindex")
+
+def serialize_video_index(index_data: dict) -> bytes:
+  index = np.ascontiguousarray(index_data['index'], dtype=np.uint32)
+  prefix = index_data['global_prefix']
+  probe = json.dumps(index_data['probe']).encode()
+  header = VIDEO_INDEX_MAGIC + struct.pack("<III", len(index), len(prefix), len(probe))
+  return header + index.tobytes() + prefix + probe
+
+def deserialize_video_index(dat: bytes) -> dict:
+  if not dat.startswith(VIDEO_INDEX_MAGIC):
+    raise ValueError("not a video index")
+  pos = len(VIDEO_INDEX_MAGIC)
+  index_len, prefix_len, probe_len = struct.unpack_from("<III", dat, pos)
+  pos += 12
+  index = np.frombuffer(dat, dtype=np.uint32, count=2 * index_len, offset=pos).reshape(index_len, 2)
+  pos += index.nbytes
+  prefix = dat[pos:pos + prefix_len]
+  pos += prefix_len
+  probe = json.loads(dat[pos:pos + probe_len])
+  return {
+    'index': index,
+    'global_prefix': prefix,
+    'probe': probe
+  }
+
+def get_video_index(fn, cache=True):
+  if cache:
+    # indexes live in the download cache, so they're evicted along with the downloaded chunks
+    download_cache = DownloadCache.instance()
+    name = os.path.basename(video_index_path(fn))
+    dat = download_cache.get(name, fn)
+    if dat is not None:
+      try:
+        return deserialize_video_index(dat)
+      except ValueError:
+        pass
+
   assert_hvec(fn)
   frame_types, dat_len, prefix = hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
   probe = ffprobe(fn, "hevc")
-  return {
+  index_data = {
     'index': index,
     'global_prefix': prefix,
     'probe': probe
   }
 
+  if cache:
+    download_cache.put(name, fn, serialize_video_index(index_data))
+  return index_data
+
+
+class FfmpegDecodeSession:
+  """
+    A single ffmpeg process decoding the byte range [start, end) of a video file.
+
+    The file is streamed into ffmpeg's stdin from a writer thread, and decoded frames are read
+    from its stdout as soon as they are ready, so decoding many GOPs only starts one process.
+  """
+  def __init__(self, fn: str, prefix: bytes, start: int, end: int, w: int, h: int, pix_fmt: str = "rgb24"):
+    self.shape = frame_shape(w, h, pix_fmt)
+    self.proc = subprocess.Popen(ffmpeg_decode_args(pix_fmt), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    self._closed = False
+    # raised from read_frame, so a failed read doesn't look like the end of the video
+    self._error: BaseException | None = None
+    self._writer = threading.Thread(target=self._write, args=(fn, prefix, start, end), daemon=True)
+    self._writer.start()
+
+  def _write(self, fn: str, prefix: bytes, start: int, end: int) -> None:
+    assert self.proc.stdin is not None
+    try:
+      self.proc.stdin.write(prefix)
+      with FileReader(fn, readahead=DECODE_READAHEAD) as f:
+        f.seek(start)
+        while start < end:
+          dat = f.read(min(CHUNK_SIZE, end - start))
+          if not dat:
+            raise DataUnreadableError(f"{fn} ended at byte {start}, expected {end}")
+          self.proc.stdin.write(dat)
+          start += len(dat)
+    except (BrokenPipeError, ValueError) as e:
+      # ffmpeg exited, which read_frame notices, or the session was closed
+      if not self._closed and not isinstance(e, BrokenPipeError):
+        self._error = e
+    except Exception as e:
+      self._error = e
+    finally:
+      try:
+        self.proc.stdin.close()
+      except BrokenPipeError:
+        pass
+
+  def read_frame(self) -> np.ndarray | None:
+    """The next decoded frame, or None once all of them were read"""
+    assert self.proc.stdout is not None
+    frame = np.empty(self.shape, dtype=np.uint8)
+    buf = memoryview(frame).cast("B")
+    pos = 0
+    while pos < len(buf):
+      n = self.proc.stdout.readinto(buf[pos:])
+      if not n:
+        self._writer.join()
+        if self._error is not None:
+          raise self._error
+        elif pos > 0:
+          raise DataUnreadableError(f"ffmpeg output ended in the middle of a frame ({pos} of {len(buf)} bytes)")
+        return None
+      pos += n
+    return frame
+
+  def close(self) -> None:
+    self._closed = True
+    if self.proc.poll() is None:
+      self.proc.kill()
+    self.proc.wait()
+    self._writer.join()
+    if self.proc.stdout is not None:
+      self.proc.stdout.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
 
 class FfmpegDecoder:
   def __init__(self, fn: str, index_data: dict|None = None,
@@ -125,20 +284,18 @@ class FfmpegDecoder:
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
                    frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
     end_fidx = end_fidx or self.frame_count
-    fidx = start_fidx
-    while fidx < end_fidx:
-      f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
-      # number of frames to discard inside this GOP before the wanted one
-      for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt)):
-        fidx = f_b + i
-        if fidx >= end_fidx:
-          return
-        elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
+    if start_fidx >= end_fidx:
+      return
+    # decode everything from the GOP of the first frame up to the end of the GOP of the last one in one go
+    f_b, _, off_b, _ = self._gop_bounds(start_fidx)
+    _, _, _, off_e = self._gop_bounds(end_fidx - 1)
+    with FfmpegDecodeSession(self.fn, self.prefix, int(off_b), int(off_e), self.w, self.h, self.pix_fmt) as session:
+      for fidx in range(f_b, end_fidx):
+        frm = session.read_frame()
+        if frm is None:
+          raise DataUnreadableError(f"{self.fn}: decoding ended at frame {fidx}, expected {end_fidx} frames")
+        if fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
           yield fidx, frm
-      fidx += 1
 
 def FrameIterator(fn: str, index_data: dict|None=None,
                         pix_fmt: str = "rgb24",
@@ -148,25 +305,133 @@ def FrameIterator(fn: str, index_data: dict|None=None,
     yield frame
 
 class FrameReader:
+  """
+    Random access to the frames of a video.
+
+    Frames are decoded a whole GOP at a time, and the most recently used GOPs are cached up to
+    cache_bytes of decoded frames (None for no limit). With readahead, the next GOP is decoded in
+    the background while frames are read in order.
+  """
   def __init__(self, fn: str, index_data: dict|None = None,
-               cache_size: int = 30, pix_fmt: str = "rgb24"):
+               cache_bytes: int|None = DEFAULT_CACHE_BYTES, pix_fmt: str = "rgb24", readahead: bool = False):
     self.decoder = FfmpegDecoder(fn, index_data, pix_fmt)
     self.iframes = self.decoder.iframes
-    self._cache: LRUCache = LRUCache(cache_size)
+    self._cache: LRUCache = LRUCache(cache_bytes, sizeof=frames_nbytes)  # GOP start -> decoded frames of the GOP
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
     self.pix_fmt = pix_fmt
+    self.readahead = readahead
 
     self.it: Iterator[tuple[int, np.ndarray]] | None = None
-    self.fidx = -1
-
-  def get(self, fidx:int):
-    if fidx in self._cache:  # If frame is cached, return it
-      return self._cache[fidx]
-    read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
-      self.it = self.decoder.get_iterator(read_start)
-      self.fidx = -1
-    while self.fidx < fidx:
-      self.fidx, frame = next(self.it)
-      self._cache[self.fidx] = frame
-    return self._cache[fidx]
+    self.fidx = -1  # last frame read from self.it
+    self._last_get = -1
+    self._pool: ThreadPoolExecutor | None = None
+    self._prefetch: tuple[int, Future] | None = None
+
+  def __getstate__(self):
+    # decoding state doesn't survive pickling, only the cached frames do
+    state = self.__dict__.copy()
+    state.update(it=None, fidx=-1, _pool=None, _prefetch=None)
+    return state
+
+  def close(self) -> None:
+    if self._pool is not None:
+      self._pool.shutdown(wait=True, cancel_futures=True)
+      self._pool = None
+    self._prefetch = None
+    self.it = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _gop_end(self, gop_start: int) -> int:
+    i = np.searchsorted(self.iframes, gop_start, side="right")
+    return int(self.iframes[i]) if i < len(self.iframes) else self.frame_count
+
+  def _decode_gop(self, gop_start: int) -> list[np.ndarray]:
+    # keep streaming from the same decoder while GOPs are read in order
+    if self.it is None or self.fidx + 1 != gop_start:
+      self.it = self.decoder.get_iterator(gop_start)
+    gop_end = self._gop_end(gop_start)
+    frames = []
+    try:
+      for fidx, frame in self.it:
+        frames.append(frame)
+        self.fidx = fidx
+        if fidx + 1 >= gop_end:
+          break
+      else:
+        self.it = None
+    except BaseException:
+      self.it = None
+      raise
+
+    # a short GOP would be cached and break every later get() of its frames
+    if len(frames) != gop_end - gop_start:
+      self.it = None
+      raise DataUnreadableError(f"{self.decoder.fn}: decoded {len(frames)} of the {gop_end - gop_start} frames of the GOP at {gop_start}")
+    return frames
+
+  def _get_gop(self, gop_start: int) -> list[np.ndarray]:
+    if gop_start in self._cache:
+      return self._cache[gop_start]
+
+    prefetch = None
+    if self._prefetch is not None and self._prefetch[0] == gop_start:
+      prefetch = self._prefetch[1]
+      self._prefetch = None
+
+    if prefetch is not None and prefetch.exception() is None:
+      frames = prefetch.result()
+    elif self._pool is not None:
+      # decoding is done on the pool while it exists, so it never races with a prefetch
+      frames = self._pool.submit(self._decode_gop, gop_start).result()
+    else:
+      frames = self._decode_gop(gop_start)
+    self._cache[gop_start] = frames
+    return frames
+
+  def _start_prefetch(self, gop_start: int) -> None:
+    if gop_start >= self.frame_count or gop_start in self._cache:
+      return
+    if self._prefetch is not None:
+      if not self._prefetch[1].done():
+        return
+      # the previous prefetch was never used, keep it around in case it is
+      prev_start, prev = self._prefetch
+      self._prefetch = None
+      try:
+        self._cache[prev_start] = prev.result()
+      except Exception:
+        # it isn't this get()'s error, drop the GOP so it's decoded again when it's needed
+        pass
+      if gop_start in self._cache:
+        return
+
+    if self._pool is None:
+      self._pool = ThreadPoolExecutor(max_workers=1)
+    self._prefetch = (gop_start, self._pool.submit(self._decode_gop, gop_start))
+
+  def get(self, fidx: int) -> np.ndarray:
+    gop_start = int(self.decoder.get_gop_start(fidx))
+    frames = self._get_gop(gop_start)
+    if self.readahead and fidx > self._last_get:
+      self._start_prefetch(self._gop_end(gop_start))
+    self._last_get = fidx
+    return frames[fidx - gop_start]
+
+  def get_many(self, fidxs: Iterable[int]) -> list[np.ndarray]:
+    """Get a batch of frames, decoding each GOP they're in once."""
+    fidxs = list(fidxs)
+    gops: dict[int, list[int]] = {}
+    for fidx in fidxs:
+      gops.setdefault(int(self.decoder.get_gop_start(fidx)), []).append(fidx)
+
+    frames = {}
+    for gop_start in sorted(gops):
+      gop = self._get_gop(gop_start)
+      for fidx in gops[gop_start]:
+        frames[fidx] = gop[fidx - gop_start]
+    return [frames[fidx] for fidx in fidxs]
@@ -1,78 +1,354 @@
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+
 import numpy as np
 
+from cereal import log as capnp_log
+
+NUMPY_TYPES = {
+  'bool': np.bool_,
+  'int8': np.int8,
+  'int16': np.int16,
+  'int32': np.int32,
+  'int64': np.int64,
+  'uint8': np.uint8,
+  'uint16': np.uint16,
+  'uint32': np.uint32,
+  'uint64': np.uint64,
+  'float32': np.float32,
+  'float64': np.float64,
+}
+# converter and missing value of the fields stored as strings or bytes
+OBJECT_TYPES = {
+  'text': (str, ''),
+  'data': (bytes, b''),
+  'enum': (str, ''),
+}
+
+# TODO: support these
+SKIPPED_SERVICES = ('qcomGnss', 'ubloxGnss')
+
+
+@dataclass
+class RaggedArray:
+  """
+    A column of variable length lists, stored as one flat array of values and
+    the offsets into it, so row i is values[offsets[i]:offsets[i + 1]].
+  """
+  values: np.ndarray
+  offsets: np.ndarray
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+  def take(self, order: np.ndarray) -> 'RaggedArray':
+    lengths = np.diff(self.offsets)[order]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    starts = self.offsets[:-1][order]
+    idxs = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return RaggedArray(self.values[idxs], offsets)
+
+  def to_array(self) -> np.ndarray:
+    """2D array if all rows have the same length, object array of rows otherwise."""
+    lengths = np.diff(self.offsets)
+    if len(lengths) and np.all(lengths == lengths[0]):
+      return self.values.reshape(len(lengths), lengths[0])
+    arr = np.empty(len(lengths), dtype=object)
+    for i in range(len(lengths)):
+      arr[i] = self[i]
+    return arr
+
+
+class _Column:
+  """Growable, preallocated numpy column."""
+  def __init__(self, dtype, capacity=64):
+    self.data = np.empty(capacity, dtype=dtype)
+    self.size = 0
+
+  def _reserve(self, n):
+    if self.size + n > len(self.data):
+      self.data = np.resize(self.data, max(2 * len(self.data), self.size + n))
+
+  def append(self, v):
+    self._reserve(1)
+    self.data[self.size] = v
+    self.size += 1
+
+  def extend(self, values):
+    n = len(values)
+    self._reserve(n)
+    self.data[self.size:self.size + n] = values
+    self.size += n
+
+  def finish(self) -> np.ndarray:
+    return self.data[:self.size]
+
+
+class _ObjectColumn:
+  def __init__(self, convert: Callable):
+    self.data: list = []
+    self.convert = convert
+
+  def append(self, v):
+    self.data.append(self.convert(v))
 
-def flatten_type_dict(d, sep="/", prefix=None):
-  res = {}
-  if isinstance(d, dict):
-    for key, val in d.items():
-      if prefix is None:
-        res.update(flatten_type_dict(val, prefix=key))
+  def extend(self, values):
+    self.data.extend(self.convert(v) for v in values)
+
+  def finish(self) -> np.ndarray:
+    if self.convert is not _to_python:
+      # text and enums become <U arrays, data S arrays
+      return np.array(self.data)
+    # nested structs and lists stay python objects, one per row
+    arr = np.empty(len(self.data), dtype=object)
+    for i, v in enumerate(self.data):
+      arr[i] = v
+    return arr
+
+
+def _to_python(v):
+  if hasattr(v, 'to_dict'):
+    return v.to_dict(verbose=True)
+  elif isinstance(v, (str, bytes)):
+    return v
+  elif hasattr(v, '__len__'):
+    return [_to_python(x) for x in v]
+  return v
+
+
+class _Leaf:
+  def __init__(self, column, missing):
+    self.column = column
+    self.missing = missing
+
+  def add(self, v):
+    self.column.append(v)
+
+  def add_missing(self):
+    self.column.append(self.missing)
+
+  def finish(self):
+    return self.column.finish()
+
+
+class _ListLeaf:
+  def __init__(self, values):
+    self.values = values
+    self.offsets = _Column(np.int64)
+    self.offsets.append(0)
+
+  def add(self, v):
+    # numeric lists are copied in one go instead of element by element
+    if isinstance(self.values, _Column):
+      v = np.array(v, dtype=self.values.data.dtype)
+    self.values.extend(v)
+    self.offsets.append(self.offsets.data[self.offsets.size - 1] + len(v))
+
+  def add_missing(self):
+    self.offsets.append(self.offsets.data[self.offsets.size - 1])
+
+  def finish(self):
+    return RaggedArray(self.values.finish(), self.offsets.finish())
+
+
+class _StructNode:
+  def __init__(self, children: list[tuple[str, bool, object]]):
+    # (field name, is union member, node)
+    self.children = children
+
+  def add(self, reader):
+    which = None
+    for name, in_union, node in self.children:
+      if in_union:
+        if which is None:
+          which = reader.which()
+        if which != name:
+          node.add_missing()
+          continue
+      node.add(getattr(reader, name))
+
+  def add_missing(self):
+    for _, _, node in self.children:
+      node.add_missing()
+
+  def leaves(self, prefix):
+    for name, _, node in self.children:
+      path = name if prefix is None else prefix + "/" + name
+      if isinstance(node, _StructNode):
+        yield from node.leaves(path)
       else:
-        res.update(flatten_type_dict(val, prefix=prefix + sep + key))
-    return res
-  elif isinstance(d, list):
-    return {prefix: np.array(d)}
-  else:
-    return {prefix: d}
-
-
-def get_message_dict(message, typ):
-  valid = message.valid
-  message = message._get(typ)
-  if not hasattr(message, 'to_dict') or typ in ('qcomGnss', 'ubloxGnss'):
-    # TODO: support these
-    #print("skipping", typ)
-    return
-
-  msg_dict = message.to_dict(verbose=True)
-  msg_dict = flatten_type_dict(msg_dict)
-  msg_dict['_valid'] = valid
-  return msg_dict
-
-
-def append_dict(path, t, d, values):
-  if path not in values:
-    group = {}
-    group["t"] = []
-    for k in d:
-      group[k] = []
-    values[path] = group
-  else:
-    group = values[path]
-
-  group["t"].append(t)
-  for k, v in d.items():
-    group[k].append(v)
-
-
-def potentially_ragged_array(arr, dtype=None, **kwargs):
-  # TODO: is there a better way to detect inhomogeneous shapes?
-  try:
-    return np.array(arr, dtype=dtype, **kwargs)
-  except ValueError:
-    return np.array(arr, dtype=object, **kwargs)
-
-def msgs_to_time_series(msgs):
+        yield path, node
+
+
+def _selected(path: str, fields: list[str] | None) -> bool:
+  if fields is None:
+    return True
+  # a field is selected if it's inside, or on the way to, one of the requested fields
+  return any(path == f or path.startswith(f + "/") or f.startswith(path + "/") for f in fields)
+
+
+def _compile_field(field, path: str, fields: list[str] | None):
+  if field.proto.which() == 'group':
+    return _compile_struct(field.schema, path, fields)
+
+  typ = field.proto.slot.type
+  which = typ.which()
+  if which == 'struct':
+    return _compile_struct(field.schema, path, fields)
+  elif which in NUMPY_TYPES:
+    dtype = NUMPY_TYPES[which]
+    return _Leaf(_Column(dtype), np.nan if which.startswith('float') else dtype(0))
+  elif which in OBJECT_TYPES:
+    convert, missing = OBJECT_TYPES[which]
+    return _Leaf(_ObjectColumn(convert), missing)
+  elif which == 'list':
+    elem = typ.list.elementType.which()
+    if elem in NUMPY_TYPES:
+      return _ListLeaf(_Column(NUMPY_TYPES[elem]))
+    return _ListLeaf(_ObjectColumn(OBJECT_TYPES[elem][0] if elem in OBJECT_TYPES else _to_python))
+  return None
+
+
+def _compile_struct(schema, prefix: str | None, fields: list[str] | None) -> _StructNode | None:
+  children = []
+  union_fields = set(schema.union_fields)
+  for name in schema.non_union_fields + schema.union_fields:
+    path = name if prefix is None else prefix + "/" + name
+    if not _selected(path, fields):
+      continue
+    node = _compile_field(schema.fields[name], path, fields)
+    if node is not None:
+      children.append((name, name in union_fields, node))
+  return _StructNode(children) if len(children) else None
+
+
+def is_supported_service(service: str) -> bool:
+  return service not in SKIPPED_SERVICES and capnp_log.Event.schema.fields[service].proto.slot.type.which() == 'struct'
+
+
+# the services msgs_to_columns outputs, events of other services are dropped
+SUPPORTED_SERVICES = [s for s in capnp_log.Event.schema.union_fields if is_supported_service(s)]
+
+
+def _compile_service(service: str, fields: list[str] | None) -> _StructNode | None:
+  if not is_supported_service(service):
+    return None
+  return _compile_struct(capnp_log.Event.schema.fields[service].schema, None, fields)
+
+
+def msgs_to_columns(msgs, services: Iterable[str] | None = None, fields: dict[str, list[str]] | None = None):
   """
-    Convert an iterable of canonical capnp messages into a dictionary of time series.
-    Each time series has a value with key "t" which consists of monotonically increasing timestamps
-    in seconds.
+    Convert an iterable of canonical capnp messages into a dictionary of columns per service.
+    The capnp schema of each service is walked once, and every field is written straight into a numpy column.
+    List fields are returned as RaggedArrays. Each service has a "t" column of monotonically increasing
+    timestamps in seconds, and a "_valid" column. Numeric columns keep the dtype of their schema field, e.g. float32.
+
+    services limits the output to those services, and fields maps a service to the field paths
+    (e.g. "cruiseState/speed") to extract from it. Services not in fields get all their fields.
   """
-  values = {}
+  services = set(services) if services is not None else None
+  fields = fields or {}
+
+  builders: dict[str, tuple[_StructNode, _Column, _Column] | None] = {}
   for msg in msgs:
     typ = msg.which()
+    if services is not None and typ not in services:
+      continue
+
+    if typ not in builders:
+      node = _compile_service(typ, fields.get(typ))
+      builders[typ] = None if node is None else (node, _Column(np.float64), _Column(np.bool_))
+    builder = builders[typ]
+    if builder is None:
+      continue
+
+    node, t, valid = builder
+    node.add(getattr(msg, typ))
+    t.append(msg.logMonoTime / 1.0e9)
+    valid.append(msg.valid)
+
+  values = {}
+  for typ, builder in builders.items():
+    if builder is None:
+      continue
+    node, t, valid = builder
+
+    # Sort values by time.
+    t = t.finish()
+    order = np.argsort(t, kind='stable')
+    group = {"t": t[order], "_valid": valid.finish()[order]}
+    for path, leaf in node.leaves(None):
+      col = leaf.finish()
+      group[path] = col.take(order) if isinstance(col, RaggedArray) else col[order]
+    values[typ] = group
+
+  return values
 
-    tm = msg.logMonoTime / 1.0e9
-    msg_dict = get_message_dict(msg, typ)
-    if msg_dict is not None:
-      append_dict(typ, tm, msg_dict, values)
 
-  # Sort values by time.
+def msgs_to_time_series(msgs, services: Iterable[str] | None = None, fields: dict[str, list[str]] | None = None):
+  """
+    Convert an iterable of canonical capnp messages into a dictionary of time series.
+    Each time series has a value with key "t" which consists of monotonically increasing timestamps
+    in seconds. List fields are 2D arrays, or object arrays if their length varies.
+    Like the python values they used to be built from, floats are float64 and integers int64.
+  """
+  values = msgs_to_columns(msgs, services, fields)
   for group in values.values():
-    order = np.argsort(group["t"])
-    for name, group_values in group.items():
-      group[name] = potentially_ragged_array(group_values)[order]
+    for name, col in group.items():
+      if isinstance(col, RaggedArray):
+        group[name] = RaggedArray(_widen(col.values), col.offsets).to_array()
+      else:
+        group[name] = _widen(col)
+  return values
+
+
+def _widen(arr: np.ndarray) -> np.ndarray:
+  if arr.dtype.kind == 'f':
+    return arr.astype(np.float64, copy=False)
+  elif arr.dtype.kind in 'iu':
+    # np.array only picks uint64 for values that don't fit in an int64
+    if arr.dtype == np.uint64 and len(arr) and arr.max() > np.iinfo(np.int64).max:
+      return arr
+    return arr.astype(np.int64, copy=False)
+  return arr
+
+
+def save_columns(fn: str, values) -> None:
+  """
+    Cache the output of msgs_to_columns to a .npz file. Columns of python objects (e.g. lists of structs)
+    are left out, so the file can be loaded without unpickling anything.
+  """
+  arrays = {}
+  for typ, group in values.items():
+    for name, col in group.items():
+      key = typ + "/" + name
+      if (col.values if isinstance(col, RaggedArray) else col).dtype == object:
+        continue
+      elif isinstance(col, RaggedArray):
+        arrays[key + ":values"] = col.values
+        arrays[key + ":offsets"] = col.offsets
+      else:
+        arrays[key] = col
+  np.savez(fn, **arrays)
 
+
+def load_columns(fn: str):
+  values: dict[str, dict] = {}
+  with np.load(fn) as dat:
+    for key in dat.files:
+      typ, name = key.split("/", 1)
+      group = values.setdefault(typ, {})
+      if name.endswith(":offsets"):
+        continue
+      elif name.endswith(":values"):
+        name = name.removesuffix(":values")
+        group[name] = RaggedArray(dat[key], dat[f"{typ}/{name}:offsets"])
+      else:
+        group[name] = dat[key]
   return values
 
 
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import bz2
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import cache, partial
 import multiprocessing
+import array
 import capnp
 import enum
+import itertools
 import os
 import pathlib
+import struct
 import sys
 import tqdm
 import urllib.parse
@@ -18,26 +23,46 @@ from urllib.parse import parse_qs, urlparse
 from cereal import log as capnp_log
 from openpilot.common.swaglog import cloudlog
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
+from openpilot.tools.lib.download_cache import DownloadCache
 from openpilot.tools.lib.openpilotci import get_url
-from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
+from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available, resolve_name
 from openpilot.tools.lib.route import Route, SegmentRange
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.log_time_series import SUPPORTED_SERVICES, msgs_to_time_series
+from openpilot.tools.lib.url_file import CHUNK_SIZE, hash_256
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
+# service (None for events without a valid union type), logMonoTime and the bytes of an event
+RawEvent = tuple[str | None, int, memoryview]
 
+# chunks to download in the background while a streamed segment is decoded
+STREAM_READAHEAD = 4
 
-def save_log(dest, log_msgs, compress=True):
-  dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
 
-  if compress and dest.endswith(".bz2"):
-    dat = bz2.compress(dat)
-  elif compress and dest.endswith(".zst"):
-    dat = zstd.compress(dat, 10)
+def _event_bytes(msg):
+  if isinstance(msg, tuple):
+    return msg[2]
+  if isinstance(msg, (bytes, bytearray, memoryview)):
+    return msg
+  return msg.as_builder().to_bytes()
 
+def save_log(dest, log_msgs, compress=True):
+  """
+    Writes events to dest, compressed according to its extension. Events can be capnp messages, the RawEvents
+    of LogReader.raw_events or the bytes of events, the last two are written as they are without being parsed.
+  """
   with open(dest, "wb") as f:
-    f.write(dat)
+    if compress and dest.endswith(".bz2"):
+      writer = bz2.BZ2File(f, "wb")
+    elif compress and dest.endswith(".zst"):
+      writer = zstd.ZstdCompressor(level=10).stream_writer(f, closefd=False)
+    else:
+      writer = contextlib.nullcontext(f)
+
+    with writer as w:
+      for msg in log_msgs:
+        w.write(_event_bytes(msg))
 
 def decompress_stream(data: bytes):
   dctx = zstd.ZstdDecompressor()
@@ -48,10 +73,210 @@ def decompress_stream(data: bytes):
 
   return decompressed_data
 
+def decompress_chunks(chunks: Iterable[bytes], ext: str | None = None) -> Iterator[bytes]:
+  """
+    Lazily decompress an iterable of raw file chunks, detecting bz2 and zstd the same way _LogFileReader does.
+    Only one input chunk and its decompressed output are held at a time.
+  """
+  chunks = iter(chunks)
+  first = next(chunks, b"")
+  chunks = itertools.chain([first], chunks)
+
+  if ext == ".bz2" or first.startswith(b'BZh9'):
+    new_decompressor = bz2.BZ2Decompressor
+  elif ext == ".zst" or first.startswith(b'\x28\xB5\x2F\xFD'):
+    new_decompressor = zstd.ZstdDecompressor().decompressobj
+  else:
+    yield from chunks
+    return
+
+  dctx = new_decompressor()
+  for chunk in chunks:
+    while chunk:
+      yield dctx.decompress(chunk)
+      if not dctx.eof:
+        break
+      # concatenated bz2 streams or zstd frames
+      chunk, dctx = dctx.unused_data, new_decompressor()
+
+def event_size(buf, pos: int = 0) -> int | None:
+  """
+    Size in bytes of the capnp message starting at pos, from its segment table.
+    Returns None if buf doesn't hold the whole message.
+  """
+  if len(buf) - pos < 4:
+    return None
+  num_segments = struct.unpack_from("<I", buf, pos)[0] + 1
+  header_size = (4 + 4 * num_segments + 7) & ~7
+  if len(buf) - pos < header_size:
+    return None
+  size = header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", buf, pos + 4))
+  if len(buf) - pos < size:
+    return None
+  return size
+
+_EVENT_STRUCT = capnp_log.Event.schema.node.struct
+_EVENT_DISCRIMINANT_OFFSET = _EVENT_STRUCT.discriminantOffset * 2
+_EVENT_MONO_TIME_OFFSET = capnp_log.Event.schema.fields['logMonoTime'].proto.slot.offset * 8
+_EVENT_SERVICES: dict[int, str] = {f.proto.discriminantValue: name for name, f in capnp_log.Event.schema.fields.items()
+                                   if name in capnp_log.Event.schema.union_fields}
+
+def raw_event_header(buf, pos: int = 0, size: int | None = None) -> tuple[str | None, int]:
+  """
+    Service and logMonoTime of the Event starting at pos, read straight from its root struct without parsing it.
+    The service is None if the union discriminant is out of range, like which() raising.
+  """
+  if size is None:
+    size = event_size(buf, pos)
+    if size is None:
+      raise ValueError("incomplete event")
+
+  num_segments, segment_words = struct.unpack_from("<II", buf, pos)
+  segment = pos + ((8 + 4 * num_segments + 7) & ~7)
+  ptr = struct.unpack_from("<Q", buf, segment)[0]
+  # a struct pointer: 30 bit signed offset in words after the pointer, then the data and pointer section sizes
+  offset = ((ptr & 0xFFFFFFFF) >> 2) - ((ptr & 0x80000000) >> 1)
+  data = segment + 8 + offset * 8
+  data_size = ((ptr >> 32) & 0xFFFF) * 8
+  if ptr & 3 != 0 or data < segment or data + data_size > segment + segment_words * 8:
+    # far pointers and broken messages are left to capnp
+    with capnp_log.Event.from_bytes(buf[pos:pos + size]) as ent:
+      try:
+        return ent.which(), ent.logMonoTime
+      except capnp.KjException:
+        return None, ent.logMonoTime
+
+  # fields past the end of the data section have their default value, 0
+  mono_time = struct.unpack_from("<Q", buf, data + _EVENT_MONO_TIME_OFFSET)[0] if data_size >= _EVENT_MONO_TIME_OFFSET + 8 else 0
+  discriminant = struct.unpack_from("<H", buf, data + _EVENT_DISCRIMINANT_OFFSET)[0] if data_size >= _EVENT_DISCRIMINANT_OFFSET + 2 else 0
+  return _EVENT_SERVICES.get(discriminant), mono_time
+
+def split_events(chunks: Iterable[bytes]) -> Iterator[bytes]:
+  """
+    Split a stream of decompressed log chunks into the bytes of individual capnp messages.
+  """
+  buf = bytearray()
+  for chunk in chunks:
+    buf += chunk
+    pos = 0
+    while (size := event_size(buf, pos)) is not None:
+      yield bytes(buf[pos:pos + size])
+      pos += size
+
+    # drop consumed messages so the buffer never grows past one chunk plus one message
+    del buf[:pos]
+
+  if len(buf):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+class LogIndex:
+  """
+    Per-segment index of the decompressed event stream: byte offset, size, service and logMonoTime of each event.
+    Lets readers decode only the events of the services they want.
+  """
+  MAGIC = b"OPLOGIDX"
+  VERSION = 1
+  NO_SERVICE = 0xFFFF  # events without a valid union type
+
+  def __init__(self, services: list[str], service_ids: array.array, offsets: array.array, sizes: array.array, mono_times: array.array):
+    self.services = services
+    self.service_ids = service_ids
+    self.offsets = offsets
+    self.sizes = sizes
+    self.mono_times = mono_times
+
+  def __len__(self) -> int:
+    return len(self.offsets)
+
+  @classmethod
+  def build(cls, dat: bytes) -> 'LogIndex':
+    services: dict[str, int] = {}
+    service_ids, offsets, sizes, mono_times = array.array('H'), array.array('Q'), array.array('Q'), array.array('Q')
+
+    view = memoryview(dat)
+    pos = 0
+    while (size := event_size(view, pos)) is not None:
+      try:
+        with capnp_log.Event.from_bytes(view[pos:pos + size]) as ent:
+          mono_time = ent.logMonoTime
+          try:
+            service_id = services.setdefault(ent.which(), len(services))
+          except capnp.KjException:
+            service_id = cls.NO_SERVICE
+      except capnp.KjException:
+        break
+
+      service_ids.append(service_id)
+      offsets.append(pos)
+      sizes.append(size)
+      mono_times.append(mono_time)
+      pos += size
+
+    return cls(list(services), service_ids, offsets, sizes, mono_times)
+
+  def select(self, services: Iterable[str]) -> Iterator[int]:
+    """Indices of the events belonging to any of services, in log order."""
+    ids = {self.services.index(s) for s in services if s in self.services}
+    return (i for i, service_id in enumerate(self.service_ids) if service_id in ids)
+
+  def to_bytes(self) -> bytes:
+    names = "\n".join(self.services).encode()
+    header = self.MAGIC + struct.pack("<III", self.VERSION, len(self), len(names))
+    return b"".join([header, names, self.service_ids.tobytes(), self.offsets.tobytes(), self.sizes.tobytes(), self.mono_times.tobytes()])
+
+  @classmethod
+  def from_bytes(cls, dat: bytes) -> 'LogIndex':
+    if not dat.startswith(cls.MAGIC):
+      raise ValueError("not a log index")
+    pos = len(cls.MAGIC)
+    version, count, names_len = struct.unpack_from("<III", dat, pos)
+    if version != cls.VERSION:
+      raise ValueError(f"unsupported log index version {version}")
+    pos += 12
+
+    services = dat[pos:pos + names_len].decode().split("\n") if names_len else []
+    pos += names_len
+
+    arrays = []
+    for typecode in ('H', 'Q', 'Q', 'Q'):
+      arr = array.array(typecode)
+      arr.frombytes(dat[pos:pos + count * arr.itemsize])
+      arrays.append(arr)
+      pos += count * arr.itemsize
+    return cls(services, *arrays)
+
+
+def log_index_name(fn: str) -> str:
+  # local files can be rewritten in place, so include their size and mtime in the key
+  fn = resolve_name(fn)
+  if os.path.isfile(fn):
+    st = os.stat(fn)
+    fn = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return hash_256(fn) + "_logindex"
+
+
+def get_log_index(fn: str, dat: bytes) -> LogIndex:
+  # indexes live in the download cache, so they're evicted along with the downloaded chunks
+  cache = DownloadCache.instance()
+  name = log_index_name(fn)
+  cached = cache.get(name, fn)
+  if cached is not None:
+    try:
+      return LogIndex.from_bytes(cached)
+    except ValueError:
+      pass
+
+  index = LogIndex.build(dat)
+  cache.put(name, fn, index.to_bytes())
+  return index
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, stream=False, use_index=False, raw=False):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
+    self._stream = stream
+    self._fn = fn
 
     ext = None
     if not dat:
@@ -60,6 +285,16 @@ class _LogFileReader:
         # old rlogs weren't compressed
         raise ValueError(f"unknown extension {ext}")
 
+    self._ext = ext
+    if stream:
+      if sort_by_time:
+        raise ValueError("sort_by_time requires the whole segment, it can't be used when streaming")
+      if dat:
+        raise ValueError("streaming is only supported when reading from a file")
+      # events are read lazily in __iter__
+      return
+
+    if not dat:
       with FileReader(fn) as f:
         dat = f.read()
 
@@ -69,20 +304,48 @@ class _LogFileReader:
       # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
       dat = decompress_stream(dat)
 
-    ents = capnp_log.Event.read_multiple_bytes(dat)
+    # with an index or for raw events, events are only parsed once something iterates over all of them.
+    # the parsed events point into dat, so keeping it around for raw_events costs nothing
+    self._dat = dat
+    self._index = get_log_index(fn, dat) if use_index and fn else None
+    self._ents_cache: list[capnp._DynamicStructReader] | None = None
+    if self._index is None and not raw:
+      self._ents_cache = self._parse_ents()
+
+  def _parse_ents(self) -> list[capnp._DynamicStructReader]:
+    ents = capnp_log.Event.read_multiple_bytes(self._dat)
 
-    self._ents = []
+    ret = []
     try:
       for e in ents:
-        self._ents.append(e)
+        ret.append(e)
     except capnp.KjException:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
-    if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+    if self._sort_by_time:
+      ret.sort(key=lambda x: x.logMonoTime)
+    return ret
+
+  @property
+  def _ents(self) -> list[capnp._DynamicStructReader]:
+    if self._ents_cache is None:
+      self._ents_cache = self._parse_ents()
+    return self._ents_cache
+
+  def _iter_stream(self) -> Iterator[capnp._DynamicStructReader]:
+    with FileReader(self._fn, readahead=STREAM_READAHEAD) as f:
+      chunks = iter(partial(f.read, CHUNK_SIZE), b"")
+      for dat in split_events(decompress_chunks(chunks, self._ext)):
+        try:
+          with capnp_log.Event.from_bytes(dat) as ent:
+            pass
+        except capnp.KjException:
+          warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+          return
+        yield ent
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in self._iter_stream() if self._stream else self._ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -92,6 +355,69 @@ class _LogFileReader:
       else:
         yield ent
 
+  def filter(self, msg_types: Iterable[str]) -> Iterator[capnp._DynamicStructReader]:
+    """Events of the given services. Only those events are parsed when the segment has an index."""
+    msg_types = set(msg_types)
+    if self._stream or self._index is None:
+      for ent in self:
+        try:
+          if ent.which() in msg_types:
+            yield ent
+        except capnp.KjException:
+          pass
+      return
+
+    idxs = list(self._index.select(msg_types))
+    if self._sort_by_time:
+      idxs.sort(key=self._index.mono_times.__getitem__)
+
+    view = memoryview(self._dat)
+    for i in idxs:
+      offset, size = self._index.offsets[i], self._index.sizes[i]
+      with capnp_log.Event.from_bytes(view[offset:offset + size]) as ent:
+        pass
+      yield ent
+
+  def _raw_events(self) -> Iterator[RawEvent]:
+    if self._stream:
+      with FileReader(self._fn, readahead=STREAM_READAHEAD) as f:
+        chunks = iter(partial(f.read, CHUNK_SIZE), b"")
+        for dat in split_events(decompress_chunks(chunks, self._ext)):
+          yield *raw_event_header(dat, 0, len(dat)), memoryview(dat)
+      return
+
+    view = memoryview(self._dat)
+    if self._index is not None:
+      index = self._index
+      for service_id, offset, size, mono_time in zip(index.service_ids, index.offsets, index.sizes, index.mono_times, strict=True):
+        service = None if service_id == LogIndex.NO_SERVICE else index.services[service_id]
+        yield service, mono_time, view[offset:offset + size]
+      return
+
+    pos = 0
+    while (size := event_size(view, pos)) is not None:
+      yield *raw_event_header(view, pos, size), view[pos:pos + size]
+      pos += size
+    if pos != len(view):
+      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  def raw_events(self, msg_types: Iterable[str] | None = None) -> Iterator[RawEvent]:
+    """
+      (service, logMonoTime, bytes) of each event, optionally only of the given services, without parsing them.
+      The bytes are views into the decompressed segment, they can be written out again with save_log.
+    """
+    msg_types = set(msg_types) if msg_types is not None else None
+    events: Iterable[RawEvent] = self._raw_events()
+    if self._sort_by_time:
+      events = sorted(events, key=lambda e: e[1])
+
+    for ev in events:
+      if msg_types is not None and ev[0] not in msg_types:
+        continue
+      if self._only_union_types and ev[0] is None:
+        continue
+      yield ev
+
 
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
@@ -275,27 +601,80 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               source: Source = auto_source, sort_by_time=False, only_union_types=False):
+               source: Source = auto_source, sort_by_time=False, only_union_types=False, streaming=False,
+               use_index=False, prefetch=0):
     self.default_mode = default_mode
     self.source = source
     self.identifier = identifier
     if isinstance(identifier, str):
       self.identifier = [identifier]
 
+    if streaming and sort_by_time:
+      raise ValueError("sort_by_time requires whole segments in memory, it can't be used with streaming")
+
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    # streaming decodes segments lazily and doesn't keep them around, so memory stays flat over long routes
+    self.streaming = streaming
+    # use_index caches a per-segment message type index so filter and first only parse the events they need
+    self.use_index = use_index
+    # number of segments to download and decode in background threads ahead of the one being read.
+    # segments read this way aren't kept around for later iterations
+    self.prefetch = prefetch
 
     self.__lrs: dict[int, _LogFileReader] = {}
     self.reset()
 
-  def _get_lr(self, i):
+  def _get_lr(self, i, raw=False):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                                     use_index=self.use_index, raw=raw)
     return self.__lrs[i]
 
+  def _load_lr(self, i, raw=False) -> _LogFileReader:
+    if self.streaming:
+      # with prefetching, segments are read whole in the background
+      return _LogFileReader(self.logreader_identifiers[i], only_union_types=self.only_union_types, stream=self.prefetch == 0, raw=raw)
+    if self.prefetch > 0 and i not in self.__lrs:
+      # prefetched segments are dropped once consumed, so memory is bounded by the prefetch window
+      return _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                            use_index=self.use_index, raw=raw)
+    return self._get_lr(i, raw)
+
+  def _iter_lrs(self, raw=False) -> Iterator[_LogFileReader]:
+    num_segs = len(self.logreader_identifiers)
+    if self.prefetch == 0:
+      for i in range(num_segs):
+        yield self._load_lr(i, raw)
+      return
+
+    # the segment being read plus at most prefetch segments ahead of it are in memory, yielded in order
+    pool = ThreadPoolExecutor(max_workers=self.prefetch)
+    futures: dict[int, Future] = {}
+    try:
+      for i in range(num_segs):
+        current = futures.pop(i) if i in futures else pool.submit(self._load_lr, i, raw)
+        for j in range(i + 1, min(i + 1 + self.prefetch, num_segs)):
+          if j not in futures:
+            futures[j] = pool.submit(self._load_lr, j, raw)
+        lr = current.result()
+        del current
+        yield lr
+        del lr
+    finally:
+      pool.shutdown(wait=False, cancel_futures=True)
+
   def __iter__(self):
-    for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
+    for lr in self._iter_lrs():
+      yield from lr
+
+  def raw_events(self, msg_types: Iterable[str] | None = None) -> Iterator[RawEvent]:
+    """
+      (service, logMonoTime, bytes) of the events of every segment, optionally only of the given services.
+      Segments are only decompressed, so filtering and saving them again with save_log is bound by I/O.
+    """
+    for lr in self._iter_lrs(raw=True):
+      yield from lr.raw_events(msg_types)
 
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
@@ -318,14 +697,27 @@ class LogReader:
     return _LogFileReader("", dat=dat)
 
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    return (getattr(m, msg_type) for lr in self._iter_lrs() for m in lr.filter([msg_type]))
 
   def first(self, msg_type: str):
-    return next(self.filter(msg_type), None)
+    # usually in the first segment, so segments are loaded one at a time rather than prefetched
+    for i in range(len(self.logreader_identifiers)):
+      for m in self._load_lr(i).filter([msg_type]):
+        return getattr(m, msg_type)
+    return None
 
   @property
   def time_series(self):
-    return msgs_to_time_series(self)
+    return self.get_time_series()
+
+  def get_time_series(self, services: Iterable[str] | None = None, fields: dict[str, list[str]] | None = None):
+    """
+      time_series, optionally for only the given services. With use_index, only the events of those services,
+      or of the services time_series supports, are parsed.
+    """
+    services = list(services) if services is not None else None
+    msgs = (m for lr in self._iter_lrs() for m in lr.filter(SUPPORTED_SERVICES if services is None else services))
+    return msgs_to_time_series(msgs, services, fields)
 
 if __name__ == "__main__":
   import codecs
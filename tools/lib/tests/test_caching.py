@@ -1,12 +1,16 @@
 import http.server
 import os
+import random
 import shutil
 import socket
+import subprocess
+import sys
 import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.download_cache import DownloadCache
+from openpilot.tools.lib.url_file import URLFile, CHUNK_SIZE
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -28,11 +32,38 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = random.Random(0).randbytes(int(3.5 * CHUNK_SIZE))
+
+  def do_GET(self):
+    if "Range" in self.headers:
+      start, end = self.headers["Range"].removeprefix("bytes=").split("-")
+      body = self.DATA[int(start):int(end) + 1]
+      self.send_response(206)
+    else:
+      body = self.DATA
+      self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
 @pytest.fixture
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
     yield f"http://{host}:{port}"
 
+
+@pytest.fixture
+def range_host():
+  with http_server_context(handler=RangeRequestHandler) as (host, port):
+    yield f"http://{host}:{port}"
+
 class TestFileDownload:
 
   def test_pipeline_defaults(self, host):
@@ -128,3 +159,104 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  @pytest.mark.parametrize("readahead", [0, 2])
+  def test_multi_chunk_reads(self, range_host, cache_enabled, readahead):
+    url = f"{range_host}/rlog"
+    data = RangeRequestHandler.DATA
+    for start, length in [(0, None), (CHUNK_SIZE - 10, 20), (5, 2 * CHUNK_SIZE), (len(data) - 100, 1000)]:
+      with URLFile(url, cache=cache_enabled, readahead=readahead) as f:
+        f.seek(start)
+        assert f.read(ll=length) == (data[start:] if length is None else data[start:start + length])
+
+    # sequential reads, as done when streaming a log
+    with URLFile(url, cache=cache_enabled, readahead=readahead) as f:
+      assert b"".join(iter(lambda: f.read(CHUNK_SIZE), b"")) == data
+
+  def test_readahead_window(self, range_host):
+    data = RangeRequestHandler.DATA
+    with URLFile(f"{range_host}/rlog", cache=False, readahead=2) as f:
+      assert f.read(CHUNK_SIZE) == data[:CHUNK_SIZE]
+      assert set(f._inflight) == {1, 2}
+
+      # chunks read ahead for the old position are dropped after a seek
+      f.seek(3 * CHUNK_SIZE)
+      assert f.read(10) == data[3 * CHUNK_SIZE:3 * CHUNK_SIZE + 10]
+      assert len(f._inflight) == 0
+
+
+class TestDownloadCache:
+  def test_lru_eviction(self, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=3 * 100)
+    for i in range(3):
+      cache.put(f"chunk{i}", "url", bytes([i]) * 100)
+    assert cache.get("chunk0") == bytes([0]) * 100
+
+    # chunk1 is now the least recently used
+    cache.put("chunk3", "url", bytes([3]) * 100)
+    assert cache.size() == 300
+    assert cache.get("chunk1") is None
+    assert not os.path.exists(tmp_path / "chunk1")
+    for i in (0, 2, 3):
+      assert cache.get(f"chunk{i}") == bytes([i]) * 100
+
+    stats = cache.stats()
+    assert stats["hits"] == 4
+    assert stats["misses"] == 1
+    assert stats["bytes_saved"] == 400
+
+  def test_integrity(self, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=1000)
+    cache.put("chunk", "url", b"1234")
+    with open(tmp_path / "chunk", "wb") as f:
+      f.write(b"12")
+    assert cache.get("chunk") is None
+
+    # chunks that aren't indexed yet are picked up
+    with open(tmp_path / "unindexed", "wb") as f:
+      f.write(b"abcd")
+    assert cache.get("unindexed") == b"abcd"
+    assert cache.size() == 4
+
+  def test_shared_index(self, tmp_path):
+    cache1 = DownloadCache(str(tmp_path), max_bytes=150)
+    cache2 = DownloadCache(str(tmp_path), max_bytes=150)
+    cache1.put("chunk0", "url", b"0" * 100)
+    cache2.put("chunk1", "url", b"1" * 100)
+    assert cache1.get("chunk0") is None
+    assert cache1.get("chunk1") == b"1" * 100
+
+  def test_size_total(self, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_bytes=1000)
+    cache.put("a", "url", b"a" * 10)
+    cache.put("a", "url", b"a" * 20)
+    cache.put("b", "url", b"b" * 5)
+    assert cache.size() == 25
+
+    # chunks deleted outside of the cache are dropped from the index
+    os.remove(tmp_path / "b")
+    assert cache.get("b") is None
+    assert cache.size() == 20
+    assert DownloadCache(str(tmp_path)).size() == 20
+
+  def test_reopen(self, tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), max_bytes=1000)
+    cache.put("a", "url", b"a" * 10)
+    assert cache.get("a") == b"a" * 10
+
+    shutil.rmtree(tmp_path / "cache")
+    cache.reopen()
+    assert cache.get("a") is None
+    assert cache.size() == 0
+    cache.put("a", "url", b"a" * 10)
+    assert cache.stats()["size"] == 10
+
+  def test_flush_at_exit(self, tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path), max_bytes=1000)
+    cache.put("a", "url", b"a" * 10)
+
+    # a hit just before exiting, well within FLUSH_INTERVAL
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+    subprocess.check_call([sys.executable, "-c", "from openpilot.tools.lib.download_cache import DownloadCache; DownloadCache.instance().get('a')"])
+    assert cache.stats()["hits"] == 1
@@ -0,0 +1,149 @@
+import os
+import subprocess
+import numpy as np
+import pytest
+
+from openpilot.tools.lib.exceptions import DataUnreadableError
+from openpilot.tools.lib.framereader import FfmpegDecodeSession, FrameIterator, FrameReader, decompress_video_data, deserialize_video_index, \
+                                            get_index_data, get_video_index, serialize_video_index, video_index_path
+
+W, H = 64, 48
+NUM_FRAMES = 45
+GOP_SIZE = 10
+
+
+@pytest.fixture(scope="module")
+def video(tmp_path_factory):
+  fn = str(tmp_path_factory.mktemp("video") / "fcamera.hevc")
+  subprocess.check_call(["ffmpeg", "-v", "quiet", "-f", "lavfi", "-i", f"testsrc=size={W}x{H}:rate=20", "-frames:v", str(NUM_FRAMES),
+                         "-c:v", "libx265", "-x265-params", f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:bframes=0:log-level=none", "-f", "hevc", fn])
+  return fn
+
+
+@pytest.fixture(scope="module")
+def expected_frames(video):
+  # the whole file decoded by a single ffmpeg call
+  with open(video, "rb") as f:
+    return decompress_video_data(f.read(), W, H)
+
+
+class FailingFileReader:
+  def __init__(self, fn, failure):
+    self.f = open(fn, "rb")
+    self.failure = failure
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.f.close()
+
+  def seek(self, pos):
+    self.f.seek(pos)
+
+  def read(self, ll):
+    if self.failure == "error":
+      raise OSError("connection reset")
+    return b""  # the file ends early
+
+
+@pytest.fixture(autouse=True)
+def cache_root(tmp_path, monkeypatch):
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path / "cache"))
+
+
+class TestVideoIndex:
+  def test_index(self, video):
+    index_data = get_video_index(video, cache=False)
+    assert len(index_data['index']) == NUM_FRAMES + 1
+    assert list(np.where(index_data['index'][:-1, 0] == 2)[0]) == list(range(0, NUM_FRAMES, GOP_SIZE))
+
+    dat = deserialize_video_index(serialize_video_index(index_data))
+    assert np.array_equal(dat['index'], index_data['index'])
+    assert dat['global_prefix'] == index_data['global_prefix']
+    assert dat['probe'] == index_data['probe']
+
+  def test_cached_index(self, video):
+    path = video_index_path(video)
+    assert not os.path.exists(path)
+    index_data = get_video_index(video)
+    assert os.path.exists(path)
+    assert np.array_equal(get_video_index(video)['index'], index_data['index'])
+
+    # a rewritten file gets a new index
+    st = os.stat(video)
+    os.utime(video, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert video_index_path(video) != path
+
+
+class TestFrameReader:
+  def test_iterator(self, video, expected_frames):
+    assert np.array_equal(np.stack(list(FrameIterator(video))), expected_frames)
+    frames = list(FrameIterator(video, start_fidx=13, end_fidx=37, frame_skip=3))
+    assert np.array_equal(np.stack(frames), expected_frames[13:37:3])
+
+  def test_session(self, video, expected_frames):
+    index, prefix, w, h = get_index_data(video)
+    # the second and third GOP
+    with FfmpegDecodeSession(video, prefix, int(index[10, 1]), int(index[30, 1]), w, h) as session:
+      frames = []
+      while (frame := session.read_frame()) is not None:
+        frames.append(frame)
+    assert np.array_equal(np.stack(frames), expected_frames[10:30])
+
+  @pytest.mark.parametrize("failure", ["error", "short_read"])
+  def test_read_errors(self, video, expected_frames, monkeypatch, failure):
+    fr = FrameReader(video)
+    with monkeypatch.context() as m:
+      m.setattr("openpilot.tools.lib.framereader.FileReader", lambda fn, readahead=0: FailingFileReader(fn, failure))
+      with pytest.raises(OSError if failure == "error" else DataUnreadableError):
+        fr.get(15)
+      # the GOP wasn't cached, so it's decoded again once the file can be read
+      assert 10 not in fr._cache
+    assert np.array_equal(fr.get(15), expected_frames[15])
+
+  def test_random_access(self, video, expected_frames):
+    # room for two GOPs of decoded frames
+    cache_bytes = 2 * GOP_SIZE * expected_frames[0].nbytes
+    fr = FrameReader(video, cache_bytes=cache_bytes)
+    for fidx in [44, 3, 17, 9, 30, 31, 0, 44, 22]:
+      assert np.array_equal(fr.get(fidx), expected_frames[fidx])
+      assert fr._cache.size <= cache_bytes
+    assert list(fr._cache._cache) == [40, 20]
+
+    fr = FrameReader(video, cache_bytes=None)
+    for fidx in range(NUM_FRAMES):
+      fr.get(fidx)
+    assert len(fr._cache) == 5
+
+  def test_readahead(self, video, expected_frames):
+    with FrameReader(video, readahead=True) as fr:
+      assert np.array_equal(fr.get(0), expected_frames[0])
+      # the next GOP is decoded in the background
+      assert fr._prefetch is not None and fr._prefetch[0] == GOP_SIZE
+      for fidx in range(1, NUM_FRAMES):
+        assert np.array_equal(fr.get(fidx), expected_frames[fidx])
+
+  @pytest.mark.parametrize("next_get", [5, GOP_SIZE + 5])
+  def test_readahead_error(self, video, expected_frames, monkeypatch, next_get):
+    with FrameReader(video, readahead=True) as fr:
+      decode_gop, failed = fr._decode_gop, []
+      def failing_decode_gop(gop_start):
+        if gop_start == GOP_SIZE and not failed:
+          failed.append(gop_start)
+          raise OSError("connection reset")
+        return decode_gop(gop_start)
+      monkeypatch.setattr(fr, "_decode_gop", failing_decode_gop)
+
+      assert np.array_equal(fr.get(0), expected_frames[0])
+      assert fr._prefetch is not None and isinstance(fr._prefetch[1].exception(), OSError)
+
+      # the failed prefetch isn't raised by an unrelated get(), and its GOP is decoded again when it's needed
+      assert np.array_equal(fr.get(next_get), expected_frames[next_get])
+      assert np.array_equal(fr.get(GOP_SIZE + 1), expected_frames[GOP_SIZE + 1])
+
+  def test_get_many(self, video, expected_frames):
+    fr = FrameReader(video)
+    fidxs = [30, 1, 11, 30, 44, 12]
+    assert all(np.array_equal(f, expected_frames[i]) for f, i in zip(fr.get_many(fidxs), fidxs, strict=True))
+    assert sorted(fr._cache._cache) == [0, 10, 30, 40]
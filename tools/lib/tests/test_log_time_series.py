@@ -0,0 +1,69 @@
+import numpy as np
+
+from cereal import log
+from openpilot.tools.lib.log_time_series import RaggedArray, load_columns, msgs_to_columns, msgs_to_time_series, save_columns
+
+
+def get_msgs():
+  msgs = []
+  for i in range(50):
+    msg = log.Event.new_message(logMonoTime=(100 - i) * 10**6)
+    cs = msg.init('carState')
+    cs.vEgo = i
+    cs.gearShifter = 'drive'
+    cs.cruiseState.speed = 2 * i
+    msgs.append(msg.as_reader())
+
+    msg = log.Event.new_message(logMonoTime=i * 10**6)
+    msg.init('modelV2').position.x = [float(i)] * (5 if i % 2 else 3)
+    msgs.append(msg.as_reader())
+
+    msg = log.Event.new_message(logMonoTime=i * 10**6)
+    accel = msg.init('accelerometer')
+    if i % 2:
+      accel.init('acceleration').v = [1., 2., 3.]
+    else:
+      accel.init('gyro').v = [1., 2.]
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestLogTimeSeries:
+  def test_time_series(self):
+    ts = msgs_to_time_series(get_msgs())
+
+    # sorted by time
+    assert np.all(np.diff(ts['carState']['t']) > 0)
+    assert np.array_equal(ts['carState']['vEgo'], np.arange(49, -1, -1))
+    assert np.array_equal(ts['carState']['cruiseState/speed'], 2 * np.arange(49, -1, -1))
+    assert set(ts['carState']['gearShifter']) == {'drive'}
+    assert ts['carState']['_valid'].all()
+
+    # same dtypes as numpy picks for python values
+    assert ts['carState']['vEgo'].dtype == np.float64
+    assert ts['carState']['canErrorCounter'].dtype == np.int64
+    assert ts['carState']['gearShifter'].dtype.kind == 'U'
+
+    # ragged lists become object arrays
+    assert [len(x) for x in ts['modelV2']['position/x'][:4]] == [3, 5, 3, 5]
+
+    # only the active union member is filled in
+    assert [len(x) for x in ts['accelerometer']['gyro/v'][:4]] == [2, 0, 2, 0]
+    assert ts['accelerometer']['acceleration/v'][1].tolist() == [1., 2., 3.]
+
+  def test_columns(self, tmp_path):
+    cols = msgs_to_columns(get_msgs(), services=['carState', 'modelV2'], fields={'carState': ['cruiseState/speed']})
+    assert set(cols) == {'carState', 'modelV2'}
+    assert set(cols['carState']) == {'t', '_valid', 'cruiseState/speed'}
+
+    x = cols['modelV2']['position/x']
+    assert isinstance(x, RaggedArray)
+    assert len(x) == 50
+    assert x[1].tolist() == [1.] * 5
+
+    fn = str(tmp_path / "columns.npz")
+    save_columns(fn, cols)
+    loaded = load_columns(fn)
+    assert np.array_equal(loaded['carState']['cruiseState/speed'], cols['carState']['cruiseState/speed'])
+    assert np.array_equal(loaded['modelV2']['position/x'].offsets, x.offsets)
+    assert np.array_equal(loaded['modelV2']['position/x'].values, x.values)
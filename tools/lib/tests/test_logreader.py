@@ -10,7 +10,9 @@ import requests
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from openpilot.tools.lib.download_cache import DownloadCache
+from openpilot.tools.lib.logreader import LogIterable, LogReader, _LogFileReader, comma_api_source, log_index_name, parse_indirect, save_log, ReadMode, \
+                                          InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
 
@@ -254,3 +256,121 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_streaming(self, ext):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, f"rlog{ext}")
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        msg.init('carState').vEgo = i
+        msgs.append(msg.as_reader())
+      save_log(fn, msgs)
+
+      expected = [m.as_builder().to_bytes() for m in LogReader(fn)]
+      streamed = [m.as_builder().to_bytes() for m in LogReader(fn, streaming=True)]
+      assert len(expected) == 1000
+      assert streamed == expected
+
+      with pytest.raises(ValueError):
+        LogReader(fn, streaming=True, sort_by_time=True)
+
+  def test_index(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setenv("COMMA_CACHE", os.path.join(tmpdir, "cache"))
+      fn = os.path.join(tmpdir, "rlog.zst")
+      msgs = []
+      for i in range(100):
+        msg = capnp_log.Event.new_message(logMonoTime=100 - i)
+        if i % 10 == 0:
+          msg.init('carParams').carFingerprint = str(i)
+        else:
+          msg.init('carState').vEgo = i
+        msgs.append(msg.as_reader())
+      save_log(fn, msgs)
+
+      for _ in range(2):
+        lr = LogReader(fn, use_index=True)
+        assert [cp.carFingerprint for cp in lr.filter("carParams")] == [str(i) for i in range(0, 100, 10)]
+        assert lr.first("carParams").carFingerprint == "0"
+        assert lr.first("initData") is None
+        assert len(list(lr)) == 100
+        assert DownloadCache.instance().get(log_index_name(fn), fn) is not None
+
+      lr = LogReader(fn, use_index=True, sort_by_time=True)
+      assert [cp.carFingerprint for cp in lr.filter("carParams")] == [str(i) for i in range(90, -1, -10)]
+
+      ts = LogReader(fn, use_index=True).time_series
+      assert ts['carState']['vEgo'].tolist() == [i for i in range(99, 0, -1) if i % 10 != 0]
+      assert ts.keys() == LogReader(fn).time_series.keys()
+
+      # the index is kept in the size-bounded download cache
+      assert DownloadCache.instance().stats()["size"] > 0
+
+  @pytest.mark.parametrize("streaming", [True, False])
+  def test_prefetch(self, streaming):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(5):
+        fn = os.path.join(tmpdir, f"{seg}_rlog.zst")
+        save_log(fn, [capnp_log.Event.new_message(logMonoTime=seg * 100 + i).as_reader() for i in range(100)])
+        fns.append(fn)
+
+      expected = [m.logMonoTime for m in LogReader(fns)]
+      assert expected == list(range(500))
+      for prefetch in (1, 2, 8):
+        lr = LogReader(fns, streaming=streaming, prefetch=prefetch)
+        assert [m.logMonoTime for m in lr] == expected
+        # consumed segments aren't kept around
+        assert len(lr._LogReader__lrs) == 0
+
+  def test_first_prefetch(self, mocker):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(5):
+        fn = os.path.join(tmpdir, f"{seg}_rlog.zst")
+        msg = capnp_log.Event.new_message(logMonoTime=seg)
+        msg.init('carParams').carFingerprint = str(seg)
+        save_log(fn, [msg.as_reader()])
+        fns.append(fn)
+
+      init_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader", wraps=_LogFileReader)
+      lr = LogReader(fns, prefetch=4)
+      assert lr.first("carParams").carFingerprint == "0"
+      assert lr.first("initData") is None
+
+      # only the first segment is loaded to find carParams, and it isn't kept around for raw events
+      assert init_mock.call_count == 1 + len(fns)
+      assert len(lr._LogReader__lrs) == 0
+      assert [t for _, t, _ in lr.raw_events()] == list(range(5))
+      assert all(c.kwargs.get("raw") for c in init_mock.call_args_list[-len(fns):])
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_raw_events(self, ext):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, f"rlog{ext}")
+      msgs = []
+      for i in range(100):
+        msg = capnp_log.Event.new_message(logMonoTime=1000 - i, valid=True)
+        if i % 10 == 0:
+          msg.init('carParams').carFingerprint = str(i)
+        else:
+          msg.init('carState').vEgo = i
+        msgs.append(msg.as_reader())
+      non_union_bytes = bytearray(capnp_log.Event.new_message(logMonoTime=1).to_bytes())
+      non_union_bytes[capnp_log.Event.new_message().total_size.word_count * 8] = 0xff
+      save_log(fn, [*msgs, bytes(non_union_bytes)])
+
+      expected = [(m.which(), m.logMonoTime, m.as_builder().to_bytes()) for m in msgs] + [(None, 1, bytes(non_union_bytes))]
+      for streaming in (False, True):
+        raw = list(LogReader(fn, streaming=streaming).raw_events())
+        assert [(s, t, bytes(dat)) for s, t, dat in raw] == expected
+
+      assert [t for _, t, _ in LogReader(fn, sort_by_time=True).raw_events()] == sorted(t for _, t, _ in expected)
+      assert len(list(LogReader(fn, only_union_types=True).raw_events())) == len(msgs)
+
+      # raw events are written back as they are
+      out_fn = os.path.join(tmpdir, f"filtered{ext}")
+      save_log(out_fn, LogReader(fn).raw_events(["carParams"]))
+      assert [m.carParams.carFingerprint for m in LogReader(out_fn)] == [str(i) for i in range(0, 100, 10)]
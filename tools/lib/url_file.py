@@ -2,6 +2,7 @@ import logging
 import os
 import socket
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -9,9 +10,12 @@ from urllib3.util import Timeout
 
 from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.download_cache import DownloadCache
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+# Concurrent range requests per URLFile, the PoolManager keeps up to 100 connections per host
+DOWNLOAD_THREADS = 8
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -38,7 +42,7 @@ class URLFile:
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
-  def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None):
+  def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None, readahead: int=0):
     self._url = url
     self._timeout = Timeout(connect=timeout, read=timeout)
     self._pos = 0
@@ -49,14 +53,28 @@ class URLFile:
     if cache is not None:
       self._force_download = not cache
 
+    # number of chunks to fetch in the background after sequential reads
+    self._readahead = readahead
+    self._last_read_end = 0
+    self._inflight: dict[int, Future] = {}
+    self._pool: ThreadPoolExecutor|None = None
+
+    self._cache: DownloadCache|None = None
     if not self._force_download:
       os.makedirs(Paths.download_cache_root(), exist_ok=True)
+      self._cache = DownloadCache.instance()
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback) -> None:
-    pass
+    self.close()
+
+  def close(self) -> None:
+    if self._pool is not None:
+      self._pool.shutdown(wait=True, cancel_futures=True)
+      self._pool = None
+    self._inflight.clear()
 
   def _request(self, method: str, url: str, headers: dict[str, str]|None=None) -> BaseHTTPResponse:
     return URLFile.pool_manager().request(method, url, timeout=self._timeout, headers=headers)
@@ -85,50 +103,82 @@ class URLFile:
         file_length.write(str(self._length))
     return self._length
 
-  def read(self, ll: int|None=None) -> bytes:
+  def _download_chunk(self, chunk_idx: int) -> bytes:
+    start = chunk_idx * CHUNK_SIZE
+    end = min(start + CHUNK_SIZE, self.get_length()) - 1
+    if start > end:
+      return b""
+    return self._get({'Range': f"bytes={start}-{end}"})
+
+  def _load_chunk(self, chunk_idx: int) -> bytes:
     if self._force_download:
-      return self.read_aux(ll=ll)
+      return self._download_chunk(chunk_idx)
+
+    assert self._cache is not None
+    name = f"{hash_256(self._url)}_{float(chunk_idx)}"
+    data = self._cache.get(name, self._url)
+    if data is None:
+      data = self._download_chunk(chunk_idx)
+      self._cache.put(name, self._url, data)
+    return data
+
+  def _executor(self) -> ThreadPoolExecutor:
+    if self._pool is None:
+      self._pool = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS)
+    return self._pool
+
+  def _fetch_chunks(self, chunk_idxs: range) -> dict[int, bytes]:
+    # chunks that aren't being read ahead already are fetched concurrently
+    for idx in chunk_idxs:
+      if idx not in self._inflight:
+        if len(chunk_idxs) == 1:
+          return {idx: self._load_chunk(idx)}
+        self._inflight[idx] = self._executor().submit(self._load_chunk, idx)
+    return {idx: self._inflight.pop(idx).result() for idx in chunk_idxs}
+
+  def _read_ahead(self, window: range) -> None:
+    # chunks read ahead for an earlier position won't be read after a seek, don't keep them around
+    for idx in [idx for idx in self._inflight if idx not in window]:
+      self._inflight.pop(idx).cancel()
+
+    num_chunks = (self.get_length() + CHUNK_SIZE - 1) // CHUNK_SIZE
+    for idx in window:
+      if idx < num_chunks and idx not in self._inflight:
+        self._inflight[idx] = self._executor().submit(self._load_chunk, idx)
 
+  def read(self, ll: int|None=None) -> bytes:
     file_begin = self._pos
     file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    # without the cache, small reads are a single request unless we're reading ahead
+    if self._force_download and (file_end == -1 or (not self._readahead and file_end - file_begin <= CHUNK_SIZE)):
+      return self.read_aux(ll=ll)
 
-  def read_aux(self, ll: int|None=None) -> bytes:
-    download_range = False
-    headers = {}
-    if self._pos != 0 or ll is not None:
-      if ll is None:
-        end = self.get_length() - 1
-      else:
-        end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
-        return b""
-      headers['Range'] = f"bytes={self._pos}-{end}"
-      download_range = True
+    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    file_end = min(file_end, self.get_length())
+    if file_begin >= file_end:
+      return b""
+
+    #  We have to align with chunks we store
+    first_chunk, last_chunk = file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE
+    chunks = self._fetch_chunks(range(first_chunk, last_chunk + 1))
+
+    parts = []
+    for idx in range(first_chunk, last_chunk + 1):
+      data = chunks[idx]
+      position = idx * CHUNK_SIZE
+      src_begin = max(0, file_begin - position)
+      src_end = min(len(data), file_end - position)
+      parts.append(data if src_begin == 0 and src_end == len(data) else memoryview(data)[src_begin:src_end])
+
+    sequential = self._readahead and file_begin == self._last_read_end
+    if self._readahead:
+      self._read_ahead(range(last_chunk + 1, last_chunk + 1 + self._readahead) if sequential else range(0))
+    self._pos = self._last_read_end = file_end
+    # a whole chunk is returned as it is, anything else is copied once
+    return parts[0] if len(parts) == 1 and isinstance(parts[0], bytes) else b"".join(parts)
+
+  def _get(self, headers: dict[str, str]) -> bytes:
+    download_range = 'Range' in headers
 
     if self._debug:
       t1 = time.time()
@@ -148,7 +198,20 @@ class URLFile:
       raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
     if (not download_range) and response_code != 200:  # OK
       raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
+    return ret
+
+  def read_aux(self, ll: int|None=None) -> bytes:
+    headers = {}
+    if self._pos != 0 or ll is not None:
+      if ll is None:
+        end = self.get_length() - 1
+      else:
+        end = min(self._pos + ll, self.get_length()) - 1
+      if self._pos >= end:
+        return b""
+      headers['Range'] = f"bytes={self._pos}-{end}"
 
+    ret = self._get(headers)
     self._pos += len(ret)
     return ret
 
@@ -4,6 +4,8 @@ import os
 import struct
 from enum import IntEnum
 
+import numpy as np
+
 from openpilot.tools.lib.filereader import FileReader
 
 DEBUG = int(os.getenv("DEBUG", "0"))
@@ -17,6 +19,9 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+# start code, NAL unit header and enough of the slice segment header to get the slice type
+NAL_HEADER_WINDOW = NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE + 4
+SCAN_CHUNK_SIZE = 1000 * 1000
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -258,38 +263,106 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
+def find_nal_unit_starts(arr: np.ndarray) -> np.ndarray:
+  """Indices of every NAL unit start code in arr, found in one vectorized pass."""
+  if len(arr) < NAL_UNIT_START_CODE_SIZE:
+    return np.zeros(0, dtype=np.int64)
+  return np.flatnonzero((arr[:-2] == 0) & (arr[1:-1] == 0) & (arr[2:] == 1))
+
+def scan_nal_units(f, chunk_size: int = SCAN_CHUNK_SIZE) -> tuple[np.ndarray, np.ndarray, int]:
+  """
+    Find the start of every NAL unit in a file-like object, reading it chunk_size bytes at a time.
+    Returns the NAL unit start offsets, the first NAL_HEADER_WINDOW bytes of each one, and the data length.
+  """
+  starts, windows = [], []
+  base = 0  # offset of buf in the file
+  buf = b""
+  while True:
+    chunk = f.read(chunk_size)
+    eof = len(chunk) == 0
+    buf += chunk
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    pos = find_nal_unit_starts(arr)
+
+    # NAL units whose header window isn't read yet are picked up with the next chunk
+    done = len(pos) if eof else np.searchsorted(pos, len(buf) - NAL_HEADER_WINDOW, side="right")
+    if done:
+      padded = np.concatenate([arr, np.zeros(NAL_HEADER_WINDOW, dtype=np.uint8)])
+      starts.append(pos[:done] + base)
+      windows.append(padded[pos[:done, None] + np.arange(NAL_HEADER_WINDOW)])
+
+    if eof:
+      break
+    keep = pos[done] if done < len(pos) else max(len(buf) - (NAL_UNIT_START_CODE_SIZE - 1), 0)
+    base += keep
+    buf = buf[keep:]
+
+  if not len(starts):
+    return np.zeros(0, dtype=np.int64), np.zeros((0, NAL_HEADER_WINDOW), dtype=np.uint8), base + len(buf)
+  return np.concatenate(starts), np.concatenate(windows), base + len(buf)
+
+def _read_ue(bits: np.ndarray, valid: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  # exp-golomb codes at the top of 32-bit words, returns their values and sizes in bits
+  valid = valid & (bits != 0)
+  lz = 31 - np.floor(np.log2(np.where(valid, bits, 1))).astype(np.int64)
+  size = 2 * lz + 1
+  valid &= size <= 32
+  size = np.where(valid, size, 1)
+  val = (bits >> (32 - size).astype(np.uint64)) - 1
+  return val.astype(np.int64), size, valid
+
 def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
   with FileReader(hevc_file_name) as f:
-    dat = f.read()
-
-  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
-    raise VideoFileInvalid("data is too short")
-
-  if dat[0] != 0x00:
-    raise VideoFileInvalid("first byte must be 0x00")
-
-  prefix_dat = b""
-  frame_types = list()
-
-  i = 1 # skip past first byte 0x00
-  try:
-    while i < len(dat):
-      require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
-      nal_unit_type = get_hevc_nal_unit_type(dat, i)
-      if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
-      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
-        slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
-        if is_first_slice:
-          frame_types.append((slice_type, i))
-      i += nal_unit_len
-  except Exception as e:
-    if not allow_corrupt:
-      raise
-    print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
-
-  return frame_types, len(dat), prefix_dat
+    head = f.read(NAL_UNIT_START_CODE_SIZE + 1)
+    if len(head) < NAL_UNIT_START_CODE_SIZE + 1:
+      raise VideoFileInvalid("data is too short")
+    if head[0] != 0x00:
+      raise VideoFileInvalid("first byte must be 0x00")
+    f.seek(0)
+    starts, windows, dat_len = scan_nal_units(f)
+
+    # every NAL unit runs up to the next start code, and the first one starts after the leading 0x00
+    lengths = np.diff(np.append(starts, dat_len))
+    nal_unit_types = (windows[:, NAL_UNIT_START_CODE_SIZE].astype(np.int64) >> 1) & 0x3F
+    errors = np.full(len(starts), "", dtype=object)
+    errors[starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE > dat_len] = "data to short to contain nal unit header"
+
+    # 7.3.6.1 General slice segment header syntax, see get_hevc_slice_type
+    rbsp = windows[:, NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE:].astype(np.uint64)
+    is_slice = np.isin(nal_unit_types, HEVC_CODED_SLICE_SEGMENT_NAL_UNITS)
+    is_first_slice = is_slice & ((rbsp[:, 0] >> 7) & 1 == 1)
+    skip_bits = 1 + ((nal_unit_types >= HevcNalUnitType.BLA_W_LP) & (nal_unit_types <= HevcNalUnitType.RSV_IRAP_VCL23))
+    bits = (rbsp[:, 0] << 24) | (rbsp[:, 1] << 16) | (rbsp[:, 2] << 8) | rbsp[:, 3]
+    bits = (bits << skip_bits.astype(np.uint64)) & 0xFFFFFFFF
+    _, pps_id_size, valid = _read_ue(bits, is_first_slice)
+    bits = (bits << pps_id_size.astype(np.uint64)) & 0xFFFFFFFF
+    slice_types, _, valid = _read_ue(bits, valid)
+    errors[is_first_slice & ~valid] = "invalid exponential-golomb code"
+    errors[valid & (slice_types > 2)] = "slice_type must be 0, 1, or 2"
+
+    if not len(starts) or starts[0] != 1:
+      errors = np.append("data must begin with start code", errors)
+      starts, lengths = np.append(1, starts), np.append(0, lengths)
+      nal_unit_types, is_first_slice, slice_types = np.append(-1, nal_unit_types), np.append(False, is_first_slice), np.append(0, slice_types)
+
+    failed = np.flatnonzero(errors != "")
+    end = len(starts)
+    if len(failed):
+      end = failed[0]
+      if not allow_corrupt:
+        raise VideoFileInvalid(errors[end])
+      print(f"ERROR: NAL unit skipped @ {starts[end]}\n", errors[end])
+
+    frames = np.flatnonzero(is_first_slice[:end])
+    frame_types = list(zip(slice_types[frames].tolist(), starts[frames].tolist(), strict=True))
+
+    # parameter sets are tiny, so they're read back after the scan
+    prefix_dat = bytearray()
+    for i in np.flatnonzero(np.isin(nal_unit_types[:end], HEVC_PARAMETER_SET_NAL_UNITS)):
+      f.seek(int(starts[i]))
+      prefix_dat += f.read(int(lengths[i]))
+
+  return frame_types, dat_len, bytes(prefix_dat)
 
 def main() -> None:
   parser = argparse.ArgumentParser()
@@ -8,7 +8,6 @@ import tarfile
 import tempfile
 import requests
 import argparse
-from functools import partial
 
 from opendbc.car.fingerprints import MIGRATION
 from openpilot.common.basedir import BASEDIR
@@ -77,16 +76,19 @@ def start_juggler(fn=None, dbc=None, layout=None, route_or_segment_name=None, pl
   subprocess.call(cmd, shell=True, env=env, cwd=juggle_dir)
 
 
-def process(can, lr):
-  return [d for d in lr if can or d.which() not in ['can', 'sendcan'] and not d.which().startswith('customReserved')]
+def keep_service(can, service):
+  return can or service not in ['can', 'sendcan'] and not service.startswith('customReserved')
 
 
 def juggle_route(route_or_segment_name, can, layout, dbc, should_migrate):
-  lr = LogReader(route_or_segment_name, default_mode=ReadMode.AUTO_INTERACTIVE)
+  lr = LogReader(route_or_segment_name, default_mode=ReadMode.AUTO_INTERACTIVE, prefetch=24)
 
-  all_data = lr.run_across_segments(24, partial(process, can))
   if should_migrate:
-    all_data = migrate_all(all_data)
+    # streamed, so only the segments being migrated are held in memory
+    all_data = migrate_all(d for d in lr if keep_service(can, d.which()))
+  else:
+    # nothing to change, so the events are copied over without being parsed
+    all_data = (ev for ev in lr.raw_events() if ev[0] is not None and keep_service(can, ev[0]))
 
   # Infer DBC name from logs
   platform = None